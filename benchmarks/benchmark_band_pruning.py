@@ -0,0 +1,95 @@
+# -*- coding: utf-8 -*-
+""" Compares sensor_forward_model_batch on the full model wavelength grid
+with evaluating the model on the support of the sensor filter only.
+
+Usage::
+
+    python benchmarks/benchmark_band_pruning.py [batch size]
+"""
+from __future__ import (
+    absolute_import,
+    division,
+    print_function,
+    unicode_literals)
+
+import sys
+import time
+
+import numpy as np
+from pkg_resources import resource_filename
+
+import sambuca_core as sbc
+from sambuca_core.tests.forward_model_inputs import (
+    load_forward_model_test_data,
+    random_free_parameters)
+
+REPEATS = 5
+# Approximate (lower, upper) band edges in nm of multispectral sensors, as
+# rectangular responses.
+SENSORS = (
+    ('Landsat 8 OLI bands 1-5', (
+        (433, 453), (450, 515), (525, 600), (630, 680), (845, 885))),
+    ('Sentinel-2 bands 1-8', (
+        (433, 453), (458, 523), (543, 578), (650, 680), (698, 713),
+        (733, 748), (773, 793), (785, 900))),
+    ('WorldView-2', (
+        (400, 450), (450, 510), (510, 580), (585, 625), (630, 690),
+        (705, 745), (770, 895), (860, 900))),
+)
+
+
+def _best_time(function):
+    best = np.inf
+    for _ in range(REPEATS):
+        start = time.time()
+        function()
+        best = min(best, time.time() - start)
+    return best
+
+
+def _filters(wavelengths):
+    for name, edges in SENSORS:
+        response = np.vstack([
+            (wavelengths >= low) & (wavelengths < high)
+            for low, high in edges]).astype(np.float64)
+        yield name, sbc.SensorFilter(wavelengths, response)
+    yield 'QuickBird test filter', sbc.load_sensor_filter_spectral_library(
+        resource_filename(sbc.__name__, 'tests/data/sensor_filters'),
+        'qbtest_filter_350_900nm')
+
+
+def main(batch_size=2048):
+    _, fixed, _ = load_forward_model_test_data()
+    context = sbc.ForwardModelContext(**fixed)
+    batch = random_free_parameters(batch_size)
+
+    for name, sensor_filter in _filters(context.wavelengths):
+        support = sensor_filter.support
+        pruned = context.subset(support)
+        print('{0}: {1} bands, {2} of {3} wavelengths supported'.format(
+            name, sensor_filter.num_bands, len(support), context.num_bands))
+        for compute_jacobian in (False, True):
+            full = sbc.sensor_forward_model_batch(
+                context, sensor_filter, compute_jacobian=compute_jacobian,
+                **batch)
+            results = sbc.sensor_forward_model_batch(
+                pruned, sensor_filter, compute_jacobian=compute_jacobian,
+                support=support, **batch)
+            identical = np.array_equal(results.rrs, full.rrs) and (
+                not compute_jacobian or
+                np.array_equal(results.jacobian, full.jacobian))
+            times = [
+                _best_time(lambda: sbc.sensor_forward_model_batch(
+                    context, sensor_filter,
+                    compute_jacobian=compute_jacobian, **batch)),
+                _best_time(lambda: sbc.sensor_forward_model_batch(
+                    pruned, sensor_filter, compute_jacobian=compute_jacobian,
+                    support=support, **batch))]
+            print('  jacobian={0}: {1:.4f} s -> {2:.4f} s ({3:.2f}x), '
+                  'bit-identical: {4}'.format(
+                      compute_jacobian, times[0], times[1],
+                      times[0] / times[1], identical))
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
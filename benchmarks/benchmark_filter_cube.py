@@ -0,0 +1,91 @@
+# -*- coding: utf-8 -*-
+""" Compares filtering a memory-mapped image cube in one call to
+SensorFilter.apply with the row blocks of filter_cube, with and without
+worker threads.
+
+Usage::
+
+    python benchmarks/benchmark_filter_cube.py [rows] [cols]
+"""
+from __future__ import (
+    absolute_import,
+    division,
+    print_function,
+    unicode_literals)
+
+import multiprocessing
+import os
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+from pkg_resources import resource_filename
+
+import sambuca_core as sbc
+
+REPEATS = 3
+BUDGETS = (4 * 1024 * 1024, 64 * 1024 * 1024)
+
+
+def _measure(function):
+    """ Returns the best time, and the peak memory allocated by numpy. """
+    best = np.inf
+    for _ in range(REPEATS):
+        start = time.time()
+        function()
+        best = min(best, time.time() - start)
+    tracemalloc.start()
+    function()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return best, peak
+
+
+def main(rows=512, cols=512):
+    sensor_filter = sbc.load_sensor_filter_spectral_library(
+        resource_filename(sbc.__name__, 'tests/data/sensor_filters'),
+        'CASI04_350_900_1nm')
+    directory = tempfile.mkdtemp()
+    try:
+        input_filename = os.path.join(directory, 'cube.npy')
+        output_filename = os.path.join(directory, 'filtered.npy')
+        cube = np.lib.format.open_memmap(
+            input_filename, mode='w+', dtype=np.float32,
+            shape=(rows, cols, sensor_filter.num_input_bands))
+        rng = np.random.RandomState(0)
+        for row in range(rows):
+            cube[row] = rng.uniform(size=cube.shape[1:])
+        cube.flush()
+        del cube
+        cube = np.load(input_filename, mmap_mode='r')
+        print('{0} x {1} x {2} float32 cube ({3:.0f} MB) to {4} bands'.format(
+            rows, cols, sensor_filter.num_input_bands, cube.nbytes / 2 ** 20,
+            sensor_filter.num_bands))
+
+        expected = sensor_filter.apply(cube)
+        elapsed, peak = _measure(lambda: sensor_filter.apply(cube))
+        print('  SensorFilter.apply: {0:.3f} s, peak {1:.1f} MB'.format(
+            elapsed, peak / 2 ** 20))
+
+        for budget in BUDGETS:
+            for workers in sorted({1, multiprocessing.cpu_count(), 4}):
+                def run():
+                    return sbc.filter_cube(
+                        sensor_filter, cube, output_filename,
+                        memory_budget=budget, max_workers=workers)
+                error = np.abs(run() - expected).max()
+                elapsed, peak = _measure(run)
+                print('  filter_cube, budget {0:.0f} MB, {1} workers: '
+                      '{2:.3f} s, peak {3:.1f} MB, max difference '
+                      '{4:.2g}'.format(
+                          budget / 2 ** 20, workers, elapsed,
+                          peak / 2 ** 20, error))
+    finally:
+        shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
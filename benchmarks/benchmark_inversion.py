@@ -0,0 +1,85 @@
+# -*- coding: utf-8 -*-
+""" Benchmarks invert_batch against per-pixel scipy.optimize.minimize.
+
+Usage::
+
+    python benchmarks/benchmark_inversion.py [pixels]
+"""
+from __future__ import (
+    absolute_import,
+    division,
+    print_function,
+    unicode_literals)
+
+import sys
+import time
+
+import numpy as np
+from scipy.optimize import minimize
+
+import sambuca_core as sbc
+from sambuca_core.tests.forward_model_inputs import (
+    load_forward_model_test_data,
+    random_free_parameters)
+
+LOWER = np.array([0.01, 0.0005, 0.2, 0.1, 0.0, 0.0, 0.0])
+UPPER = np.array([2.0, 0.5, 5.0, 15.0, 1.0, 1.0, 0.0])
+INITIAL = np.array([0.5, 0.1, 1.0, 3.0, 0.33, 0.33, 0.0])
+
+
+def _scipy_inversion(context, observed):
+    """ The per-pixel, derivative-free approach used downstream. """
+    def objective(x, target):
+        rrs = context.evaluate(*x, compute_jacobian=False).rrs
+        return 0.5 * np.sum((rrs - target) ** 2)
+
+    costs = []
+    for target in observed:
+        result = minimize(
+            objective,
+            INITIAL,
+            args=(target,),
+            method='L-BFGS-B',
+            bounds=list(zip(LOWER, UPPER)))
+        costs.append(result.fun)
+    return np.array(costs)
+
+
+def main(pixels=200):
+    _, fixed, _ = load_forward_model_test_data()
+    context = sbc.ForwardModelContext(**fixed)
+    batch = random_free_parameters(pixels)
+    batch['depth'] = np.random.RandomState(1).uniform(0.5, 5.0, pixels)
+    batch['sub3_frac'][:] = 0.0
+    truth = np.stack([batch[name] for name in sbc.FREE_PARAMETERS], axis=-1)
+    observed = context.evaluate_batch(*truth.T, compute_jacobian=False).rrs
+
+    for project_fractions in (False, True):
+        start = time.time()
+        results = sbc.invert_batch(
+            context, observed, INITIAL, LOWER, UPPER,
+            project_fractions=project_fractions)
+        elapsed = time.time() - start
+        print('invert_batch(project_fractions={0}): {1} pixels in {2:.2f} s '
+              '({3:.0f} pixels/s), {4:.1f} evaluations/pixel, median cost '
+              '{5:.3g}, {6:.0f}% converged'.format(
+                  project_fractions,
+                  pixels,
+                  elapsed,
+                  pixels / elapsed,
+                  results.evaluations.mean(),
+                  np.median(results.cost),
+                  100.0 * results.converged.mean()))
+
+    # scipy is much slower, so time a subset
+    subset = min(pixels, 50)
+    start = time.time()
+    costs = _scipy_inversion(context, observed[:subset])
+    elapsed = time.time() - start
+    print('scipy.optimize.minimize (L-BFGS-B): {0} pixels in {1:.2f} s '
+          '({2:.0f} pixels/s), median cost {3:.3g}'.format(
+              subset, elapsed, subset / elapsed, np.median(costs)))
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
@@ -0,0 +1,109 @@
+# -*- coding: utf-8 -*-
+""" Benchmarks linearised re-evaluation from the Jacobian: the cost and
+accuracy of evaluate_linearised for small steps, and the evaluations that
+invert_batch saves with linear_tolerance.
+
+Usage::
+
+    python benchmarks/benchmark_linearised.py [pixels]
+"""
+from __future__ import (
+    absolute_import,
+    division,
+    print_function,
+    unicode_literals)
+
+import sys
+import time
+
+import numpy as np
+
+import sambuca_core as sbc
+from sambuca_core.tests.forward_model_inputs import (
+    load_forward_model_test_data,
+    random_free_parameters)
+
+REPEATS = 5
+STEP_SCALES = (1e-4, 1e-3, 1e-2)
+TOLERANCES = (None, 1e-8, 1e-7, 1e-6, 1e-5)
+NOISE = 1e-4
+
+LOWER = np.array([0.01, 0.0005, 0.2, 0.1, 0.0, 0.0, 0.0])
+UPPER = np.array([2.0, 0.5, 5.0, 15.0, 1.0, 1.0, 0.0])
+INITIAL = np.array([0.5, 0.1, 1.0, 3.0, 0.33, 0.33, 0.0])
+
+
+def _best_time(function):
+    best = np.inf
+    for _ in range(REPEATS):
+        start = time.time()
+        function()
+        best = min(best, time.time() - start)
+    return best
+
+
+def _evaluator(context, parameters):
+    results = context.evaluate_batch(*parameters.T)
+    rng = np.random.RandomState(0)
+    direction = rng.normal(size=parameters.shape) * \
+        np.maximum(np.abs(parameters), 0.05)
+    full = _best_time(lambda: context.evaluate_batch(
+        *parameters.T, compute_jacobian=False))
+    print('evaluate_batch without the Jacobian: {0:.4f} s'.format(full))
+    for scale in STEP_SCALES:
+        delta = scale * direction
+        exact = context.evaluate_batch(
+            *(parameters + delta).T, compute_jacobian=False).rrs
+        predicted = context.evaluate_linearised(
+            results, parameters, delta, np.inf)
+        error = np.abs(predicted.rrs - exact)
+        elapsed = _best_time(lambda: context.evaluate_linearised(
+            results, parameters, delta, np.inf))
+        print('  relative step {0:g}: {1:.4f} s ({2:.1f}x), max error '
+              '{3:.2g}, estimate {4:.2g}, error within estimate in {5:.1f}% '
+              'of bands'.format(
+                  scale, elapsed, full / elapsed, error.max(),
+                  predicted.error.max(),
+                  100.0 * np.mean(error <= predicted.error)))
+
+
+def _inversion(context, truth, observed, label):
+    print('invert_batch, {0} observations:'.format(label))
+    for tolerance in TOLERANCES:
+        start = time.time()
+        results = sbc.invert_batch(
+            context, observed, INITIAL, LOWER, UPPER,
+            linear_tolerance=tolerance)
+        elapsed = time.time() - start
+        rrs = context.evaluate_batch(
+            *results.parameters.T, compute_jacobian=False).rrs
+        cost = 0.5 * np.sum((rrs - observed) ** 2, axis=1)
+        print('  linear_tolerance={0}: {1:.2f} s, {2:.2f} evaluations/pixel '
+              '({3:.2f} iterations), median cost {4:.3g}, max |reported - '
+              'true cost| {5:.2g}, median parameter error {6:.2g}, {7:.0f}% '
+              'converged'.format(
+                  tolerance, elapsed, results.evaluations.mean(),
+                  results.iterations.mean(), np.median(cost),
+                  np.abs(results.cost - cost).max(),
+                  np.median(np.abs(results.parameters - truth).max(axis=1)),
+                  100.0 * results.converged.mean()))
+
+
+def main(pixels=1000):
+    _, fixed, _ = load_forward_model_test_data()
+    context = sbc.ForwardModelContext(**fixed)
+    batch = random_free_parameters(pixels)
+    batch['depth'] = np.random.RandomState(1).uniform(0.5, 5.0, pixels)
+    batch['sub3_frac'][:] = 0.0
+    truth = np.stack([batch[name] for name in sbc.FREE_PARAMETERS], axis=-1)
+    observed = context.evaluate_batch(*truth.T, compute_jacobian=False).rrs
+
+    _evaluator(context, truth)
+    _inversion(context, truth, observed, 'exact')
+    noisy = observed + np.random.RandomState(2).normal(
+        scale=NOISE, size=observed.shape)
+    _inversion(context, truth, noisy, 'noisy')
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
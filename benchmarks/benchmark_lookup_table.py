@@ -0,0 +1,72 @@
+# -*- coding: utf-8 -*-
+""" Benchmarks rrs lookup table build time and query throughput.
+
+Usage::
+
+    python benchmarks/benchmark_lookup_table.py
+"""
+from __future__ import (
+    absolute_import,
+    division,
+    print_function,
+    unicode_literals)
+
+import os
+import shutil
+import tempfile
+import time
+
+import numpy as np
+
+import sambuca_core as sbc
+from sambuca_core.tests.forward_model_inputs import (
+    load_forward_model_test_data)
+
+
+def main():
+    _, fixed, _ = load_forward_model_test_data()
+    context = sbc.ForwardModelContext(dtype=np.float32, **fixed)
+    axes = dict(
+        chl=np.linspace(0.01, 1.0, 8),
+        cdom=np.linspace(0.001, 0.5, 6),
+        nap=np.linspace(0.2, 5.0, 8),
+        depth=np.linspace(0.5, 15.0, 10),
+        sub1_frac=np.linspace(0.0, 1.0, 3),
+        sub2_frac=np.linspace(0.0, 1.0, 3),
+        sub3_frac=[0.0])
+
+    directory = tempfile.mkdtemp()
+    try:
+        start = time.time()
+        lut = sbc.build_rrs_lookup_table(
+            context, os.path.join(directory, 'lut'), **axes)
+        elapsed = time.time() - start
+        points = int(np.prod(lut.grid_shape))
+        print('build: {0} grid points in {1:.2f} s ({2:.0f} points/s)'.format(
+            points, elapsed, points / elapsed))
+
+        rng = np.random.RandomState(0)
+        lower = np.array([axis[0] for axis in lut.axes])
+        upper = np.array([axis[-1] for axis in lut.axes])
+        queries = lower + rng.uniform(size=(50000, 7)) * (upper - lower)
+
+        for name, method in (('nearest', lut.nearest),
+                             ('interpolate', lut.interpolate)):
+            start = time.time()
+            method(queries)
+            elapsed = time.time() - start
+            print('{0}: {1} queries in {2:.2f} s ({3:.0f} pixels/s)'.format(
+                name, len(queries), elapsed, len(queries) / elapsed))
+
+        start = time.time()
+        context.evaluate_batch(*queries.T, compute_jacobian=False)
+        elapsed = time.time() - start
+        print('forward_model_batch: {0} pixels in {1:.2f} s '
+              '({2:.0f} pixels/s)'.format(
+                  len(queries), elapsed, len(queries) / elapsed))
+    finally:
+        shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,88 @@
+# -*- coding: utf-8 -*-
+""" Compares filtering spectral batches to several sensors one sensor at a
+time with filtering them in one pass with a MultiSensorFilter.
+
+Usage::
+
+    python benchmarks/benchmark_multi_sensor_filter.py [pixels ...]
+"""
+from __future__ import (
+    absolute_import,
+    division,
+    print_function,
+    unicode_literals)
+
+import sys
+import time
+
+import numpy as np
+from pkg_resources import resource_filename
+
+import sambuca_core as sbc
+
+REPEATS = 5
+# (number of bands, full width at half maximum in nm) of synthetic filters
+SYNTHETIC = ((100, 10.0), (20, 30.0))
+
+
+def _best_time(function):
+    best = np.inf
+    for _ in range(REPEATS):
+        start = time.time()
+        function()
+        best = min(best, time.time() - start)
+    return best
+
+
+def _synthetic_filter(num_bands, fwhm):
+    """ Gaussian bands over 350-900 nm, truncated at 3 sigma. """
+    wavelengths = np.arange(350, 901, dtype=np.float64)
+    centres = np.linspace(400, 850, num_bands)
+    sigma = fwhm / 2.3548
+    distance = (wavelengths - centres[:, np.newaxis]) / sigma
+    response = np.where(
+        np.abs(distance) <= 3.0, np.exp(-0.5 * distance ** 2), 0.0)
+    return sbc.SensorFilter(wavelengths, response)
+
+
+def main(*pixel_counts):
+    pixel_counts = pixel_counts or (8192, 65536)
+    directory = resource_filename(sbc.__name__, 'tests/data/sensor_filters')
+    sensor_filters = [
+        ('CASI04', sbc.load_sensor_filter_spectral_library(
+            directory, 'CASI04_350_900_1nm')),
+        ('QuickBird', sbc.load_sensor_filter_spectral_library(
+            directory, 'qbtest_filter_350_900nm'))]
+    sensor_filters.extend(
+        ('{0} x {1:g} nm'.format(num_bands, fwhm),
+         _synthetic_filter(num_bands, fwhm))
+        for num_bands, fwhm in SYNTHETIC)
+    multi = sbc.MultiSensorFilter(sensor_filters)
+    print('{0} sensors, {1} output bands, {2} blocks'.format(
+        len(multi), multi.num_bands, len(multi.stacked.blocks())))
+
+    rng = np.random.RandomState(0)
+    for pixels in pixel_counts:
+        spectra = rng.uniform(size=(pixels, multi.num_input_bands))
+        filtered = multi.apply(spectra)
+        error = max(
+            np.abs(filtered[name] - sensor_filter.apply(spectra)).max()
+            for name, sensor_filter in sensor_filters)
+        transposed = np.ascontiguousarray(spectra.T)
+        times = [
+            _best_time(lambda: [
+                sbc.apply_sensor_filter(transposed, sensor_filter.response)
+                for _, sensor_filter in sensor_filters]),
+            _best_time(lambda: [
+                sensor_filter.apply(spectra)
+                for _, sensor_filter in sensor_filters]),
+            _best_time(lambda: multi.apply(spectra))]
+        print('  {0} pixels: apply_sensor_filter per sensor {1:.4f} s, '
+              'SensorFilter.apply per sensor {2:.4f} s, MultiSensorFilter '
+              '{3:.4f} s ({4:.2f}x, {5:.2f}x), max difference {6:.2g}'.format(
+                  pixels, times[0], times[1], times[2],
+                  times[0] / times[2], times[1] / times[2], error))
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
@@ -0,0 +1,67 @@
+# -*- coding: utf-8 -*-
+""" Compares evaluate_batch with and without optically-deep detection, on
+batches with increasing proportions of deep water.
+
+Usage::
+
+    python benchmarks/benchmark_optically_deep.py [batch size] [tolerance]
+"""
+from __future__ import (
+    absolute_import,
+    division,
+    print_function,
+    unicode_literals)
+
+import sys
+import time
+
+import numpy as np
+
+import sambuca_core as sbc
+from sambuca_core.tests.forward_model_inputs import (
+    load_forward_model_test_data,
+    random_free_parameters)
+
+REPEATS = 5
+DEPTH_RANGES = ((0.5, 15.0), (0.5, 60.0), (20.0, 150.0), (100.0, 200.0))
+
+
+def _best_time(function):
+    best = np.inf
+    for _ in range(REPEATS):
+        start = time.time()
+        function()
+        best = min(best, time.time() - start)
+    return best
+
+
+def main(batch_size=2048, tolerance=1e-6):
+    _, fixed, _ = load_forward_model_test_data()
+    context = sbc.ForwardModelContext(**fixed)
+    batch = random_free_parameters(batch_size)
+    rng = np.random.RandomState(0)
+
+    for low, high in DEPTH_RANGES:
+        batch['depth'] = rng.uniform(low, high, batch_size)
+        deep = np.all(
+            context.optically_deep(tolerance=tolerance, **batch), axis=1)
+        exact = context.evaluate_batch(compute_jacobian=False, **batch).rrs
+        fast = context.evaluate_batch(
+            compute_jacobian=False, deep_tolerance=tolerance, **batch).rrs
+        print('depth {0:g}-{1:g} m: {2:.0f}% deep pixels, max rrs error '
+              '{3:.2g}'.format(
+                  low, high, 100.0 * deep.mean(), np.abs(fast - exact).max()))
+        for compute_jacobian in (False, True):
+            times = [
+                _best_time(lambda: context.evaluate_batch(
+                    compute_jacobian=compute_jacobian,
+                    deep_tolerance=deep_tolerance,
+                    **batch))
+                for deep_tolerance in (None, tolerance)]
+            print('  jacobian={0}: {1:.3f} s -> {2:.3f} s ({3:.2f}x)'.format(
+                compute_jacobian, times[0], times[1], times[0] / times[1]))
+
+
+if __name__ == '__main__':
+    main(*[int(arg) if i == 0 else float(arg)
+           for i, arg in enumerate(sys.argv[1:])])
@@ -0,0 +1,50 @@
+# -*- coding: utf-8 -*-
+""" Benchmarks the scaling of run_scene from one worker to all processors.
+
+Usage::
+
+    python benchmarks/benchmark_scene.py [rows] [cols]
+"""
+from __future__ import (
+    absolute_import,
+    division,
+    print_function,
+    unicode_literals)
+
+import multiprocessing
+import sys
+import time
+
+import numpy as np
+
+import sambuca_core as sbc
+from sambuca_core.tests.forward_model_inputs import (
+    load_forward_model_test_data,
+    random_free_parameters)
+
+
+def main(rows=200, cols=200):
+    _, fixed, _ = load_forward_model_test_data()
+    context = sbc.ForwardModelContext(**fixed)
+    batch = random_free_parameters(rows * cols)
+    parameters = np.stack(
+        [batch[name] for name in sbc.FREE_PARAMETERS],
+        axis=-1).reshape(rows, cols, len(sbc.FREE_PARAMETERS))
+
+    baseline = None
+    for workers in range(1, multiprocessing.cpu_count() + 1):
+        start = time.time()
+        sbc.run_scene(context, parameters, max_workers=workers)
+        elapsed = time.time() - start
+        baseline = baseline or elapsed
+        print('{0} worker(s): {1} pixels in {2:.2f} s ({3:.0f} pixels/s, '
+              'speedup {4:.2f})'.format(
+                  workers,
+                  rows * cols,
+                  elapsed,
+                  rows * cols / elapsed,
+                  baseline / elapsed))
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
@@ -0,0 +1,72 @@
+# -*- coding: utf-8 -*-
+""" Reports the forward model evaluations saved by warm-started and pyramid
+scene inversion, on a synthetic scene with smoothly varying parameters.
+
+Usage::
+
+    python benchmarks/benchmark_scene_inversion.py [rows] [cols]
+"""
+from __future__ import (
+    absolute_import,
+    division,
+    print_function,
+    unicode_literals)
+
+import sys
+import time
+
+import numpy as np
+
+import sambuca_core as sbc
+from sambuca_core.tests.forward_model_inputs import (
+    load_forward_model_test_data)
+from sambuca_core.tests.test_scene_inversion import smooth_scene
+
+LOWER = np.array([0.01, 0.0005, 0.2, 0.1, 0.0, 0.0, 0.0])
+UPPER = np.array([2.0, 0.5, 5.0, 15.0, 1.0, 1.0, 0.0])
+INITIAL = np.array([0.5, 0.1, 1.0, 3.0, 0.33, 0.33, 0.0])
+
+
+def main(rows=40, cols=40):
+    _, fixed, _ = load_forward_model_test_data()
+    context = sbc.ForwardModelContext(**fixed)
+    _, observed = smooth_scene(context, rows, cols)
+    observed = observed + np.random.RandomState(0).normal(
+        0.0, 1e-4, observed.shape)
+
+    baseline = None
+    for warm_start in (False, True):
+        start = time.time()
+        results = sbc.invert_scene(
+            context, observed, INITIAL, LOWER, UPPER, warm_start=warm_start)
+        elapsed = time.time() - start
+        per_pixel = results.evaluations.mean()
+        baseline = baseline or per_pixel
+        print('warm_start={0}: {1:.2f} s, {2:.2f} evaluations/pixel '
+              '({3:.0f}% fewer), {4:.1f}% fallbacks, median cost '
+              '{5:.3g}'.format(
+                  warm_start,
+                  elapsed,
+                  per_pixel,
+                  100.0 * (1.0 - per_pixel / baseline),
+                  100.0 * results.fallback.mean(),
+                  np.median(results.cost)))
+
+    start = time.time()
+    results = sbc.invert_pyramid(context, observed, INITIAL, LOWER, UPPER)
+    elapsed = time.time() - start
+    per_pixel = results.evaluations.mean()
+    total = sum(results.level_evaluations) / float(rows * cols)
+    print('pyramid: {0:.2f} s, {1:.2f} evaluations/pixel at full resolution '
+          '({2:.0f}% fewer), {3:.2f} including coarser levels ({4:.0f}% '
+          'fewer), median cost {5:.3g}'.format(
+              elapsed,
+              per_pixel,
+              100.0 * (1.0 - per_pixel / baseline),
+              total,
+              100.0 * (1.0 - total / baseline),
+              np.median(results.cost)))
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
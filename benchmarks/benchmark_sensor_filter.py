@@ -0,0 +1,84 @@
+# -*- coding: utf-8 -*-
+""" Compares filtering spectral batches with the dense operator product and
+with the banded SensorFilter.apply, for the test sensor filters and for
+synthetic narrow-band filters.
+
+Usage::
+
+    python benchmarks/benchmark_sensor_filter.py [pixels ...]
+"""
+from __future__ import (
+    absolute_import,
+    division,
+    print_function,
+    unicode_literals)
+
+import sys
+import time
+
+import numpy as np
+from pkg_resources import resource_filename
+
+import sambuca_core as sbc
+
+REPEATS = 5
+# (number of bands, full width at half maximum in nm) of synthetic filters
+SYNTHETIC = ((100, 10.0), (20, 30.0))
+
+
+def _best_time(function):
+    best = np.inf
+    for _ in range(REPEATS):
+        start = time.time()
+        function()
+        best = min(best, time.time() - start)
+    return best
+
+
+def _synthetic_filter(num_bands, fwhm):
+    """ Gaussian bands over 350-900 nm, truncated at 3 sigma. """
+    wavelengths = np.arange(350, 901, dtype=np.float64)
+    centres = np.linspace(400, 850, num_bands)
+    sigma = fwhm / 2.3548
+    distance = (wavelengths - centres[:, np.newaxis]) / sigma
+    response = np.where(
+        np.abs(distance) <= 3.0, np.exp(-0.5 * distance ** 2), 0.0)
+    return sbc.SensorFilter(wavelengths, response)
+
+
+def _filters():
+    directory = resource_filename(sbc.__name__, 'tests/data/sensor_filters')
+    yield 'CASI04', sbc.load_sensor_filter_spectral_library(
+        directory, 'CASI04_350_900_1nm')
+    yield 'QuickBird', sbc.load_sensor_filter_spectral_library(
+        directory, 'qbtest_filter_350_900nm')
+    for num_bands, fwhm in SYNTHETIC:
+        yield '{0} x {1:g} nm'.format(num_bands, fwhm), \
+            _synthetic_filter(num_bands, fwhm)
+
+
+def main(*pixel_counts):
+    pixel_counts = pixel_counts or (8192, 65536)
+    rng = np.random.RandomState(0)
+    for name, sensor_filter in _filters():
+        operator = sensor_filter.operator
+        blocks = sensor_filter.blocks()
+        print('{0}: {1} x {2} bands, {3:.1f}% non-zero, {4} blocks storing '
+              '{5:.1f}% of the operator'.format(
+                  name, sensor_filter.num_bands, sensor_filter.num_input_bands,
+                  100.0 * np.mean(operator != 0), len(blocks),
+                  100.0 * sum(block.size for _, _, block in blocks) /
+                  operator.size))
+        for pixels in pixel_counts:
+            spectra = rng.uniform(size=(pixels, sensor_filter.num_input_bands))
+            error = np.abs(
+                sensor_filter.apply(spectra) - np.dot(spectra, operator)).max()
+            dense = _best_time(lambda: np.dot(spectra, operator))
+            banded = _best_time(lambda: sensor_filter.apply(spectra))
+            print('  {0} pixels: np.dot {1:.4f} s, apply {2:.4f} s '
+                  '({3:.2f}x), max difference {4:.2g}'.format(
+                      pixels, dense, banded, dense / banded, error))
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
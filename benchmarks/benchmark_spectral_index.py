@@ -0,0 +1,87 @@
+# -*- coding: utf-8 -*-
+""" Benchmarks spectral index build, persistence and query, and the
+inversion evaluations saved by starting from the nearest simulated spectrum.
+
+Usage::
+
+    python benchmarks/benchmark_spectral_index.py [sample size] [pixels]
+"""
+from __future__ import (
+    absolute_import,
+    division,
+    print_function,
+    unicode_literals)
+
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+import sambuca_core as sbc
+from sambuca_core.tests.forward_model_inputs import (
+    load_forward_model_test_data)
+
+LOWER = np.array([0.01, 0.0005, 0.2, 0.1, 0.0, 0.0, 0.0])
+UPPER = np.array([2.0, 0.5, 5.0, 15.0, 1.0, 1.0, 0.0])
+INITIAL = np.array([0.5, 0.1, 1.0, 3.0, 0.33, 0.33, 0.0])
+
+
+def _sample(count, seed):
+    rng = np.random.RandomState(seed)
+    sample = LOWER + rng.uniform(size=(count, 7)) * \
+        (np.minimum(UPPER, [1.0, 0.5, 5.0, 8.0, 1.0, 1.0, 0.0]) - LOWER)
+    return sample
+
+
+def _timed(function, *args, **kwargs):
+    start = time.time()
+    result = function(*args, **kwargs)
+    return result, time.time() - start
+
+
+def main(sample_size=50000, pixels=500):
+    _, fixed, _ = load_forward_model_test_data()
+    context = sbc.ForwardModelContext(**fixed)
+    sample = _sample(sample_size, 0)
+    truth = _sample(pixels, 1)
+    observed = context.evaluate_batch(*truth.T, compute_jacobian=False).rrs
+
+    directory = tempfile.mkdtemp()
+    try:
+        for num_components in (None, 10):
+            index, elapsed = _timed(
+                sbc.build_spectral_index, context, sample,
+                num_components=num_components)
+            print('build (components={0}): {1} spectra in {2:.2f} s'.format(
+                num_components, sample_size, elapsed))
+
+            filename = os.path.join(directory, 'index.npz')
+            _, elapsed = _timed(index.save, filename)
+            print('  save: {0:.2f} s, {1:.1f} MB'.format(
+                elapsed, os.path.getsize(filename) / 1e6))
+            index, elapsed = _timed(sbc.SpectralIndex.load, filename)
+            print('  load: {0:.2f} s'.format(elapsed))
+
+            results, elapsed = _timed(index.query, observed, k=1)
+            print('  query: {0} pixels in {1:.3f} s ({2:.0f} pixels/s)'.format(
+                pixels, elapsed, pixels / elapsed))
+
+            for name, start in (('global start', INITIAL),
+                                ('index start', results.parameters[:, 0])):
+                inversion, elapsed = _timed(
+                    sbc.invert_batch, context, observed, start, LOWER, UPPER)
+                print('  invert_batch from {0}: {1:.2f} s, {2:.2f} '
+                      'evaluations/pixel, median cost {3:.3g}'.format(
+                          name,
+                          elapsed,
+                          inversion.evaluations.mean(),
+                          np.median(inversion.cost)))
+    finally:
+        shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
@@ -0,0 +1,118 @@
+# -*- coding: utf-8 -*-
+""" Compares a substrate combination search with inverting every combination
+of a spectral library.
+
+The library is the two forward model test substrates, the three substrates
+of substrates/HI_3.lib and the three synthetic spectra of the tests, giving
+56 triplets. Every pixel mixes a random triplet, with a little noise.
+
+Usage::
+
+    python benchmarks/benchmark_substrate_search.py [pixels]
+"""
+from __future__ import (
+    absolute_import,
+    division,
+    print_function,
+    unicode_literals)
+
+import itertools
+import sys
+import time
+
+import numpy as np
+from pkg_resources import resource_filename
+
+import sambuca_core as sbc
+from sambuca_core import substrate_search
+from sambuca_core.tests.forward_model_inputs import (
+    load_forward_model_test_data)
+from sambuca_core.tests.test_substrate_search import substrate_library
+
+LOWER = np.array([0.01, 0.0005, 0.2, 0.1, 0.0, 0.0, 0.0])
+UPPER = np.array([2.0, 0.5, 5.0, 15.0, 1.0, 1.0, 1.0])
+INITIAL = np.array([0.5, 0.1, 1.0, 3.0, 0.33, 0.33, 0.33])
+
+
+def load_library(fixed):
+    """ The test substrates, HI_3 and the synthetic test spectra. """
+    hi_3 = sbc.load_spectral_library(resource_filename(
+        sbc.__name__, './tests/data/substrates/HI_3.lib'))
+    wavelengths = fixed['wavelengths']
+    resampled = [np.interp(wavelengths, *spectrum)
+                 for _, spectrum in sorted(hi_3.items())]
+    synthetic = substrate_library(fixed)
+    return np.vstack([synthetic[:2], resampled, synthetic[2:]])
+
+
+def _count_restarts():
+    """ Wraps the invert_batch of search_substrates, to count the starting
+    point evaluations of its rounds, one per pixel of each call. """
+    counter = {'evaluations': 0}
+    invert_batch = substrate_search.invert_batch
+
+    def counted(context, observed_rrs, *args, **kwargs):
+        counter['evaluations'] += len(observed_rrs)
+        return invert_batch(context, observed_rrs, *args, **kwargs)
+    substrate_search.invert_batch = counted
+    return counter
+
+
+def main(pixels=64):
+    _, fixed, _ = load_forward_model_test_data()
+    context = sbc.ForwardModelContext(**fixed)
+    library = load_library(fixed)
+    triplets = list(itertools.combinations(range(len(library)), 3))
+
+    rng = np.random.RandomState(0)
+    truth_combination = rng.randint(len(triplets), size=pixels)
+    truth = np.column_stack([
+        rng.uniform(0.05, 1.0, pixels),
+        rng.uniform(0.005, 0.1, pixels),
+        rng.uniform(0.2, 2.0, pixels),
+        rng.uniform(0.5, 4.0, pixels),
+        rng.dirichlet([2.0, 2.0, 2.0], size=pixels)])
+    observed = np.array([
+        context.with_substrates(*library[list(triplets[index])]).evaluate(
+            *parameters, compute_jacobian=False).rrs
+        for index, parameters in zip(truth_combination, truth)])
+    observed += rng.normal(0.0, 1e-5, observed.shape)
+
+    # Baseline: invert the batch once for every combination
+    start = time.time()
+    costs = np.empty((pixels, len(triplets)))
+    evaluations = 0
+    for index, triplet in enumerate(triplets):
+        results = sbc.invert_batch(
+            context.with_substrates(*library[list(triplet)]), observed,
+            INITIAL, LOWER, UPPER, project_fractions=True)
+        costs[:, index] = results.cost
+        evaluations += results.evaluations.sum()
+    elapsed = time.time() - start
+    exhaustive = np.argmin(costs, axis=1)
+    print('every combination: {0:.2f} s, {1:.1f} evaluations/pixel, '
+          '{2:.0f}% true combination'.format(
+              elapsed,
+              evaluations / float(pixels),
+              100.0 * np.mean(exhaustive == truth_combination)))
+
+    restarts = _count_restarts()
+    for candidates in (None, 16, 8):
+        restarts['evaluations'] = 0
+        start = time.time()
+        results = sbc.search_substrates(
+            context, library, observed, INITIAL, LOWER, UPPER,
+            candidates=candidates, project_fractions=True)
+        elapsed = time.time() - start
+        print('search candidates={0}: {1:.2f} s, {2:.1f} evaluations/pixel '
+              '({3:.1f} re-evaluating round starting points), {4:.0f}% true '
+              'combination, {5:.0f}% match every combination'.format(
+                  candidates,
+                  elapsed,
+                  results.evaluations.mean(),
+                  restarts['evaluations'] / float(pixels),
+                  100.0 * np.mean(results.combination == truth_combination),
+                  100.0 * np.mean(results.combination == exhaustive)))
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
@@ -0,0 +1,85 @@
+# -*- coding: utf-8 -*-
+""" Compares loss gradients from the full Jacobian with the
+vector-Jacobian product of evaluate_vjp.
+
+Usage::
+
+    python benchmarks/benchmark_vjp.py [batch size] [error function]
+"""
+from __future__ import (
+    absolute_import,
+    division,
+    print_function,
+    unicode_literals)
+
+import sys
+import time
+import tracemalloc
+
+import numpy as np
+
+import sambuca_core as sbc
+from sambuca_core.tests.forward_model_inputs import (
+    load_forward_model_test_data,
+    random_free_parameters)
+
+REPEATS = 5
+
+
+def _measure(function):
+    """ Returns the best time, and the peak memory allocated by numpy. """
+    best = np.inf
+    for _ in range(REPEATS):
+        start = time.time()
+        function()
+        best = min(best, time.time() - start)
+    tracemalloc.start()
+    function()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return best, peak
+
+
+def main(batch_size=4096, name='alpha_f'):
+    _, fixed, _ = load_forward_model_test_data()
+    context = sbc.ForwardModelContext(**fixed)
+    batch = random_free_parameters(batch_size)
+    parameters = np.stack(
+        [batch[key] for key in sbc.FREE_PARAMETERS], axis=-1)
+    observed = context.evaluate_batch(
+        *(parameters * 1.1).T, compute_jacobian=False).rrs
+    nedr = np.full(context.num_bands, 0.0005)
+    function = sbc.ERROR_FUNCTIONS[name]
+
+    def jacobian():
+        results = context.evaluate_batch(*parameters.T)
+        return function(observed, results.rrs, nedr,
+                        jacobian=sbc.stack_jacobian(results)).gradient
+
+    def product():
+        return context.evaluate_vjp(
+            *parameters.T,
+            cotangent=lambda rrs: sbc.distance_rrs_gradient(
+                name, observed, rrs, nedr).gradient).gradient
+
+    def rrs_only():
+        results = context.evaluate_batch(
+            *parameters.T, compute_jacobian=False)
+        return function(observed, results.rrs, nedr).value
+
+    difference = np.abs(jacobian() - product()).max() / \
+        np.abs(jacobian()).max()
+    print('{0} pixels, {1} bands, distance_{2}: max relative gradient '
+          'difference {3:.2g}'.format(
+              batch_size, context.num_bands, name, difference))
+    for label, candidate in (('Jacobian + chain rule', jacobian),
+                             ('evaluate_vjp', product),
+                             ('value only (no gradient)', rrs_only)):
+        elapsed, peak = _measure(candidate)
+        print('  {0}: {1:.3f} s, peak {2:.0f} MB'.format(
+            label, elapsed, peak / 1e6))
+
+
+if __name__ == '__main__':
+    main(*[int(arg) if i == 0 else arg
+           for i, arg in enumerate(sys.argv[1:])])
@@ -0,0 +1,67 @@
+# -*- coding: utf-8 -*-
+""" Compares a bathymetry sweep evaluated with cached water column terms to
+the same sweep evaluated with evaluate_batch.
+
+Usage::
+
+    python benchmarks/benchmark_water_column.py [water columns] [depths]
+"""
+from __future__ import (
+    absolute_import,
+    division,
+    print_function,
+    unicode_literals)
+
+import sys
+import time
+
+import numpy as np
+
+import sambuca_core as sbc
+from sambuca_core.tests.forward_model_inputs import (
+    load_forward_model_test_data,
+    random_free_parameters)
+
+REPEATS = 5
+
+
+def _best_time(function):
+    best = np.inf
+    for _ in range(REPEATS):
+        start = time.time()
+        function()
+        best = min(best, time.time() - start)
+    return best
+
+
+def main(columns=64, depths=64):
+    _, fixed, _ = load_forward_model_test_data()
+    context = sbc.ForwardModelContext(**fixed)
+    batch = random_free_parameters(columns)
+    depth = np.linspace(0.5, 15.0, depths)
+
+    def batched():
+        rrs = np.empty((depths, columns, context.num_bands))
+        for i, value in enumerate(depth):
+            rrs[i] = context.evaluate_batch(
+                batch['chl'], batch['cdom'], batch['nap'], value, 0.5, 0.5,
+                0.0, compute_jacobian=False).rrs
+        return rrs
+
+    def cached():
+        terms = context.water_column(batch['chl'], batch['cdom'], batch['nap'])
+        return context.evaluate_water_column(
+            terms, depth[:, np.newaxis], 0.5, 0.5, 0.0).rrs
+
+    assert np.array_equal(batched(), cached())
+    points = columns * depths
+    for name, function in (('evaluate_batch', batched),
+                           ('water_column', cached)):
+        elapsed = _best_time(function)
+        print('{0}: {1} columns x {2} depths in {3:.3f} s '
+              '({4:.0f} spectra/s)'.format(
+                  name, columns, depths, elapsed, points / elapsed))
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
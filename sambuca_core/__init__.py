@@ -1,17 +1,72 @@
 # -*- coding: utf-8 -*-
 """ Core components of the Sambuca modeling system """
 
+from .error import (
+    distance_alpha,
+    distance_alpha_f,
+    distance_f,
+    distance_lsq,
+    distance_rrs_gradient,
+    ERROR_FUNCTIONS,
+    ErrorResults,
+    stack_jacobian,
+)
 from .exceptions import (
     SambucaException,
     UnsupportedDataFormatError,
     DataValidationError
 )
-from .forward_model import forward_model, ForwardModelResults
+from .forward_model import (
+    FREE_PARAMETERS,
+    JACOBIAN_FIELDS,
+    forward_model,
+    forward_model_batch,
+    ForwardModelContext,
+    ForwardModelResults,
+    LinearisedResults,
+    VJPResults,
+    WaterColumnResults,
+    WaterColumnTerms,
+)
+from .forward_model_workspace import ForwardModelWorkspace
+from .inversion import (
+    DEFAULT_LOWER_BOUNDS,
+    DEFAULT_UPPER_BOUNDS,
+    invert_batch,
+    InversionResults,
+    solve_fractions,
+)
+from .lookup_table import (
+    build_rrs_lookup_table,
+    RrsLookupTable,
+    LUT_PARAMETERS,
+)
+from .scene import run_scene, SceneResults
+from .scene_inversion import (
+    block_average,
+    invert_pyramid,
+    invert_scene,
+    PyramidInversionResults,
+    SceneInversionResults,
+)
 from .sensor_filter import (
     apply_sensor_filter,
+    filter_cube,
     load_sensor_filters,
     load_sensor_filters_excel,
     load_sensor_filter_spectral_library,
+    MultiSensorFilter,
+    sensor_filter_operator,
+    SensorFilter,
+)
+from .sensor_forward_model import (
+    sensor_forward_model_batch,
+    SensorModelResults,
+)
+from .spectral_index import (
+    build_spectral_index,
+    IndexQueryResults,
+    SpectralIndex,
 )
 from .spectra_operations import (
     spectra_find_common_wavelengths,
@@ -24,6 +79,11 @@ from .spectra_readers import (
     load_envi_spectral_library,
     load_excel_spectral_library,
 )
+from .stacked_results import StackedForwardModelResults
+from .substrate_search import (
+    search_substrates,
+    SubstrateSearchResults,
+)
 from .utility import (
     strictly_decreasing,
     strictly_increasing,
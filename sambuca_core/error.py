@@ -0,0 +1,298 @@
+# -*- coding: utf-8 -*-
+""" Batched objective functions comparing observed and modelled rrs.
+
+Each function accepts observed and modelled spectra of shape (N, bands), or a
+single pair of (bands,) spectra, and returns one value per pixel. When the
+Jacobian of the modelled rrs is supplied, the gradient of the value with
+respect to the free parameters is also returned, by the chain rule.
+
+The definitions follow the SAMBUCA error functions:
+
+* lsq: the Euclidean distance between the spectra.
+* alpha: the spectral angle between the spectra, in radians.
+* f: the Euclidean distance divided by the sum of the observed spectrum.
+* alpha_f: the product of the f and alpha distances.
+
+Where a noise equivalent difference in reflectance (NEDR) spectrum is
+supplied, the alpha and f distances are calculated on spectra divided by the
+NEDR. The lsq distance is always unweighted.
+"""
+
+from __future__ import (
+    absolute_import,
+    division,
+    print_function,
+    unicode_literals)
+from builtins import *
+from collections import namedtuple
+
+import numpy as np
+
+from .forward_model import JACOBIAN_FIELDS
+
+ErrorResults = namedtuple('ErrorResults', ['value', 'gradient'])
+""" namedtuple containing the value and gradient of an error function.
+
+Attributes:
+    value (numpy.ndarray): The error of each pixel, shape (N,).
+    gradient (numpy.ndarray): The derivatives of the error with respect to
+        the free parameters, shape (N, parameters). None if no Jacobian was
+        supplied.
+"""
+
+
+def stack_jacobian(results):
+    """ Stacks the rrs_d* fields of forward model results.
+
+    Args:
+        results (ForwardModelResults): Results calculated with the Jacobian.
+
+    Returns:
+        numpy.ndarray: The Jacobian of rrs, with shape (7, bands) for scalar
+            results or (N, 7, bands) for batched results, and the parameter
+            axis ordered as FREE_PARAMETERS.
+    """
+    return np.stack(
+        [getattr(results, name) for name in JACOBIAN_FIELDS], axis=-2)
+
+
+def _prepare(observed_rrs, modelled_rrs, nedr, jacobian):
+    """ Converts the inputs to 2-D arrays, optionally dividing by the NEDR.
+
+    Returns:
+        tuple: (observed, modelled, jacobian, is_batch). jacobian is None
+            if not supplied.
+    """
+    observed = np.asarray(observed_rrs, dtype=np.float64)
+    is_batch = observed.ndim == 2
+    observed = np.atleast_2d(observed)
+    modelled = np.atleast_2d(np.asarray(modelled_rrs, dtype=np.float64))
+    if observed.shape != modelled.shape:
+        raise ValueError(
+            'Observed spectra shape {0} does not match the modelled spectra '
+            'shape {1}'.format(observed.shape, modelled.shape))
+
+    if jacobian is not None:
+        jacobian = np.asarray(jacobian, dtype=np.float64)
+        if not is_batch:
+            jacobian = jacobian[np.newaxis]
+        if jacobian.ndim != 3 or jacobian.shape[0] != observed.shape[0] or \
+           jacobian.shape[2] != observed.shape[1]:
+            raise ValueError(
+                'The Jacobian must have shape (N, parameters, bands)')
+
+    if nedr is not None:
+        scale = 1.0 / np.asarray(nedr, dtype=np.float64)
+        observed = observed * scale
+        modelled = modelled * scale
+        if jacobian is not None:
+            jacobian = jacobian * scale[..., np.newaxis, :]
+
+    return observed, modelled, jacobian, is_batch
+
+
+def _finish(value, gradient_wrt_rrs, jacobian, is_batch):
+    """ Chains the gradient through the Jacobian and restores the shape. """
+    gradient = None
+    if jacobian is not None:
+        gradient = np.matmul(
+            jacobian, gradient_wrt_rrs[..., np.newaxis])[..., 0]
+    if not is_batch:
+        value = value[0]
+        gradient = None if gradient is None else gradient[0]
+    return ErrorResults(value=value, gradient=gradient)
+
+
+def _lsq(observed, modelled):
+    """ Returns the distance, and its gradient with respect to modelled. """
+    difference = modelled - observed
+    distance = np.sqrt(np.einsum('nb,nb->n', difference, difference))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        gradient = np.where(
+            distance[:, np.newaxis] > 0,
+            difference / distance[:, np.newaxis],
+            0.0)
+    return distance, gradient
+
+
+def _alpha(observed, modelled):
+    """ Returns the spectral angle, and its gradient with respect to modelled.
+    """
+    observed_norm = np.sqrt(np.einsum('nb,nb->n', observed, observed))
+    modelled_norm = np.sqrt(np.einsum('nb,nb->n', modelled, modelled))
+    norms = observed_norm * modelled_norm
+
+    # The angle and gradient are zero where either spectrum is zero, whose
+    # cosine is NaN. d(cosine)/d(modelled) is scaled by -1/sin(angle), and
+    # the gradient is also zero where the spectra are parallel.
+    with np.errstate(divide='ignore', invalid='ignore'):
+        cosine = np.einsum('nb,nb->n', observed, modelled) / norms
+        angle = np.where(
+            cosine <= 1.0, np.arccos(np.minimum(cosine, 1.0)), 0.0)
+        sine = np.sqrt(1.0 - np.minimum(cosine, 1.0) ** 2)
+        d_cosine = observed / norms[:, np.newaxis] - \
+            (cosine / modelled_norm ** 2)[:, np.newaxis] * modelled
+        gradient = np.where(
+            sine[:, np.newaxis] > 0,
+            -d_cosine / sine[:, np.newaxis],
+            0.0)
+    return angle, gradient
+
+
+def _f(observed, modelled):
+    """ Returns the f distance, and its gradient with respect to modelled. """
+    distance, gradient = _lsq(observed, modelled)
+    observed_sum = observed.sum(axis=1)
+    return distance / observed_sum, gradient / observed_sum[:, np.newaxis]
+
+
+def _alpha_f(observed, modelled):
+    """ Returns the alpha_f distance, and its gradient with respect to
+    modelled. """
+    f_distance, f_gradient = _f(observed, modelled)
+    angle, angle_gradient = _alpha(observed, modelled)
+    gradient = f_distance[:, np.newaxis] * angle_gradient + \
+        angle[:, np.newaxis] * f_gradient
+    return f_distance * angle, gradient
+
+
+def distance_lsq(observed_rrs, modelled_rrs, nedr=None, jacobian=None):
+    """ The Euclidean distance between observed and modelled spectra.
+
+    Args:
+        observed_rrs (array-like): Observed rrs, shape (N, bands) or
+            (bands,).
+        modelled_rrs (array-like): Modelled rrs, of the same shape.
+        nedr (array-like, optional): Accepted for a uniform interface with
+            the other error functions, but not used, as the lsq distance is
+            unweighted.
+        jacobian (array-like, optional): The Jacobian of modelled_rrs, with
+            shape (N, parameters, bands) or (parameters, bands), such as
+            the result of stack_jacobian or SensorModelResults.jacobian.
+
+    Returns:
+        ErrorResults: The distance and, if the Jacobian was supplied, its
+            gradient.
+    """
+    # pylint: disable=unused-argument
+    observed, modelled, jacobian, is_batch = _prepare(
+        observed_rrs, modelled_rrs, None, jacobian)
+    distance, gradient = _lsq(observed, modelled)
+    return _finish(distance, gradient, jacobian, is_batch)
+
+
+def distance_alpha(observed_rrs, modelled_rrs, nedr=None, jacobian=None):
+    """ The spectral angle between observed and modelled spectra.
+
+    Args:
+        observed_rrs (array-like): Observed rrs, shape (N, bands) or
+            (bands,).
+        modelled_rrs (array-like): Modelled rrs, of the same shape.
+        nedr (array-like, optional): The NEDR, with shape (bands,) or
+            (N, bands).
+        jacobian (array-like, optional): The Jacobian of modelled_rrs, with
+            shape (N, parameters, bands) or (parameters, bands).
+
+    Returns:
+        ErrorResults: The angle in radians and, if the Jacobian was supplied,
+            its gradient.
+    """
+    observed, modelled, jacobian, is_batch = _prepare(
+        observed_rrs, modelled_rrs, nedr, jacobian)
+    angle, gradient = _alpha(observed, modelled)
+    return _finish(angle, gradient, jacobian, is_batch)
+
+
+def distance_f(observed_rrs, modelled_rrs, nedr=None, jacobian=None):
+    """ The Euclidean distance divided by the sum of the observed spectrum.
+
+    Args:
+        observed_rrs (array-like): Observed rrs, shape (N, bands) or
+            (bands,).
+        modelled_rrs (array-like): Modelled rrs, of the same shape.
+        nedr (array-like, optional): The NEDR, with shape (bands,) or
+            (N, bands).
+        jacobian (array-like, optional): The Jacobian of modelled_rrs, with
+            shape (N, parameters, bands) or (parameters, bands).
+
+    Returns:
+        ErrorResults: The distance and, if the Jacobian was supplied, its
+            gradient.
+    """
+    observed, modelled, jacobian, is_batch = _prepare(
+        observed_rrs, modelled_rrs, nedr, jacobian)
+    distance, gradient = _f(observed, modelled)
+    return _finish(distance, gradient, jacobian, is_batch)
+
+
+def distance_alpha_f(observed_rrs, modelled_rrs, nedr=None, jacobian=None):
+    """ The product of the f distance and the spectral angle.
+
+    Args:
+        observed_rrs (array-like): Observed rrs, shape (N, bands) or
+            (bands,).
+        modelled_rrs (array-like): Modelled rrs, of the same shape.
+        nedr (array-like, optional): The NEDR, with shape (bands,) or
+            (N, bands).
+        jacobian (array-like, optional): The Jacobian of modelled_rrs, with
+            shape (N, parameters, bands) or (parameters, bands).
+
+    Returns:
+        ErrorResults: The distance and, if the Jacobian was supplied, its
+            gradient.
+    """
+    observed, modelled, jacobian, is_batch = _prepare(
+        observed_rrs, modelled_rrs, nedr, jacobian)
+    distance, gradient = _alpha_f(observed, modelled)
+    return _finish(distance, gradient, jacobian, is_batch)
+
+
+ERROR_FUNCTIONS = {
+    'lsq': distance_lsq,
+    'alpha': distance_alpha,
+    'f': distance_f,
+    'alpha_f': distance_alpha_f,
+}
+""" The error functions, keyed by their SAMBUCA names. """
+
+_KERNELS = {
+    'lsq': _lsq,
+    'alpha': _alpha,
+    'f': _f,
+    'alpha_f': _alpha_f,
+}
+
+
+def distance_rrs_gradient(name, observed_rrs, modelled_rrs, nedr=None):
+    """ An error function, and its gradient with respect to the modelled
+    rrs.
+
+    The gradient is the cotangent of ForwardModelContext.evaluate_vjp, which
+    chains it to the free parameters without forming the Jacobian.
+
+    Args:
+        name (str): The name of the error function, a key of
+            ERROR_FUNCTIONS.
+        observed_rrs (array-like): Observed rrs, shape (N, bands) or
+            (bands,).
+        modelled_rrs (array-like): Modelled rrs, of the same shape.
+        nedr (array-like, optional): The NEDR, as for the error function.
+
+    Returns:
+        ErrorResults: The error, and its gradient with the shape of
+            modelled_rrs.
+    """
+    if name not in _KERNELS:
+        raise ValueError('Unknown error function {0}'.format(name))
+    if name == 'lsq':
+        nedr = None
+    observed, modelled, _, is_batch = _prepare(
+        observed_rrs, modelled_rrs, nedr, None)
+    value, gradient = _KERNELS[name](observed, modelled)
+    if nedr is not None:
+        # The distance was calculated on the spectra divided by the NEDR
+        gradient = gradient / np.asarray(nedr, dtype=np.float64)
+    if not is_batch:
+        value = value[0]
+        gradient = gradient[0]
+    return ErrorResults(value=value, gradient=gradient)
@@ -7,6 +7,7 @@ from __future__ import (
     print_function,
     unicode_literals)
 from builtins import *
+import copy
 import math
 from collections import namedtuple
 
@@ -14,6 +15,33 @@ import numpy as np
 
 from .constants import REFRACTIVE_INDEX_SEAWATER
 
+FREE_PARAMETERS = (
+    'chl',
+    'cdom',
+    'nap',
+    'depth',
+    'sub1_frac',
+    'sub2_frac',
+    'sub3_frac',
+)
+""" The names of the free (per-pixel) forward model parameters, in the order
+in which they are passed to the model. This is also the order of the
+parameter axis of stacked Jacobians.
+"""
+
+JACOBIAN_FIELDS = (
+    'rrs_dchl',
+    'rrs_dcdom',
+    'rrs_dnap',
+    'rrs_ddepth',
+    'rrs_dfrac1',
+    'rrs_dfrac2',
+    'rrs_dfrac3',
+)
+""" The ForwardModelResults fields holding the derivatives of rrs with
+respect to each of the FREE_PARAMETERS, in the same order.
+"""
+
 ForwardModelResults = namedtuple('ForwardModelResults',
                                  [
                                      'r_substratum',
@@ -80,15 +108,1037 @@ Attributes:
     bb_ph (numpy.ndarray): Modelled backscatter of phytoplankton.
     bb_nap(numpy.ndarray): Modelled backscatter of NAP.
     bb_water(numpy.ndarray): Modelled backscatter of water.
+    rrs_dchl (numpy.ndarray): Derivative of rrs with respect to chl.
+    rrs_dcdom (numpy.ndarray): Derivative of rrs with respect to cdom.
+    rrs_dnap (numpy.ndarray): Derivative of rrs with respect to nap.
+    rrs_ddepth (numpy.ndarray): Derivative of rrs with respect to depth.
+    rrs_dfrac1 (numpy.ndarray): Derivative of rrs with respect to sub1_frac.
+    rrs_dfrac2 (numpy.ndarray): Derivative of rrs with respect to sub2_frac.
+    rrs_dfrac3 (numpy.ndarray): Derivative of rrs with respect to sub3_frac.
+
+    The rrs_d* derivatives are None if the model was evaluated with
+    compute_jacobian=False.
+"""
+
+# An upper bound of rrsdp = (0.084 + 0.17 * u) * u, as 0 <= u <= 1
+_MAX_RRSDP = 0.254
+
+# The margin between the estimated error of a linearised prediction and its
+# tolerance. The largest actual error of a pixel was at most about 1.2 times
+# its largest estimate in tests (see linearisation_error).
+_LINEARISATION_SAFETY = 2.0
+
+WaterColumnTerms = namedtuple('WaterColumnTerms',
+                              [
+                                  'a',
+                                  'bb',
+                                  'kappa',
+                                  'u',
+                                  'du_column',
+                                  'du_bottom',
+                                  'rrsdp',
+                                  'kd',
+                                  'kuc',
+                                  'kub',
+                                  'column_path',
+                                  'bottom_path',
+                              ])
+""" A namedtuple containing the terms of the forward model that depend only
+on chl, cdom and nap, as calculated by ForwardModelContext.water_column.
+
+Every field has shape (..., num_bands), where ... is the broadcast shape of
+chl, cdom and nap.
+
+Attributes:
+    a (numpy.ndarray): Total absorption.
+    bb (numpy.ndarray): Total backscatter.
+    kappa (numpy.ndarray): a + bb.
+    u (numpy.ndarray): bb / kappa.
+    du_column (numpy.ndarray): Optical path elongation of scattered photons
+        from the water column.
+    du_bottom (numpy.ndarray): Optical path elongation of scattered photons
+        from the bottom.
+    rrsdp (numpy.ndarray): Optically-deep remotely-sensed reflectance.
+    kd (numpy.ndarray): As for ForwardModelResults.
+    kuc (numpy.ndarray): As for ForwardModelResults.
+    kub (numpy.ndarray): As for ForwardModelResults.
+    column_path (numpy.ndarray): The water column attenuation per unit of
+        kappa * depth, (kd + kuc) / kappa.
+    bottom_path (numpy.ndarray): The bottom attenuation per unit of
+        kappa * depth, (kd + kub) / kappa.
+"""
+
+WaterColumnResults = namedtuple('WaterColumnResults', ['rrs', 'rrs_ddepth'])
+""" A namedtuple containing the results of
+ForwardModelContext.evaluate_water_column.
+
+Attributes:
+    rrs (numpy.ndarray): Modelled remotely-sensed reflectance.
+    rrs_ddepth (numpy.ndarray): Derivative of rrs with respect to depth, or
+        None if it was not requested.
+"""
+
+VJPResults = namedtuple('VJPResults', ['rrs', 'gradient'])
+""" A namedtuple containing the results of ForwardModelContext.evaluate_vjp.
+
+Attributes:
+    rrs (numpy.ndarray): Modelled remotely-sensed reflectance, shape
+        (N, num_bands).
+    gradient (numpy.ndarray): The vector-Jacobian product, shape (N, 7), with
+        columns ordered as FREE_PARAMETERS.
+"""
+
+LinearisedResults = namedtuple('LinearisedResults',
+                               ['rrs', 'error', 'evaluated'])
+""" A namedtuple containing the results of
+ForwardModelContext.evaluate_linearised.
+
+Attributes:
+    rrs (numpy.ndarray): Predicted (or, for evaluated pixels, modelled) rrs,
+        shape (N, num_bands).
+    error (numpy.ndarray): The second-order magnitude estimate of the error
+        of the predicted rrs (see linearisation_error), shape
+        (N, num_bands). Zero for evaluated pixels.
+    evaluated (numpy.ndarray): True for the pixels whose estimated error
+        exceeded the tolerance, and which were evaluated by the full model,
+        shape (N,).
 """
 
 
 # pylint: disable=too-many-arguments
 # pylint: disable=too-many-locals
+# pylint: disable=too-many-instance-attributes
 
 # Disabling invalid-name as many of the common (and published) variable names
 # in the Sambuca model are invalid according to Python conventions.
 # pylint: disable=invalid-name
+class ForwardModelContext(object):
+    """Parameter-independent state of the Lee/Sambuca forward model.
+
+    The derived SIOPs (bb_water, a_cdom_star, a_nap_star, bb_ph_star and
+    bb_nap_star) and the sub-surface viewing geometry do not depend on the
+    free parameters (chl, cdom, nap, depth and the substrate fractions).
+    A context computes them once, so that repeated model evaluations, such as
+    those made by an optimiser, only pay for the parameter-dependent terms.
+
+    The constructor arguments are identical to the corresponding arguments of
+    :func:`forward_model`, including dtype. The derived SIOPs are calculated
+    in double precision and then stored at the precision given by dtype.
+
+    Attributes:
+        num_bands (int): The number of spectral bands.
+        dtype (numpy.dtype): The floating-point type of all model arrays.
+        wavelengths (numpy.ndarray): Central wavelengths of the modelled bands.
+        substrate1 (numpy.ndarray): A benthic substrate.
+        substrate2 (numpy.ndarray): A benthic substrate.
+        substrate3 (numpy.ndarray): A benthic substrate.
+        a_water (numpy.ndarray): Absorption coefficient of pure water.
+        a_ph_star (numpy.ndarray): Specific absorption of phytoplankton.
+        a_cdom_star (numpy.ndarray): Specific absorption of CDOM.
+        a_nap_star (numpy.ndarray): Specific absorption of NAP.
+        bb_water (numpy.ndarray): Backscatter of water.
+        bb_ph_star (numpy.ndarray): Specific backscatter of phytoplankton.
+        bb_nap_star (numpy.ndarray): Specific backscatter of NAP.
+        theta_w (float): Sub-surface solar zenith angle in radians.
+        theta_o (float): Sub-surface viewing angle in radians.
+        inv_cos_theta_w (float): 1 / cos(theta_w).
+        inv_cos_theta_0 (float): 1 / cos(theta_o).
+        q_factor (float): q value used to produce the R(0-) values.
+    """
+
+    def __init__(
+            self,
+            substrate1,
+            substrate2,
+            substrate3,
+            wavelengths,
+            a_water,
+            a_ph_star,
+            num_bands,
+            a_cdom_slope=None,
+            a_nap_slope=None,
+            bb_ph_slope=None,
+            bb_nap_slope=None,
+            lambda0cdom=None,
+            lambda0nap=None,
+            lambda0x=None,
+            x_ph_lambda0x=None,
+            x_nap_lambda0x=None,
+            a_cdom_lambda0cdom=None,
+            a_nap_lambda0nap=None,
+            bb_lambda_ref=None,
+            water_refractive_index=None,
+            theta_air=None,
+            off_nadir=None,
+            q_factor=None,
+            dtype=np.float64):
+
+        assert len(substrate1) == num_bands
+        if substrate2 is not None:
+            assert len(substrate2) == num_bands
+        if substrate3 is not None:
+            assert len(substrate3) == num_bands
+        assert len(wavelengths) == num_bands
+        assert len(a_water) == num_bands
+        assert len(a_ph_star) == num_bands
+
+        self.num_bands = num_bands
+        self.dtype = np.dtype(dtype)
+        self.substrate1 = self._as_spectrum(substrate1)
+        self.substrate2 = self._as_spectrum(substrate2)
+        self.substrate3 = self._as_spectrum(substrate3)
+        self.wavelengths = self._as_spectrum(wavelengths)
+        self.a_water = self._as_spectrum(a_water)
+        self.a_ph_star = self._as_spectrum(a_ph_star)
+        # A Python float keeps the precision of the arrays it multiplies
+        self.q_factor = None if q_factor is None else float(q_factor)
+
+        # Sub-surface solar zenith angle in radians
+        inv_refractive_index = 1.0 / water_refractive_index
+        self.theta_w = \
+            math.asin(inv_refractive_index * math.sin(math.radians(theta_air)))
+
+        # Sub-surface viewing angle in radians
+        self.theta_o = \
+            math.asin(inv_refractive_index * math.sin(math.radians(off_nadir)))
+
+        # common terms in the model calculations
+        self.inv_cos_theta_w = 1.0 / math.cos(self.theta_w)
+        self.inv_cos_theta_0 = 1.0 / math.cos(self.theta_o)
+
+        # Calculate derived SIOPS, based on
+        # Mobley, Curtis D., 1994: Radiative Transfer in natural waters.
+        # These are always calculated in double precision, and then stored
+        # at the precision of the context.
+        wavelengths = np.asarray(wavelengths, dtype=np.float64)
+        self.bb_water = self._as_spectrum((0.00194 / 2.0) * \
+            np.power(bb_lambda_ref / wavelengths, 4.32))
+        self.a_cdom_star = self._as_spectrum(a_cdom_lambda0cdom * \
+            np.exp(-a_cdom_slope * (wavelengths - lambda0cdom)))
+        self.a_nap_star = self._as_spectrum(a_nap_lambda0nap * \
+            np.exp(-a_nap_slope * (wavelengths - lambda0nap)))
+
+        # Calculate backscatter
+        backscatter = np.power(lambda0x / wavelengths, bb_ph_slope)
+        # specific backscatter due to phytoplankton
+        self.bb_ph_star = self._as_spectrum(x_ph_lambda0x * backscatter)
+        # specific backscatter due to NAP
+        # If a bb_nap_slope value has been supplied, use it.
+        # Otherwise, reuse bb_ph_slope.
+        if bb_nap_slope:
+            backscatter = np.power(lambda0x / wavelengths, bb_nap_slope)
+        self.bb_nap_star = self._as_spectrum(x_nap_lambda0x * backscatter)
+
+    def _as_spectrum(self, values):
+        """Converts a spectral input to an array of the context dtype. """
+        if values is None:
+            return None
+        return np.asarray(values, dtype=self.dtype)
+
+    def with_substrates(self, substrate1, substrate2, substrate3):
+        """Returns a copy of the context with different substrates.
+
+        The derived SIOPs and geometry are shared with this context, so
+        switching between the members of a spectral library does not repeat
+        the constructor calculations.
+
+        Args:
+            substrate1 (array-like): A benthic substrate.
+            substrate2 (array-like): A benthic substrate.
+            substrate3 (array-like): A benthic substrate.
+
+        Returns:
+            ForwardModelContext: The new context.
+        """
+        for substrate in (substrate1, substrate2, substrate3):
+            if substrate is not None and len(substrate) != self.num_bands:
+                raise ValueError(
+                    'Substrates must have {0} bands'.format(self.num_bands))
+        context = copy.copy(self)
+        context.substrate1 = self._as_spectrum(substrate1)
+        context.substrate2 = self._as_spectrum(substrate2)
+        context.substrate3 = self._as_spectrum(substrate3)
+        return context
+
+    def subset(self, bands):
+        """Returns a copy of the context restricted to some of its bands.
+
+        Every band of the model is evaluated independently, so the subset
+        context gives the same rrs and derivatives as this context for the
+        selected bands.
+
+        Args:
+            bands (array-like): The indices of the selected bands, or a
+                boolean mask of shape (num_bands,).
+
+        Returns:
+            ForwardModelContext: The new context.
+        """
+        bands = np.arange(self.num_bands)[np.asarray(bands)]
+        if bands.ndim != 1:
+            raise ValueError('The bands must be a vector of band indices')
+        context = copy.copy(self)
+        context.num_bands = len(bands)
+        for name in ('substrate1', 'substrate2', 'substrate3', 'wavelengths',
+                     'a_water', 'a_ph_star', 'bb_water', 'a_cdom_star',
+                     'a_nap_star', 'bb_ph_star', 'bb_nap_star'):
+            spectrum = getattr(self, name)
+            if spectrum is not None:
+                setattr(context, name, np.ascontiguousarray(spectrum[bands]))
+        return context
+
+    def evaluate(
+            self,
+            chl,
+            cdom,
+            nap,
+            depth,
+            sub1_frac,
+            sub2_frac,
+            sub3_frac,
+            compute_jacobian=True):
+        """Evaluates the forward model for a single set of free parameters.
+
+        Args:
+            chl (float): Concentration of chlorophyll.
+            cdom (float): Concentration of CDOM.
+            nap (float): Concentration of NAP.
+            depth (float): Water column depth.
+            sub1_frac (float): Proportion of substrate1.
+            sub2_frac (float): Proportion of substrate2.
+            sub3_frac (float): Proportion of substrate3.
+            compute_jacobian (bool, optional): If true (the default), the
+                rrs_d* derivatives are calculated. Otherwise they are None
+                in the results.
+
+        Returns:
+            ForwardModelResults: A namedtuple containing the model outputs.
+        """
+        # 0-d arrays rather than scalars, so that the parameters do not promote
+        # the precision of the context.
+        parameters = [np.asarray(p, dtype=self.dtype)
+                      for p in (chl, cdom, nap, depth,
+                                sub1_frac, sub2_frac, sub3_frac)]
+        return self._evaluate(
+            *parameters, compute_jacobian=compute_jacobian)
+
+    def evaluate_batch(
+            self,
+            chl,
+            cdom,
+            nap,
+            depth,
+            sub1_frac,
+            sub2_frac,
+            sub3_frac,
+            compute_jacobian=True,
+            deep_tolerance=None):
+        """Evaluates the forward model for a batch of free parameters.
+
+        Args:
+            chl (array-like): Chlorophyll concentrations, shape (N,).
+            cdom (array-like): CDOM concentrations, shape (N,).
+            nap (array-like): NAP concentrations, shape (N,).
+            depth (array-like): Water column depths, shape (N,).
+            sub1_frac (array-like): Proportions of substrate1, shape (N,).
+            sub2_frac (array-like): Proportions of substrate2, shape (N,).
+            sub3_frac (array-like): Proportions of substrate3, shape (N,).
+
+            compute_jacobian (bool, optional): If true (the default), the
+                rrs_d* derivatives are calculated. Otherwise they are None
+                in the results.
+            deep_tolerance (float, optional): If supplied, and most of the
+                batch is optically deep in every band to this tolerance (see
+                optically_deep), those pixels are evaluated by a faster
+                kernel that skips the bottom terms. Their rrs is rrsdp, and
+                their depth and substrate fraction derivatives are zero.
+                numpy.inf treats every pixel as optically deep.
+
+            Scalars are broadcast across the batch.
+
+        Returns:
+            ForwardModelResults: A namedtuple containing the model outputs,
+                where every field has shape (N, num_bands). Fields that do not
+                depend on the free parameters (such as a_water or bb_water)
+                are returned as read-only broadcast views rather than copies.
+        """
+        parameters = np.broadcast_arrays(
+            *[np.atleast_1d(np.asarray(p, dtype=self.dtype))
+              for p in (chl, cdom, nap, depth, sub1_frac, sub2_frac, sub3_frac)])
+        if parameters[0].ndim != 1:
+            raise ValueError('Batched forward model parameters must be 1-D')
+
+        deep = np.zeros(len(parameters[0]), dtype=bool)
+        if deep_tolerance is not None:
+            deep = np.all(
+                self.optically_deep(*parameters, tolerance=deep_tolerance),
+                axis=1)
+
+        # Column vectors broadcast against the (num_bands,) spectral inputs
+        # in every expression of the model.
+        if 2 * np.count_nonzero(deep) <= len(deep):
+            # Too few optically deep pixels to repay patching the others
+            results = self._evaluate(
+                *[p[:, np.newaxis] for p in parameters],
+                compute_jacobian=compute_jacobian)
+        else:
+            results = self._evaluate_deep(
+                *[p[:, np.newaxis] for p in parameters],
+                compute_jacobian=compute_jacobian)
+            shallow = np.flatnonzero(~deep)
+            if len(shallow):
+                results = self._patch(
+                    results,
+                    shallow,
+                    self._evaluate(
+                        *[p[shallow, np.newaxis] for p in parameters],
+                        compute_jacobian=compute_jacobian))
+
+        shape = (len(parameters[0]), self.num_bands)
+        return ForwardModelResults._make(
+            field if field is None or field.shape == shape
+            else np.broadcast_to(field, shape)
+            for field in results)
+
+    def optically_deep(
+            self,
+            chl,
+            cdom,
+            nap,
+            depth,
+            sub1_frac,
+            sub2_frac,
+            sub3_frac,
+            tolerance):
+        """Finds the bands in which the bottom is effectively invisible.
+
+        The bottom changes rrs from rrsdp by rrsdp * expColumnScaled and
+        r_substratum * expBottomScaled / pi. The optical path elongations
+        are at least 1.03 and 1.04, so both attenuation terms are at most
+        exp(-(1 / cos(theta_w) + 1.03 / cos(theta_o)) * kappa * depth). A
+        band is optically deep when this bound, scaled by upper bounds of
+        rrsdp and r_substratum, is within the tolerance. The test only needs
+        kappa, so it is much cheaper than evaluating the model.
+
+        Args:
+            chl (array-like): Chlorophyll concentrations, shape (N,).
+            cdom (array-like): CDOM concentrations, shape (N,).
+            nap (array-like): NAP concentrations, shape (N,).
+            depth (array-like): Water column depths, shape (N,).
+            sub1_frac (array-like): Proportions of substrate1, shape (N,).
+            sub2_frac (array-like): Proportions of substrate2, shape (N,).
+            sub3_frac (array-like): Proportions of substrate3, shape (N,).
+            tolerance (float): The largest acceptable change of rrs.
+
+        Returns:
+            numpy.ndarray: A boolean array of shape (N, num_bands), true
+                where rrs is within tolerance of rrsdp.
+        """
+        chl, cdom, nap, depth = np.broadcast_arrays(
+            *[np.asarray(p, dtype=np.float64)
+              for p in (chl, cdom, nap, depth)])
+        # kappa is linear in (1, chl, cdom, nap)
+        kappa = np.dot(
+            np.stack([np.ones_like(chl), chl, cdom, nap], axis=-1),
+            np.stack([self.a_water + self.bb_water,
+                      self.a_ph_star + self.bb_ph_star,
+                      self.a_cdom_star,
+                      self.a_nap_star + self.bb_nap_star]).astype(np.float64))
+
+        r_substratum = 0.0
+        for fraction, substrate in ((sub1_frac, self.substrate1),
+                                    (sub2_frac, self.substrate2),
+                                    (sub3_frac, self.substrate3)):
+            if substrate is not None:
+                r_substratum = r_substratum + np.abs(fraction) * \
+                    float(np.max(np.abs(substrate)))
+        bound = np.maximum(_MAX_RRSDP, np.asarray(r_substratum) / math.pi)
+
+        # exp(-path * kappa * depth) * bound <= tolerance
+        path = self.inv_cos_theta_w + 1.03 * self.inv_cos_theta_0
+        with np.errstate(divide='ignore', invalid='ignore'):
+            threshold = np.log(bound / tolerance) / (path * depth)
+        return kappa >= threshold[..., np.newaxis]
+
+    def water_column(self, chl, cdom, nap):
+        """Calculates the terms of the model that do not depend on depth or
+        the substrates.
+
+        The terms can be passed to evaluate_water_column any number of
+        times, to evaluate many depths and substrate mixes of the same water
+        without recalculating the optical properties.
+
+        Args:
+            chl (array-like): Chlorophyll concentrations.
+            cdom (array-like): CDOM concentrations.
+            nap (array-like): NAP concentrations.
+
+            The concentrations are scalars or arrays of any broadcastable
+            shape.
+
+        Returns:
+            WaterColumnTerms: The terms, with shape (..., num_bands).
+        """
+        chl, cdom, nap = [np.asarray(p, dtype=self.dtype)[..., np.newaxis]
+                          for p in (chl, cdom, nap)]
+        a = self.a_water + chl * self.a_ph_star + cdom * self.a_cdom_star + \
+            nap * self.a_nap_star
+        bb = self.bb_water + chl * self.bb_ph_star + nap * self.bb_nap_star
+        kappa = a + bb
+        u = bb / kappa
+        du_column = 1.03 * np.power(1.00 + (2.40 * u), 0.50)
+        du_bottom = 1.04 * np.power(1.00 + (5.40 * u), 0.50)
+        rrsdp = (0.084 + 0.17 * u) * u
+        du_column_scaled = du_column * self.inv_cos_theta_0
+        du_bottom_scaled = du_bottom * self.inv_cos_theta_0
+        return WaterColumnTerms(
+            a=a,
+            bb=bb,
+            kappa=kappa,
+            u=u,
+            du_column=du_column,
+            du_bottom=du_bottom,
+            rrsdp=rrsdp,
+            kd=kappa * self.inv_cos_theta_w,
+            kuc=kappa * du_column_scaled,
+            kub=kappa * du_bottom_scaled,
+            column_path=self.inv_cos_theta_w + du_column_scaled,
+            bottom_path=self.inv_cos_theta_w + du_bottom_scaled)
+
+    def evaluate_water_column(
+            self,
+            terms,
+            depth,
+            sub1_frac,
+            sub2_frac,
+            sub3_frac,
+            compute_ddepth=False):
+        """Evaluates rrs from precalculated water column terms.
+
+        The depths and substrate fractions broadcast against the leading
+        shape of the terms, so a single water column can be evaluated at a
+        vector of depths, or every water column of a batch at a grid of
+        depths. For example, terms for chl of shape (N,) and depth of shape
+        (D, 1) give rrs of shape (D, N, num_bands).
+
+        Args:
+            terms (WaterColumnTerms): Terms from water_column.
+            depth (array-like): Water column depths.
+            sub1_frac (array-like): Proportions of substrate1.
+            sub2_frac (array-like): Proportions of substrate2.
+            sub3_frac (array-like): Proportions of substrate3.
+            compute_ddepth (bool, optional): If true, the derivative of rrs
+                with respect to depth is also calculated.
+
+        Returns:
+            WaterColumnResults: The rrs (and derivative) values, with the
+                broadcast shape of the inputs and a trailing band axis.
+        """
+        depth, sub1_frac, sub2_frac, sub3_frac = [
+            np.asarray(p, dtype=self.dtype)[..., np.newaxis]
+            for p in (depth, sub1_frac, sub2_frac, sub3_frac)]
+        r_substratum = sub1_frac * self.substrate1 + \
+            sub2_frac * self.substrate2 + sub3_frac * self.substrate3
+        kappa_d = terms.kappa * depth
+        exp_bottom = np.exp(-terms.bottom_path * kappa_d)
+        exp_column = np.exp(-terms.column_path * kappa_d)
+        rrs = (terms.rrsdp * (1.0 - exp_column) +
+               ((1.0 / math.pi) * r_substratum * exp_bottom))
+        rrs_ddepth = None
+        if compute_ddepth:
+            rrs_ddepth = \
+                terms.rrsdp * terms.column_path * terms.kappa * exp_column - \
+                (1.0 / math.pi) * r_substratum * terms.bottom_path * \
+                terms.kappa * exp_bottom
+        return WaterColumnResults(rrs=rrs, rrs_ddepth=rrs_ddepth)
+
+    def evaluate_vjp(
+            self,
+            chl,
+            cdom,
+            nap,
+            depth,
+            sub1_frac,
+            sub2_frac,
+            sub3_frac,
+            cotangent):
+        """Evaluates rrs, and the product of a band vector with its Jacobian.
+
+        For a cotangent of d(loss)/d(rrs), the product is the gradient of the
+        loss with respect to the free parameters. Rather than forming the
+        seven rrs_d* arrays and reducing them, the derivatives are
+        propagated backwards through the model from the cotangent: rrs
+        depends on chl, cdom and nap only through kappa and bb, and on the
+        attenuation terms only through their exponents. Each pixel needs a
+        few per-band arrays and one small matrix product per group of
+        parameters, so the product is much cheaper than the Jacobian.
+
+        Args:
+            chl (array-like): Chlorophyll concentrations, shape (N,).
+            cdom (array-like): CDOM concentrations, shape (N,).
+            nap (array-like): NAP concentrations, shape (N,).
+            depth (array-like): Water column depths, shape (N,).
+            sub1_frac (array-like): Proportions of substrate1, shape (N,).
+            sub2_frac (array-like): Proportions of substrate2, shape (N,).
+            sub3_frac (array-like): Proportions of substrate3, shape (N,).
+            cotangent (array-like or callable): The band vector, with shape
+                (N, num_bands) or (num_bands,). Losses usually depend on the
+                modelled rrs, so this may also be a function that is called
+                with the rrs, and returns the vector.
+
+            Scalars are broadcast across the batch.
+
+        Returns:
+            VJPResults: The rrs, and the products with shape (N, 7).
+        """
+        chl, cdom, nap, depth, sub1_frac, sub2_frac, sub3_frac = [
+            p[:, np.newaxis] for p in np.broadcast_arrays(
+                *[np.atleast_1d(np.asarray(p, dtype=self.dtype))
+                  for p in (chl, cdom, nap, depth,
+                            sub1_frac, sub2_frac, sub3_frac)])]
+        if chl.ndim != 2:
+            raise ValueError('Batched forward model parameters must be 1-D')
+        substrates = np.stack(
+            [self.substrate1, self.substrate2, self.substrate3])
+
+        terms = self.water_column(chl[:, 0], cdom[:, 0], nap[:, 0])
+        kappa_d = terms.kappa * depth
+        exp_bottom = np.exp(-terms.bottom_path * kappa_d)
+        exp_column = np.exp(-terms.column_path * kappa_d)
+        r_substratum = sub1_frac * self.substrate1 + \
+            sub2_frac * self.substrate2 + sub3_frac * self.substrate3
+        rrs = (terms.rrsdp * (1.0 - exp_column) +
+               ((1.0 / math.pi) * r_substratum * exp_bottom))
+        bottom = (1.0 / math.pi) * exp_bottom
+
+        if callable(cotangent):
+            cotangent = cotangent(rrs)
+        cotangent = np.broadcast_to(
+            np.asarray(cotangent, dtype=self.dtype), rrs.shape)
+
+        # rrs is linear in the fractions
+        gradient = np.empty((len(rrs), len(FREE_PARAMETERS)), dtype=rrs.dtype)
+        gradient[:, 4:] = np.dot(cotangent * bottom, substrates.T)
+
+        # The adjoints of the column and bottom attenuation exponents, and
+        # of kappa * depth through them
+        column_adjoint = cotangent * terms.rrsdp * exp_column
+        bottom_adjoint = -cotangent * r_substratum * bottom
+        path_adjoint = column_adjoint * terms.column_path + \
+            bottom_adjoint * terms.bottom_path
+        gradient[:, 3] = np.einsum('nb,nb->n', path_adjoint, terms.kappa)
+
+        # u changes rrsdp, and the path elongations of both exponents
+        u_adjoint = cotangent * (0.084 + 0.34 * terms.u) * (1.0 - exp_column)
+        u_adjoint += kappa_d * self.inv_cos_theta_0 * (
+            column_adjoint * (1.03 * 1.03 * 1.2 / terms.du_column) +
+            bottom_adjoint * (1.04 * 1.04 * 2.7 / terms.du_bottom))
+
+        # u = bb / kappa, and kappa and bb are linear in the concentrations
+        bb_adjoint = u_adjoint / terms.kappa
+        kappa_adjoint = path_adjoint * depth - bb_adjoint * terms.u
+        gradient[:, :3] = \
+            np.dot(kappa_adjoint, np.stack(
+                [self.a_ph_star + self.bb_ph_star,
+                 self.a_cdom_star,
+                 self.a_nap_star + self.bb_nap_star]).T) + \
+            np.dot(bb_adjoint, np.stack(
+                [self.bb_ph_star,
+                 np.zeros(self.num_bands, dtype=self.dtype),
+                 self.bb_nap_star]).T)
+        return VJPResults(rrs=rrs, gradient=gradient)
+
+    def linearisation_error(self, results, depth, delta):
+        """Estimates the error of a first-order prediction of rrs.
+
+        rrs is linear in the substrate fractions. It depends on chl, cdom,
+        nap and depth through the attenuation terms exp(-path * kappa *
+        depth), and through u = bb / kappa. The second-order error of a step
+        is estimated as its first-order change, sum(|J . delta|), times z,
+        the change of the bottom attenuation exponent plus the relative
+        changes of kappa and bb. Every term comes from the results, so the
+        estimate costs a small fraction of an evaluation.
+
+        This is a magnitude estimate, not a bound on the error of each band.
+        The absorption and backscatter effects of a parameter can cancel in
+        J . delta, and the bands where they do can have errors well above
+        their estimate. This mostly happens for steps along a single
+        parameter, such as nap. The largest estimate of a pixel is a better
+        guide: in tests, the largest actual error of a pixel was at most
+        about 1.2 times its largest estimate.
+
+        Args:
+            results (ForwardModelResults): Batched results, calculated with
+                the Jacobian. Only the a, bb, kd and kub fields and the
+                rrs_d* fields are used.
+            depth (array-like): The depths the results were evaluated at,
+                shape (N,).
+            delta (array-like): The parameter changes, with shape (N, 7) and
+                columns ordered as FREE_PARAMETERS.
+
+        Returns:
+            numpy.ndarray: The estimated magnitude of the error of each
+                band, shape (N, num_bands).
+        """
+        return self._linearise(results, depth, delta, predict=False)[1]
+
+    def evaluate_linearised(self, results, parameters, delta, tolerance):
+        """Predicts rrs after a small parameter change, from the Jacobian.
+
+        The rrs of parameters + delta is predicted as rrs + J . delta. Pixels
+        whose estimated error (see linearisation_error), times a safety
+        factor of 2, exceeds the tolerance in any band are evaluated by the
+        full model instead. The estimate is not a strict bound, but with
+        this margin the errors of predicted pixels were within the tolerance
+        in tests. Small changes, such as those of line searches and
+        converging optimisers, are predicted for a fraction of the cost of
+        an evaluation.
+
+        Args:
+            results (ForwardModelResults): Batched results at parameters,
+                calculated with the Jacobian.
+            parameters (array-like): The parameters of the results, with
+                shape (N, 7) and columns ordered as FREE_PARAMETERS.
+            delta (array-like): The parameter changes, shape (N, 7) or (7,).
+            tolerance (float): The largest acceptable estimated error of the
+                predicted rrs, in any band.
+
+        Returns:
+            LinearisedResults: The rrs, its estimated error and the pixels
+                that were evaluated.
+        """
+        parameters = np.asarray(parameters, dtype=np.float64)
+        delta = np.broadcast_to(
+            np.asarray(delta, dtype=np.float64), parameters.shape)
+        rrs, error = self._linearise(results, parameters[:, 3], delta)
+        evaluated = ~np.all(
+            _LINEARISATION_SAFETY * error <= tolerance, axis=1)
+        if evaluated.any():
+            rows = np.flatnonzero(evaluated)
+            rrs[rows] = self.evaluate_batch(
+                *(parameters[rows] + delta[rows]).T,
+                compute_jacobian=False).rrs
+            error[rows] = 0.0
+        return LinearisedResults(rrs=rrs, error=error, evaluated=evaluated)
+
+    def _linearise(self, results, depth, delta, predict=True):
+        """The first-order prediction of rrs and its estimated error.
+
+        Returns:
+            tuple: The predicted rrs (or None, if predict is False) and the
+                estimated error, both with shape (N, num_bands).
+        """
+        delta = np.asarray(delta, dtype=np.float64)
+        rrs = np.array(results.rrs, dtype=np.float64) if predict else None
+        first_order = np.zeros(results.a.shape)
+        change = np.empty(results.a.shape)
+        for i, name in enumerate(JACOBIAN_FIELDS):
+            np.multiply(getattr(results, name), delta[:, i:i + 1], out=change)
+            if predict:
+                rrs += change
+            first_order += np.abs(change, out=change)
+        first_order *= self._linearisation_scale(
+            results, depth, np.abs(delta))
+        return rrs, first_order
+
+    def _linearisation_scale(self, results, depth, delta):
+        """The z factor of linearisation_error, shape (N, num_bands).
+
+        Args:
+            results (ForwardModelResults): Batched results. Only the a, bb,
+                kd and kub fields are used.
+            depth (array-like): The depths of the results, shape (N,).
+            delta (numpy.ndarray): The absolute parameter changes, (N, 7).
+        """
+        depth = np.asarray(depth, dtype=np.float64)[:, np.newaxis]
+        rate = results.kd + results.kub
+        # The changes of kappa and bb, bounded by the absolute changes of
+        # chl, cdom and nap
+        kappa_change = np.dot(delta[:, :3], np.stack(
+            [self.a_ph_star + self.bb_ph_star,
+             self.a_cdom_star,
+             self.a_nap_star + self.bb_nap_star]).astype(np.float64))
+        bb_change = np.dot(delta[:, 0:3:2], np.stack(
+            [self.bb_ph_star, self.bb_nap_star]).astype(np.float64))
+
+        # The change of the bottom attenuation exponent, rate * depth, plus
+        # the relative changes of kappa and bb
+        scale = depth * rate
+        scale += 1.0
+        scale *= kappa_change
+        scale /= results.a + results.bb
+        scale += bb_change / results.bb
+        scale += rate * delta[:, 3:4]
+        return scale
+
+    def _evaluate(
+            self,
+            chl,
+            cdom,
+            nap,
+            depth,
+            sub1_frac,
+            sub2_frac,
+            sub3_frac,
+            compute_jacobian=True):
+        """Model kernel shared by evaluate and evaluate_batch.
+
+        The free parameters are either scalars, or (N, 1) columns that
+        broadcast against the (num_bands,) spectral terms.
+        """
+        substrate1 = self.substrate1
+        substrate2 = self.substrate2
+        substrate3 = self.substrate3
+        a_water = self.a_water
+        a_ph_star = self.a_ph_star
+        a_cdom_star = self.a_cdom_star
+        a_nap_star = self.a_nap_star
+        bb_water = self.bb_water
+        bb_ph_star = self.bb_ph_star
+        bb_nap_star = self.bb_nap_star
+        inv_cos_theta_w = self.inv_cos_theta_w
+        inv_cos_theta_0 = self.inv_cos_theta_0
+        q_factor = self.q_factor
+
+        # Total absorption
+        a_ph = chl * a_ph_star
+        a_cdom = cdom * a_cdom_star
+        a_nap = nap * a_nap_star
+        a = a_water + a_ph + a_cdom + a_nap
+
+        # Total backscatter
+        bb_ph = chl * bb_ph_star
+        bb_nap = nap * bb_nap_star
+        bb = bb_water + bb_ph + bb_nap
+
+        # Calculate bottom reflectance from 3 subs (BOMBER etc)
+        r_substratum = sub1_frac * substrate1 + sub2_frac * substrate2 + \
+            sub3_frac * substrate3
+
+        # TODO: what are u and kappa?
+        kappa = a + bb
+        u = bb / kappa
+
+        # Optical path elongation for scattered photons
+        # elongation from water column
+        # TODO: reference to the paper from which these equations are derived
+        sq1 = np.power(1.00 + (2.40 * u), 0.50)
+        du_column = 1.03 * sq1
+        # elongation from bottom
+        sq2 = np.power(1.00 + (5.40 * u), 0.50)
+        du_bottom = 1.04 * sq2
+
+        # Remotely sensed sub-surface reflectance for optically deep water
+        rrsdp = (0.084 + 0.17 * u) * u
+
+        # common terms in the following calculations
+        du_column_scaled = du_column * inv_cos_theta_0
+        du_bottom_scaled = du_bottom * inv_cos_theta_0
+
+        # TODO: descriptions of kd, kuc, kub
+        kd = kappa * inv_cos_theta_w
+        kuc = kappa * du_column_scaled
+        kub = kappa * du_bottom_scaled
+
+        # Remotely sensed reflectance
+        # The attenuation terms are shared by rrs and the Jacobian.
+        kappa_d = kappa * depth
+        expBottomScaled = np.exp(-(inv_cos_theta_w + du_bottom_scaled) * kappa_d)
+        expColumnScaled = np.exp(-(inv_cos_theta_w + du_column_scaled) * kappa_d)
+        rrs = (rrsdp * (1.0 - expColumnScaled) +
+               ((1.0 / math.pi) * r_substratum * expBottomScaled))
+
+        rrs_dchl = rrs_dcdom = rrs_dnap = rrs_ddepth = None
+        rrs_dfrac1 = rrs_dfrac2 = rrs_dfrac3 = None
+        if compute_jacobian:
+            rrs_dfrac1 = (1.0 / math.pi) * substrate1 * expBottomScaled
+            rrs_dfrac2 = (1.0 / math.pi) * substrate2 * expBottomScaled
+            rrs_dfrac3 = (1.0 / math.pi) * substrate3 * expBottomScaled
+            rrs_ddepth = rrsdp *(inv_cos_theta_w + du_column_scaled)* kappa*expColumnScaled - (1.0 / math.pi) * r_substratum *(inv_cos_theta_w + du_bottom_scaled)*kappa*expBottomScaled
+            u_dcdom = -(bb*a_cdom_star/(kappa*kappa))
+            du_column_dcdom = 1.03*2.4*u_dcdom/(2.0*sq1)
+            du_bottom_dcdom = 1.04*5.4*u_dcdom/(2.0*sq2)
+            rrs_dcdom = (0.084*u_dcdom+0.34*u*u_dcdom)*(1.0 - expColumnScaled) +rrsdp*depth*((inv_cos_theta_0*du_column_dcdom*kappa+a_cdom_star*(inv_cos_theta_w + du_column_scaled)) * expColumnScaled) +(1.0 / math.pi) * r_substratum * (-depth) * ((inv_cos_theta_0*du_bottom_dcdom*kappa+a_cdom_star*(inv_cos_theta_w + du_bottom_scaled)) * expBottomScaled)
+            u_dchl = (bb_ph_star*kappa-bb*(a_ph_star+bb_ph_star))/(kappa*kappa)
+            du_column_dchl = 1.03*2.4*u_dchl/(2.0*sq1)
+            du_bottom_dchl = 1.04*5.4*u_dchl/(2.0*sq2)
+            rrs_dchl = (0.084*u_dchl+0.34*u*u_dchl)*(1.0 - expColumnScaled) +rrsdp*depth*((inv_cos_theta_0*du_column_dchl*kappa+(a_ph_star+bb_ph_star)*(inv_cos_theta_w + du_column_scaled)) * expColumnScaled) +(1.0 / math.pi) * r_substratum * (-depth) * ((inv_cos_theta_0*du_bottom_dchl*kappa+(a_ph_star+bb_ph_star)*(inv_cos_theta_w + du_bottom_scaled)) * expBottomScaled)
+            u_dnap = (bb_nap_star*kappa-bb*(a_nap_star+bb_nap_star))/(kappa*kappa)
+            du_column_dnap = 1.03*2.4*u_dnap/(2.0*sq1)
+            du_bottom_dnap = 1.04*5.4*u_dnap/(2.0*sq2)
+            rrs_dnap = (0.084*u_dnap+0.34*u*u_dnap)*(1.0 - expColumnScaled) +rrsdp*depth*((inv_cos_theta_0*du_column_dnap*kappa+(a_nap_star+bb_nap_star)*(inv_cos_theta_w + du_column_scaled)) * expColumnScaled) +(1.0 / math.pi) * r_substratum * (-depth) * ((inv_cos_theta_0*du_bottom_dnap*kappa+(a_nap_star+bb_nap_star)*(inv_cos_theta_w + du_bottom_scaled)) * expBottomScaled)
+
+        return ForwardModelResults(
+            r_substratum=r_substratum,
+            rrs=rrs,
+            rrsdp=rrsdp,
+            r_0_minus=rrs * q_factor,
+            rdp_0_minus=rrsdp * q_factor,
+            kd=kd,
+            kub=kub,
+            kuc=kuc,
+            a=a,
+            a_ph_star=a_ph_star,
+            a_cdom_star=a_cdom_star,
+            a_nap_star=a_nap_star,
+            a_ph=a_ph,
+            a_cdom=a_cdom,
+            a_nap=a_nap,
+            a_water=a_water,
+            bb=bb,
+            bb_ph_star=bb_ph_star,
+            bb_nap_star=bb_nap_star,
+            bb_ph=bb_ph,
+            bb_nap=bb_nap,
+            bb_water=bb_water,
+            rrs_dchl=rrs_dchl,
+            rrs_dcdom=rrs_dcdom,
+            rrs_dnap=rrs_dnap,
+            rrs_ddepth=rrs_ddepth,
+            rrs_dfrac1=rrs_dfrac1,
+            rrs_dfrac2=rrs_dfrac2,
+            rrs_dfrac3=rrs_dfrac3
+        )
+
+    def _evaluate_deep(
+            self,
+            chl,
+            cdom,
+            nap,
+            depth,
+            sub1_frac,
+            sub2_frac,
+            sub3_frac,
+            compute_jacobian=True):
+        """Optically-deep model kernel, for (N, 1) columns of parameters.
+
+        The results are those of _evaluate with the attenuation terms
+        expColumnScaled and expBottomScaled set to zero.
+        """
+        # pylint: disable=unused-argument
+        terms = self.water_column(chl[:, 0], cdom[:, 0], nap[:, 0])
+        kappa = terms.kappa
+        u = terms.u
+        bb = terms.bb
+        r_substratum = sub1_frac * self.substrate1 + \
+            sub2_frac * self.substrate2 + sub3_frac * self.substrate3
+        rrs = terms.rrsdp
+
+        rrs_dchl = rrs_dcdom = rrs_dnap = rrs_ddepth = None
+        rrs_dfrac1 = rrs_dfrac2 = rrs_dfrac3 = None
+        if compute_jacobian:
+            # The derivatives of rrsdp, as in _evaluate
+            a_ph_star = self.a_ph_star
+            bb_ph_star = self.bb_ph_star
+            a_nap_star = self.a_nap_star
+            bb_nap_star = self.bb_nap_star
+            u_dcdom = -(bb*self.a_cdom_star/(kappa*kappa))
+            rrs_dcdom = (0.084*u_dcdom+0.34*u*u_dcdom)
+            u_dchl = (bb_ph_star*kappa-bb*(a_ph_star+bb_ph_star))/(kappa*kappa)
+            rrs_dchl = (0.084*u_dchl+0.34*u*u_dchl)
+            u_dnap = (bb_nap_star*kappa-bb*(a_nap_star+bb_nap_star))/(kappa*kappa)
+            rrs_dnap = (0.084*u_dnap+0.34*u*u_dnap)
+            rrs_ddepth = np.zeros_like(rrs)
+            rrs_dfrac1 = np.zeros_like(rrs)
+            rrs_dfrac2 = np.zeros_like(rrs)
+            rrs_dfrac3 = np.zeros_like(rrs)
+
+        return ForwardModelResults(
+            r_substratum=r_substratum,
+            rrs=rrs,
+            rrsdp=terms.rrsdp,
+            r_0_minus=rrs * self.q_factor,
+            rdp_0_minus=terms.rrsdp * self.q_factor,
+            kd=terms.kd,
+            kub=terms.kub,
+            kuc=terms.kuc,
+            a=terms.a,
+            a_ph_star=self.a_ph_star,
+            a_cdom_star=self.a_cdom_star,
+            a_nap_star=self.a_nap_star,
+            a_ph=chl * self.a_ph_star,
+            a_cdom=cdom * self.a_cdom_star,
+            a_nap=nap * self.a_nap_star,
+            a_water=self.a_water,
+            bb=bb,
+            bb_ph_star=self.bb_ph_star,
+            bb_nap_star=self.bb_nap_star,
+            bb_ph=chl * self.bb_ph_star,
+            bb_nap=nap * self.bb_nap_star,
+            bb_water=self.bb_water,
+            rrs_dchl=rrs_dchl,
+            rrs_dcdom=rrs_dcdom,
+            rrs_dnap=rrs_dnap,
+            rrs_ddepth=rrs_ddepth,
+            rrs_dfrac1=rrs_dfrac1,
+            rrs_dfrac2=rrs_dfrac2,
+            rrs_dfrac3=rrs_dfrac3
+        )
+
+    @staticmethod
+    def _patch(results, rows, patch):
+        """Overwrites rows of batched results with other results.
+
+        Args:
+            results (ForwardModelResults): Results of the whole batch, which
+                are updated in place.
+            rows (numpy.ndarray): The indices of the rows to overwrite.
+            patch (ForwardModelResults): Results of those rows.
+        """
+        fields = list(results)
+        written = set()
+        for i, (field, value) in enumerate(zip(results, patch)):
+            if field is None or field.ndim == 1:
+                # Missing, or a parameter-independent context term
+                continue
+            if id(field) in written:
+                # Fields may share an array, such as rrs and rrsdp of the
+                # optically-deep kernel.
+                field = fields[i] = field.copy()
+            written.add(id(field))
+            field[rows] = value
+        return ForwardModelResults._make(fields)
+
+    def _bottom_log_derivatives(self, results, depth):
+        """Derivatives of the log bottom attenuation term of the model.
+
+        The substrate contribution to rrs is r_substratum * expBottomScaled /
+        pi, so its derivative with respect to chl, cdom, nap or depth is that
+        contribution times the derivative of log(expBottomScaled) returned
+        here. This lets callers correct the Jacobian for a change in the
+        substrate fractions without re-evaluating the model.
+
+        Args:
+            results (ForwardModelResults): Batched results from
+                evaluate_batch.
+            depth (array-like): The depths the results were evaluated at,
+                shape (N,).
+
+        Returns:
+            numpy.ndarray: The derivatives, with shape (N, num_bands, 4) and
+                the last axis ordered chl, cdom, nap, depth.
+        """
+        depth = np.asarray(depth)[:, np.newaxis]
+        kappa = results.a + results.bb
+        u = results.bb / kappa
+        du_bottom_scaled = results.kub / kappa
+        sq2 = du_bottom_scaled / (1.04 * self.inv_cos_theta_0)
+        path = self.inv_cos_theta_w + du_bottom_scaled
+
+        derivatives = []
+        for a_star, bb_star in ((self.a_ph_star, self.bb_ph_star),
+                                (self.a_cdom_star, 0.0),
+                                (self.a_nap_star, self.bb_nap_star)):
+            kappa_dx = a_star + bb_star
+            u_dx = (bb_star - u * kappa_dx) / kappa
+            du_bottom_dx = 1.04 * 5.4 * u_dx / (2.0 * sq2)
+            derivatives.append(
+                -depth * (self.inv_cos_theta_0 * du_bottom_dx * kappa +
+                          kappa_dx * path))
+        derivatives.append(-(results.kd + results.kub))
+        return np.stack(derivatives, axis=-1)
+
+
 def forward_model(
         chl,
         cdom,
@@ -119,11 +1169,17 @@ def forward_model(
         water_refractive_index=None,
         theta_air=None,
         off_nadir=None,
-        q_factor=None):
+        q_factor=None,
+        compute_jacobian=True,
+        dtype=np.float64):
     """Semi-analytical Lee/Sambuca forward model.
 
     TODO: Extended description goes here.
 
+    Each call builds a :class:`ForwardModelContext`. Client code that evaluates
+    the model repeatedly with the same SIOPs, substrates and geometry should
+    build the context once and call its evaluate method instead.
+
     TODO: For those arguments which have units, the units should be stated.
 
     Args:
@@ -164,154 +1220,140 @@ def forward_model(
         off_nadir (float, optional): off-nadir angle.
         q_factor (float, optional): q value for producing the R(0-) values from
             modelled remotely-sensed reflectance (rrs) values.
+        compute_jacobian (bool, optional): If true (the default), the
+            derivatives of rrs with respect to the free parameters (rrs_dchl,
+            rrs_dcdom, rrs_dnap, rrs_ddepth and rrs_dfrac1..3) are calculated.
+            Callers that only need rrs should pass False, which skips more
+            than half of the floating-point work. The derivative fields are
+            then None in the results.
+        dtype (numpy.dtype, optional): The floating-point precision of the
+            model, either numpy.float64 (the default) or numpy.float32.
+            Single precision halves the memory footprint of the model arrays
+            and is accurate to within the tolerances of the IDL reference data,
+            which is itself effectively single precision.
 
     Returns:
         ForwardModelResults: A namedtuple containing the model outputs.
     """
 
-    assert len(substrate1) == num_bands
-    if substrate2 is not None:
-        assert len(substrate2) == num_bands
-    if substrate3 is not None:
-        assert len(substrate2) == num_bands
-    assert len(wavelengths) == num_bands
-    assert len(a_water) == num_bands
-    assert len(a_ph_star) == num_bands
-
-    # Sub-surface solar zenith angle in radians
-    inv_refractive_index = 1.0 / water_refractive_index
-    theta_w = \
-        math.asin(inv_refractive_index * math.sin(math.radians(theta_air)))
-
-    # Sub-surface viewing angle in radians
-    theta_o = \
-        math.asin(inv_refractive_index * math.sin(math.radians(off_nadir)))
-
-    # Calculate derived SIOPS, based on
-    # Mobley, Curtis D., 1994: Radiative Transfer in natural waters.
-    bb_water = (0.00194 / 2.0) * np.power(bb_lambda_ref / wavelengths, 4.32)
-    a_cdom_star = a_cdom_lambda0cdom * \
-        np.exp(-a_cdom_slope * (wavelengths - lambda0cdom))
-    a_nap_star = a_nap_lambda0nap * \
-        np.exp(-a_nap_slope * (wavelengths - lambda0nap))
-
-    # Calculate backscatter
-    backscatter = np.power(lambda0x / wavelengths, bb_ph_slope)
-    # specific backscatter due to phytoplankton
-    bb_ph_star = x_ph_lambda0x * backscatter
-    # specific backscatter due to NAP
-     # If a bb_nap_slope value has been supplied, use it.
-     # Otherwise, reuse bb_ph_slope.
-    if bb_nap_slope:
-        backscatter = np.power(lambda0x / wavelengths, bb_nap_slope)
-    bb_nap_star = x_nap_lambda0x * backscatter
-
-    # Total absorption
-    a_ph = chl * a_ph_star
-    a_cdom = cdom * a_cdom_star
-    a_nap = nap * a_nap_star
-    a = a_water + a_ph + a_cdom + a_nap
-
-    # Total backscatter
-    bb_ph = chl * bb_ph_star
-    bb_nap = nap * bb_nap_star
-    bb = bb_water + bb_ph + bb_nap
-
-    # Calculate total bottom reflectance from the two substrates
-    #r_substratum = substrate1
-    #if substrate2 is not None:
-        #r_substratum = substrate_fraction * substrate1 + \
-        #(1. - substrate_fraction) * substrate2
-        
-    # Calculate bottom reflectance from 3 subs (BOMBER etc)
-    
-    r_substratum = sub1_frac * substrate1 + sub2_frac * substrate2 + sub3_frac * substrate3
-
-    # TODO: what are u and kappa?
-    kappa = a + bb
-    u = bb / kappa
-
-    # Optical path elongation for scattered photons
-    # elongation from water column
-    # TODO: reference to the paper from which these equations are derived
-    du_column = 1.03 * np.power(1.00 + (2.40 * u), 0.50)
-    # elongation from bottom
-    du_bottom = 1.04 * np.power(1.00 + (5.40 * u), 0.50)
-
-    # Remotely sensed sub-surface reflectance for optically deep water
-    rrsdp = (0.084 + 0.17 * u) * u
-
-    # common terms in the following calculations
-    inv_cos_theta_w = 1.0 / math.cos(theta_w)
-    inv_cos_theta_0 = 1.0 / math.cos(theta_o)
-    du_column_scaled = du_column * inv_cos_theta_0
-    du_bottom_scaled = du_bottom * inv_cos_theta_0
-
-    # TODO: descriptions of kd, kuc, kub
-    kd = kappa * inv_cos_theta_w
-    kuc = kappa * du_column_scaled
-    kub = kappa * du_bottom_scaled
-
-    # Remotely sensed reflectance
-    kappa_d = kappa * depth
-    rrs = (rrsdp *
-           (1.0 - np.exp(-(inv_cos_theta_w + du_column_scaled) * kappa_d)) +
-           ((1.0 / math.pi) * r_substratum *
-            np.exp(-(inv_cos_theta_w + du_bottom_scaled) * kappa_d)))
-	
-	#jacobian
-    expBottomScaled = np.exp(-(inv_cos_theta_w + du_bottom_scaled) * kappa_d)
-    expColumnScaled = np.exp(-(inv_cos_theta_w + du_column_scaled) * kappa_d)
-    rrs_dfrac1 = (1.0 / math.pi) * substrate1 * expBottomScaled
-    rrs_dfrac2 = (1.0 / math.pi) * substrate2 *expBottomScaled
-    rrs_dfrac3 = (1.0 / math.pi) * substrate3 *expBottomScaled
-    sq1= np.power(1.00 + (2.40 * u), 0.50)
-    sq2= np.power(1.00 + (5.40 * u), 0.50)
-    rrs_ddepth = rrsdp *(inv_cos_theta_w + du_column_scaled)* kappa*expColumnScaled - (1.0 / math.pi) * r_substratum *(inv_cos_theta_w + du_bottom_scaled)*kappa*expBottomScaled
-    u_dcdom = -(bb*a_cdom_star/(kappa*kappa))
-    du_column_dcdom = 1.03*2.4*u_dcdom/(2.0*sq1)
-    du_bottom_dcdom = 1.04*5.4*u_dcdom/(2.0*sq2)
-    rrs_dcdom = (0.084*u_dcdom+0.34*u*u_dcdom)*(1.0 - expColumnScaled) +rrsdp*depth*((inv_cos_theta_0*du_column_dcdom*kappa+a_cdom_star*(inv_cos_theta_w + du_column_scaled)) * expColumnScaled) +(1.0 / math.pi) * r_substratum * (-depth) * ((inv_cos_theta_0*du_bottom_dcdom*(a+bb)+a_cdom_star*(inv_cos_theta_w + du_bottom_scaled)) * expBottomScaled)
-    u_dchl = (bb_ph_star*(a+bb)-bb*(a_ph_star+bb_ph_star))/(kappa*kappa)
-    du_column_dchl = 1.03*2.4*u_dchl/(2.0*sq1)
-    du_bottom_dchl = 1.04*5.4*u_dchl/(2.0*sq2)
-    rrs_dchl = (0.084*u_dchl+0.34*u*u_dchl)*(1.0 - expColumnScaled) +rrsdp*depth*((inv_cos_theta_0*du_column_dchl*kappa+(a_ph_star+bb_ph_star)*(inv_cos_theta_w + du_column_scaled)) * expColumnScaled) +(1.0 / math.pi) * r_substratum * (-depth) * ((inv_cos_theta_0*du_bottom_dchl*(a+bb)+(a_ph_star+bb_ph_star)*(inv_cos_theta_w + du_bottom_scaled)) * expBottomScaled)
-    u_dnap = (bb_nap_star*(a+bb)-bb*(a_nap_star+bb_nap_star))/(kappa*kappa)
-    du_column_dnap = 1.03*2.4*u_dnap/(2.0*sq1)
-    du_bottom_dnap = 1.04*5.4*u_dnap/(2.0*sq2)
-    rrs_dnap = (0.084*u_dnap+0.34*u*u_dnap)*(1.0 - expColumnScaled) +rrsdp*depth*((inv_cos_theta_0*du_column_dnap*(a+bb)+(a_nap_star+bb_nap_star)*(inv_cos_theta_w + du_column_scaled)) * expColumnScaled) +(1.0 / math.pi) * r_substratum * (-depth) * ((inv_cos_theta_0*du_bottom_dnap*(a+bb)+(a_nap_star+bb_nap_star)*(inv_cos_theta_w + du_bottom_scaled)) * expBottomScaled)			
-    return ForwardModelResults(
-        r_substratum=r_substratum,
-        rrs=rrs,
-        rrsdp=rrsdp,
-        r_0_minus=rrs * q_factor,
-        rdp_0_minus=rrsdp * q_factor,
-        kd=kd,
-        kub=kub,
-        kuc=kuc,
-        a=a,
+    context = ForwardModelContext(
+        substrate1=substrate1,
+        substrate2=substrate2,
+        substrate3=substrate3,
+        wavelengths=wavelengths,
+        a_water=a_water,
         a_ph_star=a_ph_star,
-        a_cdom_star=a_cdom_star,
-        a_nap_star=a_nap_star,
-        a_ph=a_ph,
-        a_cdom=a_cdom,
-        a_nap=a_nap,
+        num_bands=num_bands,
+        a_cdom_slope=a_cdom_slope,
+        a_nap_slope=a_nap_slope,
+        bb_ph_slope=bb_ph_slope,
+        bb_nap_slope=bb_nap_slope,
+        lambda0cdom=lambda0cdom,
+        lambda0nap=lambda0nap,
+        lambda0x=lambda0x,
+        x_ph_lambda0x=x_ph_lambda0x,
+        x_nap_lambda0x=x_nap_lambda0x,
+        a_cdom_lambda0cdom=a_cdom_lambda0cdom,
+        a_nap_lambda0nap=a_nap_lambda0nap,
+        bb_lambda_ref=bb_lambda_ref,
+        water_refractive_index=water_refractive_index,
+        theta_air=theta_air,
+        off_nadir=off_nadir,
+        q_factor=q_factor,
+        dtype=dtype)
+    return context.evaluate(
+        chl, cdom, nap, depth, sub1_frac, sub2_frac, sub3_frac,
+        compute_jacobian)
+
+
+def forward_model_batch(
+        chl,
+        cdom,
+        nap,
+        depth,
+        sub1_frac,
+        sub2_frac,
+        sub3_frac,
+        substrate1,
+        substrate2,
+        substrate3,
+        wavelengths,
+        a_water,
+        a_ph_star,
+        num_bands,
+        a_cdom_slope=None,
+        a_nap_slope=None,
+        bb_ph_slope=None,
+        bb_nap_slope=None,
+        lambda0cdom=None,
+        lambda0nap=None,
+        lambda0x=None,
+        x_ph_lambda0x=None,
+        x_nap_lambda0x=None,
+        a_cdom_lambda0cdom=None,
+        a_nap_lambda0nap=None,
+        bb_lambda_ref=None,
+        water_refractive_index=None,
+        theta_air=None,
+        off_nadir=None,
+        q_factor=None,
+        compute_jacobian=True,
+        dtype=np.float64):
+    """Batched (multi-pixel) version of the forward model.
+
+    The free parameters (chl, cdom, nap, depth and the substrate fractions)
+    are vectors of shape (N,), or scalars that are broadcast across the batch.
+    Every other argument is identical to :func:`forward_model`, and the SIOP
+    setup is performed once for the whole batch.
+
+    Args:
+        chl (array-like): Chlorophyll concentrations, shape (N,).
+        cdom (array-like): CDOM concentrations, shape (N,).
+        nap (array-like): NAP concentrations, shape (N,).
+        depth (array-like): Water column depths, shape (N,).
+        sub1_frac (array-like): Proportions of substrate1, shape (N,).
+        sub2_frac (array-like): Proportions of substrate2, shape (N,).
+        sub3_frac (array-like): Proportions of substrate3, shape (N,).
+
+        All remaining arguments are as documented for :func:`forward_model`.
+
+    Returns:
+        ForwardModelResults: A namedtuple containing the model outputs, where
+            every field has shape (N, num_bands). Fields that do not depend on
+            the free parameters (such as a_water or bb_water) are returned as
+            read-only broadcast views rather than copies.
+    """
+
+    context = ForwardModelContext(
+        substrate1=substrate1,
+        substrate2=substrate2,
+        substrate3=substrate3,
+        wavelengths=wavelengths,
         a_water=a_water,
-        bb=bb,
-        bb_ph_star=bb_ph_star,
-        bb_nap_star=bb_nap_star,
-        bb_ph=bb_ph,
-        bb_nap=bb_nap,
-        bb_water=bb_water,
-		rrs_dchl=rrs_dchl,
-		rrs_dcdom=rrs_dcdom,
-		rrs_dnap=rrs_dnap,
-		rrs_ddepth=rrs_ddepth,
-		rrs_dfrac1=rrs_dfrac1,
-		rrs_dfrac2=rrs_dfrac2,
-		rrs_dfrac3=rrs_dfrac3
-    )
+        a_ph_star=a_ph_star,
+        num_bands=num_bands,
+        a_cdom_slope=a_cdom_slope,
+        a_nap_slope=a_nap_slope,
+        bb_ph_slope=bb_ph_slope,
+        bb_nap_slope=bb_nap_slope,
+        lambda0cdom=lambda0cdom,
+        lambda0nap=lambda0nap,
+        lambda0x=lambda0x,
+        x_ph_lambda0x=x_ph_lambda0x,
+        x_nap_lambda0x=x_nap_lambda0x,
+        a_cdom_lambda0cdom=a_cdom_lambda0cdom,
+        a_nap_lambda0nap=a_nap_lambda0nap,
+        bb_lambda_ref=bb_lambda_ref,
+        water_refractive_index=water_refractive_index,
+        theta_air=theta_air,
+        off_nadir=off_nadir,
+        q_factor=q_factor,
+        dtype=dtype)
+    return context.evaluate_batch(
+        chl, cdom, nap, depth, sub1_frac, sub2_frac, sub3_frac,
+        compute_jacobian)
 
 # pylint: enable=too-many-arguments
 # pylint: enable=invalid-name
 # pylint: enable=too-many-locals
+# pylint: enable=too-many-instance-attributes
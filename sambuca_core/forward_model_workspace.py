@@ -0,0 +1,377 @@
+# -*- coding: utf-8 -*-
+"""Allocation-free evaluation of the Lee/Sambuca forward model. """
+
+from __future__ import (
+    absolute_import,
+    division,
+    print_function,
+    unicode_literals)
+from builtins import *
+import math
+
+import numpy as np
+
+from .forward_model import (
+    FREE_PARAMETERS,
+    JACOBIAN_FIELDS,
+    ForwardModelResults,
+)
+
+# ForwardModelResults fields that are copies of parameter-independent context
+# terms, and so are never written by the workspace kernel.
+_CONTEXT_FIELDS = (
+    'a_ph_star',
+    'a_cdom_star',
+    'a_nap_star',
+    'a_water',
+    'bb_ph_star',
+    'bb_nap_star',
+    'bb_water',
+)
+
+# Scratch arrays used by the kernel.
+_SCRATCH_NAMES = (
+    'kappa',
+    'kappa2',
+    'u',
+    'sq1',
+    'sq2',
+    'du_column_scaled',
+    'du_bottom_scaled',
+    'column_path',
+    'bottom_path',
+    'exp_column',
+    'exp_bottom',
+    'one_minus_exp_column',
+    'r_scaled',
+    'rrsdp_depth',
+    'r_scaled_neg_depth',
+    'u_dx',
+    't1',
+    't2',
+)
+
+
+# pylint: disable=too-many-instance-attributes
+# pylint: disable=too-many-arguments
+# Disabling invalid-name as many of the common (and published) variable names
+# in the Sambuca model are invalid according to Python conventions.
+# pylint: disable=invalid-name
+class ForwardModelWorkspace(object):
+    """Preallocated output and scratch buffers for the forward model.
+
+    A workspace evaluates the same model as
+    :meth:`ForwardModelContext.evaluate` (or evaluate_batch when a batch size
+    is given), but every intermediate and output array is allocated once,
+    when the workspace is created. Each evaluation overwrites the buffers in
+    place using ufuncs with out= arguments, so a steady-state inversion loop
+    performs no array allocations per model evaluation.
+
+    The arrays in the returned results are owned by the workspace and are
+    overwritten by the next call to evaluate. Copy any values that must
+    outlive the next evaluation.
+
+    Args:
+        context (ForwardModelContext): The parameter-independent model state.
+        batch_size (int, optional): If supplied, evaluate accepts parameter
+            vectors of shape (batch_size,), and every result field has shape
+            (batch_size, num_bands). Otherwise evaluate accepts scalars and the
+            results have shape (num_bands,).
+        compute_jacobian (bool, optional): If true (the default), the rrs_d*
+            derivatives are calculated. Otherwise they are None in the
+            results, and their buffers are not allocated.
+
+    Attributes:
+        context (ForwardModelContext): The model context.
+        batch_size (int): The batch size, or None for scalar evaluation.
+        shape (tuple): The shape of every result field.
+        results (ForwardModelResults): The result buffers.
+    """
+
+    def __init__(self, context, batch_size=None, compute_jacobian=True):
+        self.context = context
+        self.batch_size = batch_size
+        self.compute_jacobian = compute_jacobian
+
+        num_bands = context.num_bands
+        if batch_size is None:
+            self.shape = (num_bands,)
+            parameter_shape = ()
+        else:
+            self.shape = (batch_size, num_bands)
+            parameter_shape = (batch_size, 1)
+        dtype = context.dtype
+
+        # Parameter buffers. In batch mode each parameter is copied into an
+        # (N, 1) column and then expanded across the bands, so that every
+        # ufunc in the kernel operates on equal-shaped contiguous arrays.
+        # Broadcasting ufuncs make numpy allocate iteration buffers, while a
+        # broadcasting copyto does not. In scalar mode the parameters are
+        # 0-d arrays used directly by the kernel.
+        self._parameter_columns = [np.zeros(parameter_shape, dtype=dtype)
+                                   for _ in FREE_PARAMETERS]
+        if batch_size is None:
+            self._parameters = self._parameter_columns
+            self._parameter_targets = self._parameter_columns
+        else:
+            self._parameters = [np.zeros(self.shape, dtype=dtype)
+                                for _ in FREE_PARAMETERS]
+            self._parameter_targets = [
+                p[:, 0] for p in self._parameter_columns]
+
+        self._scratch = dict(
+            (name, np.empty(self.shape, dtype=dtype))
+            for name in _SCRATCH_NAMES)
+
+        # Parameter-independent spectral terms used by the kernel, expanded
+        # to the full result shape for the same reason.
+        inv_pi = 1.0 / math.pi
+        spectral = dict(
+            (name, getattr(context, name)) for name in _CONTEXT_FIELDS)
+        spectral.update(
+            substrate1=context.substrate1,
+            substrate2=context.substrate2,
+            substrate3=context.substrate3,
+            inv_pi_substrate1=inv_pi * context.substrate1,
+            inv_pi_substrate2=inv_pi * context.substrate2,
+            inv_pi_substrate3=inv_pi * context.substrate3,
+            kappa_dchl=context.a_ph_star + context.bb_ph_star,
+            kappa_dnap=context.a_nap_star + context.bb_nap_star)
+        self._spectral = dict(
+            (name, np.array(np.broadcast_to(value, self.shape),
+                            dtype=dtype, order='C'))
+            for name, value in spectral.items())
+
+        fields = {}
+        for name in ForwardModelResults._fields:
+            if name in _CONTEXT_FIELDS:
+                value = getattr(context, name)
+                fields[name] = value if batch_size is None \
+                    else np.broadcast_to(value, self.shape)
+            elif name in JACOBIAN_FIELDS and not compute_jacobian:
+                fields[name] = None
+            else:
+                fields[name] = np.empty(self.shape, dtype=dtype)
+        self.results = ForwardModelResults(**fields)
+
+    def evaluate(
+            self,
+            chl,
+            cdom,
+            nap,
+            depth,
+            sub1_frac,
+            sub2_frac,
+            sub3_frac):
+        """Evaluates the forward model into the workspace buffers.
+
+        Args:
+            chl (float or array-like): Concentration of chlorophyll.
+            cdom (float or array-like): Concentration of CDOM.
+            nap (float or array-like): Concentration of NAP.
+            depth (float or array-like): Water column depth.
+            sub1_frac (float or array-like): Proportion of substrate1.
+            sub2_frac (float or array-like): Proportion of substrate2.
+            sub3_frac (float or array-like): Proportion of substrate3.
+
+            In batch mode, each parameter is a vector of shape (batch_size,)
+            or a scalar that is broadcast across the batch.
+
+        Returns:
+            ForwardModelResults: The workspace results, overwritten in place.
+        """
+        for target, value in zip(
+                self._parameter_targets,
+                (chl, cdom, nap, depth, sub1_frac, sub2_frac, sub3_frac)):
+            np.copyto(target, value)
+        if self.batch_size is not None:
+            for parameter, column in zip(
+                    self._parameters, self._parameter_columns):
+                np.copyto(parameter, column)
+
+        self._evaluate()
+        return self.results
+
+    # pylint: disable=too-many-locals
+    # pylint: disable=too-many-statements
+    def _evaluate(self):
+        """In-place model kernel. """
+        context = self.context
+        c = self._spectral
+        r = self.results
+        s = self._scratch
+        chl, cdom, nap, depth, sub1_frac, sub2_frac, sub3_frac = \
+            self._parameters
+        inv_cos_theta_w = context.inv_cos_theta_w
+        inv_cos_theta_0 = context.inv_cos_theta_0
+        kappa = s['kappa']
+        u = s['u']
+        t1 = s['t1']
+
+        # Total absorption
+        np.multiply(chl, c['a_ph_star'], out=r.a_ph)
+        np.multiply(cdom, c['a_cdom_star'], out=r.a_cdom)
+        np.multiply(nap, c['a_nap_star'], out=r.a_nap)
+        np.add(c['a_water'], r.a_ph, out=r.a)
+        np.add(r.a, r.a_cdom, out=r.a)
+        np.add(r.a, r.a_nap, out=r.a)
+
+        # Total backscatter
+        np.multiply(chl, c['bb_ph_star'], out=r.bb_ph)
+        np.multiply(nap, c['bb_nap_star'], out=r.bb_nap)
+        np.add(c['bb_water'], r.bb_ph, out=r.bb)
+        np.add(r.bb, r.bb_nap, out=r.bb)
+
+        # Bottom reflectance from the three substrates
+        np.multiply(sub1_frac, c['substrate1'], out=r.r_substratum)
+        np.multiply(sub2_frac, c['substrate2'], out=t1)
+        np.add(r.r_substratum, t1, out=r.r_substratum)
+        np.multiply(sub3_frac, c['substrate3'], out=t1)
+        np.add(r.r_substratum, t1, out=r.r_substratum)
+
+        np.add(r.a, r.bb, out=kappa)
+        np.divide(r.bb, kappa, out=u)
+
+        # Optical path elongation for scattered photons
+        np.multiply(u, 2.40, out=s['sq1'])
+        np.add(s['sq1'], 1.00, out=s['sq1'])
+        np.power(s['sq1'], 0.50, out=s['sq1'])
+        np.multiply(u, 5.40, out=s['sq2'])
+        np.add(s['sq2'], 1.00, out=s['sq2'])
+        np.power(s['sq2'], 0.50, out=s['sq2'])
+        np.multiply(s['sq1'], 1.03, out=s['du_column_scaled'])
+        np.multiply(
+            s['du_column_scaled'],
+            inv_cos_theta_0,
+            out=s['du_column_scaled'])
+        np.multiply(s['sq2'], 1.04, out=s['du_bottom_scaled'])
+        np.multiply(
+            s['du_bottom_scaled'],
+            inv_cos_theta_0,
+            out=s['du_bottom_scaled'])
+
+        # Remotely sensed sub-surface reflectance for optically deep water
+        np.multiply(u, 0.17, out=r.rrsdp)
+        np.add(r.rrsdp, 0.084, out=r.rrsdp)
+        np.multiply(r.rrsdp, u, out=r.rrsdp)
+
+        np.multiply(kappa, inv_cos_theta_w, out=r.kd)
+        np.multiply(kappa, s['du_column_scaled'], out=r.kuc)
+        np.multiply(kappa, s['du_bottom_scaled'], out=r.kub)
+
+        # Attenuation along the water column and bottom paths
+        np.add(s['du_column_scaled'], inv_cos_theta_w, out=s['column_path'])
+        np.add(s['du_bottom_scaled'], inv_cos_theta_w, out=s['bottom_path'])
+        np.multiply(kappa, depth, out=t1)
+        np.multiply(s['column_path'], t1, out=s['exp_column'])
+        np.negative(s['exp_column'], out=s['exp_column'])
+        np.exp(s['exp_column'], out=s['exp_column'])
+        np.multiply(s['bottom_path'], t1, out=s['exp_bottom'])
+        np.negative(s['exp_bottom'], out=s['exp_bottom'])
+        np.exp(s['exp_bottom'], out=s['exp_bottom'])
+
+        # Remotely sensed reflectance
+        np.subtract(1.0, s['exp_column'], out=s['one_minus_exp_column'])
+        np.multiply(r.rrsdp, s['one_minus_exp_column'], out=r.rrs)
+        np.multiply(1.0 / math.pi, r.r_substratum, out=s['r_scaled'])
+        np.multiply(s['r_scaled'], s['exp_bottom'], out=t1)
+        np.add(r.rrs, t1, out=r.rrs)
+
+        np.multiply(r.rrs, context.q_factor, out=r.r_0_minus)
+        np.multiply(r.rrsdp, context.q_factor, out=r.rdp_0_minus)
+
+        if self.compute_jacobian:
+            self._evaluate_jacobian()
+
+    def _evaluate_jacobian(self):
+        """In-place calculation of the rrs_d* derivatives. """
+        c = self._spectral
+        r = self.results
+        s = self._scratch
+        depth = self._parameters[3]
+        kappa = s['kappa']
+        t1 = s['t1']
+
+        # Substrate fractions
+        for out, name in zip(
+                (r.rrs_dfrac1, r.rrs_dfrac2, r.rrs_dfrac3),
+                ('inv_pi_substrate1', 'inv_pi_substrate2',
+                 'inv_pi_substrate3')):
+            np.multiply(c[name], s['exp_bottom'], out=out)
+
+        # Depth
+        np.multiply(r.rrsdp, s['column_path'], out=r.rrs_ddepth)
+        np.multiply(r.rrs_ddepth, kappa, out=r.rrs_ddepth)
+        np.multiply(r.rrs_ddepth, s['exp_column'], out=r.rrs_ddepth)
+        np.multiply(s['r_scaled'], s['bottom_path'], out=t1)
+        np.multiply(t1, kappa, out=t1)
+        np.multiply(t1, s['exp_bottom'], out=t1)
+        np.subtract(r.rrs_ddepth, t1, out=r.rrs_ddepth)
+
+        # Terms shared by the concentration derivatives
+        np.multiply(kappa, kappa, out=s['kappa2'])
+        np.multiply(r.rrsdp, depth, out=s['rrsdp_depth'])
+        np.multiply(s['r_scaled'], depth, out=s['r_scaled_neg_depth'])
+        np.negative(s['r_scaled_neg_depth'], out=s['r_scaled_neg_depth'])
+
+        self._concentration_derivative(
+            r.rrs_dchl, c['bb_ph_star'], c['kappa_dchl'])
+        self._concentration_derivative(
+            r.rrs_dcdom, None, c['a_cdom_star'])
+        self._concentration_derivative(
+            r.rrs_dnap, c['bb_nap_star'], c['kappa_dnap'])
+
+    def _concentration_derivative(self, out, bb_star, kappa_dx):
+        """Derivative of rrs with respect to a concentration x, where
+        d(bb)/dx = bb_star and d(kappa)/dx = kappa_dx.
+        """
+        context = self.context
+        r = self.results
+        s = self._scratch
+        kappa = s['kappa']
+        u_dx = s['u_dx']
+        t1 = s['t1']
+        t2 = s['t2']
+
+        # u = bb / kappa
+        np.multiply(r.bb, kappa_dx, out=u_dx)
+        if bb_star is None:
+            np.negative(u_dx, out=u_dx)
+        else:
+            np.multiply(bb_star, kappa, out=t1)
+            np.subtract(t1, u_dx, out=u_dx)
+        np.divide(u_dx, s['kappa2'], out=u_dx)
+
+        # deep water reflectance term
+        np.multiply(s['u'], 0.34, out=t1)
+        np.add(t1, 0.084, out=t1)
+        np.multiply(t1, u_dx, out=t1)
+        np.multiply(t1, s['one_minus_exp_column'], out=out)
+
+        # water column attenuation term
+        np.multiply(u_dx, 1.03 * 2.4 / 2.0, out=t1)
+        np.divide(t1, s['sq1'], out=t1)
+        np.multiply(t1, context.inv_cos_theta_0, out=t1)
+        np.multiply(t1, kappa, out=t1)
+        np.multiply(kappa_dx, s['column_path'], out=t2)
+        np.add(t1, t2, out=t1)
+        np.multiply(t1, s['exp_column'], out=t1)
+        np.multiply(t1, s['rrsdp_depth'], out=t1)
+        np.add(out, t1, out=out)
+
+        # bottom attenuation term
+        np.multiply(u_dx, 1.04 * 5.4 / 2.0, out=t1)
+        np.divide(t1, s['sq2'], out=t1)
+        np.multiply(t1, context.inv_cos_theta_0, out=t1)
+        np.multiply(t1, kappa, out=t1)
+        np.multiply(kappa_dx, s['bottom_path'], out=t2)
+        np.add(t1, t2, out=t1)
+        np.multiply(t1, s['exp_bottom'], out=t1)
+        np.multiply(t1, s['r_scaled_neg_depth'], out=t1)
+        np.add(out, t1, out=out)
+    # pylint: enable=too-many-locals
+    # pylint: enable=too-many-statements
+
+# pylint: enable=too-many-instance-attributes
+# pylint: enable=too-many-arguments
+# pylint: enable=invalid-name
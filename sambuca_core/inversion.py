@@ -0,0 +1,603 @@
+# -*- coding: utf-8 -*-
+""" Batched, bounded least-squares inversion of the forward model.
+
+The inversion uses a vectorised Levenberg-Marquardt solver driven by the
+analytic Jacobian of the forward model. All pixels of a batch are iterated in
+lockstep, and pixels drop out of the active set as they converge.
+"""
+
+from __future__ import (
+    absolute_import,
+    division,
+    print_function,
+    unicode_literals)
+from builtins import *
+
+from collections import namedtuple
+import itertools
+
+import numpy as np
+
+from .forward_model import (
+    FREE_PARAMETERS,
+    ForwardModelResults,
+    JACOBIAN_FIELDS,
+    _LINEARISATION_SAFETY,
+)
+
+# Columns of the parameter arrays holding the substrate fractions
+_FRACTIONS = slice(4, 7)
+
+DEFAULT_LOWER_BOUNDS = (0.0, 0.0, 0.0, 0.0, 0.0, 0.0, 0.0)
+""" Default lower bounds of the free parameters, ordered as FREE_PARAMETERS.
+"""
+
+DEFAULT_UPPER_BOUNDS = (np.inf, np.inf, np.inf, np.inf, 1.0, 1.0, 1.0)
+""" Default upper bounds of the free parameters, ordered as FREE_PARAMETERS.
+"""
+
+InversionResults = namedtuple('InversionResults',
+                              [
+                                  'parameters',
+                                  'cost',
+                                  'iterations',
+                                  'evaluations',
+                                  'converged',
+                                  'damping',
+                              ])
+""" namedtuple containing the results of a batched inversion.
+
+Attributes:
+    parameters (numpy.ndarray): The fitted free parameters, with shape (N, 7)
+        and columns ordered as FREE_PARAMETERS.
+    cost (numpy.ndarray): The final cost of each pixel, 0.5 * sum(w * r**2),
+        where r is the modelled minus the observed rrs, and w the weights.
+    iterations (numpy.ndarray): The number of LM iterations of each pixel.
+    evaluations (numpy.ndarray): The number of forward model evaluations of
+        each pixel.
+    converged (numpy.ndarray): True for pixels that met the ftol or xtol
+        convergence criterion, False for pixels that reached max_iterations
+        or stalled with the damping above max_damping.
+    damping (numpy.ndarray): The final LM damping factor of each pixel. It
+        can be passed back as initial_damping to continue an inversion.
+"""
+
+
+# The results fields used to estimate linearisation errors
+_LINEARISATION_FIELDS = ('a', 'bb', 'kd', 'kub')
+
+_LinearModel = namedtuple('_LinearModel',
+                          ['parameters', 'residual', 'jacobian', 'results'])
+""" The weighted residual (n, bands) and Jacobian (n, 7, bands) of evaluated
+parameters (n, 7), and the results fields needed to estimate the error of
+predictions from them.
+"""
+
+
+def _take(model, rows):
+    """ Selects rows of a _LinearModel. """
+    return _LinearModel(
+        parameters=model.parameters[rows],
+        residual=model.residual[rows],
+        jacobian=model.jacobian[rows],
+        results=model.results._make(
+            None if field is None else field[rows]
+            for field in model.results))
+
+
+def _replace_rows(model, rows, replacement):
+    """ Returns a _LinearModel with rows overwritten by another model. """
+    if not len(rows):
+        return model
+    def replace(field, value):
+        if field is None:
+            return None
+        field = field.copy()
+        field[rows] = value
+        return field
+
+    return _LinearModel(
+        parameters=replace(model.parameters, replacement.parameters),
+        residual=replace(model.residual, replacement.residual),
+        jacobian=replace(model.jacobian, replacement.jacobian),
+        results=model.results._make(
+            replace(field, value)
+            for field, value in zip(model.results, replacement.results)))
+
+
+def _as_bounds(bounds, default, num_pixels):
+    """ Converts lower or upper bounds to a (num_pixels, 7) array. """
+    if bounds is None:
+        bounds = default
+    bounds = np.asarray(bounds, dtype=np.float64)
+    if bounds.shape not in ((len(FREE_PARAMETERS),),
+                            (num_pixels, len(FREE_PARAMETERS))):
+        raise ValueError(
+            'Inversion bounds must have shape ({0},) or (N, {0})'.format(
+                len(FREE_PARAMETERS)))
+    return np.broadcast_to(bounds, (num_pixels, len(FREE_PARAMETERS)))
+
+
+def solve_fractions(bottom, target, lower, upper, sqrt_weights=None):
+    """ Bounded linear least-squares solve of the substrate fractions.
+
+    Solves min ||W^(1/2) (f . bottom - target)||^2 subject to
+    lower <= f <= upper for every pixel. The problem is convex, so its
+    solution is the best feasible stationary point over all faces of the
+    bound box. Each of the (up to) 3**3 faces, with every fraction free, at
+    its lower bound or at its upper bound, is solved in closed form,
+    vectorised across pixels.
+
+    Args:
+        bottom (numpy.ndarray): The rrs per unit of each substrate fraction,
+            shape (N, 3, bands). These are the rrs_dfrac1..3 Jacobian
+            fields, which do not depend on the fractions.
+        target (numpy.ndarray): The rrs to be explained by the substrate
+            term, shape (N, bands).
+        lower (array-like): Lower bounds of the fractions, shape (3,) or
+            (N, 3).
+        upper (array-like): Upper bounds of the fractions, shape (3,) or
+            (N, 3).
+        sqrt_weights (numpy.ndarray, optional): Square roots of the residual
+            weights, shape (N, bands).
+
+    Returns:
+        numpy.ndarray: The fractions, with shape (N, 3).
+    """
+    lower = np.asarray(lower, dtype=np.float64)
+    upper = np.asarray(upper, dtype=np.float64)
+    if sqrt_weights is not None:
+        bottom = bottom * sqrt_weights[:, np.newaxis, :]
+        target = target * sqrt_weights
+    gram = np.matmul(bottom, bottom.transpose(0, 2, 1))
+    projection = np.matmul(bottom, target[..., np.newaxis])[..., 0]
+    return _solve_box_quadratic(gram, projection, lower, upper)
+
+
+def _solve_box_quadratic(gram, projection, lower, upper):
+    """ Minimises f.G.f - 2 f.p subject to lower <= f <= upper.
+
+    See solve_fractions, which forms G and p from the substrate basis.
+    """
+    count = projection.shape[-1]
+    tolerance = 1e-12 * np.maximum(1.0, np.abs(upper - lower))
+    identity = np.eye(count, dtype=bool)
+    best = np.zeros(projection.shape)
+    best_cost = np.full(len(projection), np.inf)
+    # 0: free, 1: at the lower bound, 2: at the upper bound. Fractions with
+    # equal bounds are always fixed at the lower bound.
+    states = [(1,) if np.all(lower[..., i] >= upper[..., i]) else (0, 1, 2)
+              for i in range(count)]
+    for face in itertools.product(*states):
+        face = np.array(face)
+        free = face == 0
+        candidate = np.where(face == 2, upper, lower) * ~free
+        if free.any():
+            # Normal equations of the free fractions, with the fixed
+            # fractions moved to the right hand side.
+            rhs = projection - np.matmul(
+                gram, candidate[..., np.newaxis])[..., 0]
+            system = gram.copy()
+            system[:, ~free, :] = 0.0
+            system[:, :, ~free] = 0.0
+            system[:, identity & ~free] = 1.0
+            rhs[:, ~free] = 0.0
+            # pinv gives the minimum norm solution when substrates are
+            # linearly dependent.
+            candidate = candidate + np.matmul(
+                np.linalg.pinv(system), rhs[..., np.newaxis])[..., 0]
+            feasible = np.all(
+                (candidate >= lower - tolerance) &
+                (candidate <= upper + tolerance), axis=1)
+            candidate = np.clip(candidate, lower, upper)
+        else:
+            candidate = np.broadcast_to(candidate, best.shape)
+            feasible = np.ones(len(projection), dtype=bool)
+
+        # The cost, less the constant target . target term
+        cost = np.einsum(
+            'ni,ni->n',
+            candidate,
+            np.matmul(gram, candidate[..., np.newaxis])[..., 0] -
+            2.0 * projection)
+        better = feasible & (cost < best_cost)
+        best[better] = candidate[better]
+        best_cost[better] = cost[better]
+    return best
+
+
+def _normal_equations(
+        context, parameters, observed, sqrt_weights, fraction_bounds=None,
+        return_model=False):
+    """ Evaluates the cost, gradient and Gauss-Newton matrix of each pixel.
+
+    If fraction_bounds is given, the substrate fractions are first replaced
+    by their bounded least-squares solution (see solve_fractions), and the
+    fraction entries of the gradient and Gauss-Newton matrix are zero.
+
+    Returns:
+        tuple: cost (n,), gradient (n, 7), J^T.J (n, 7, 7) and the
+            parameters (n, 7), including any solved fractions. With
+            return_model, a _LinearModel of the evaluated pixels follows.
+    """
+    results = context.evaluate_batch(*parameters.T)
+    # (n, 7, bands) Jacobian of the residuals
+    jacobian = np.stack(
+        [getattr(results, name) for name in JACOBIAN_FIELDS],
+        axis=1).astype(np.float64, copy=False)
+    residual = np.asarray(results.rrs, dtype=np.float64) - observed
+
+    # Parameters outside the model's domain can give non-finite spectra.
+    # These pixels get an infinite cost, so the step is rejected.
+    invalid = ~(np.all(np.isfinite(residual), axis=1) &
+                np.all(np.isfinite(jacobian), axis=(1, 2)))
+    if invalid.any():
+        residual[invalid] = 0.0
+        jacobian[invalid] = 0.0
+
+    if fraction_bounds is not None:
+        # rrs is linear in the fractions, with the rrs_dfrac* fields as the
+        # basis, so the rrs of any other fractions follows without another
+        # model evaluation.
+        bottom = jacobian[:, _FRACTIONS, :]
+        fractions = parameters[:, _FRACTIONS]
+        residual -= np.matmul(fractions[:, np.newaxis, :], bottom)[:, 0, :]
+        solved = solve_fractions(
+            bottom, -residual, fraction_bounds[0], fraction_bounds[1],
+            sqrt_weights)
+        change = np.matmul(
+            (solved - fractions)[:, np.newaxis, :], bottom)[:, 0, :]
+        residual += np.matmul(solved[:, np.newaxis, :], bottom)[:, 0, :]
+
+        # The substrate term, and its derivatives with respect to the water
+        # column parameters, scale with the fractions. Correct the evaluated
+        # derivatives to the solved fractions.
+        # pylint: disable=protected-access
+        correction = context._bottom_log_derivatives(
+            results, parameters[:, 3]).transpose(0, 2, 1)
+        correction *= change[:, np.newaxis, :]
+        correction[invalid] = 0.0
+        jacobian[:, :4, :] += correction
+        parameters = parameters.copy()
+        parameters[:, _FRACTIONS] = solved
+
+    if sqrt_weights is not None:
+        residual *= sqrt_weights
+        jacobian *= sqrt_weights[:, np.newaxis, :]
+
+    gradient = np.matmul(jacobian, residual[..., np.newaxis])[..., 0]
+    hessian = np.matmul(jacobian, jacobian.transpose(0, 2, 1))
+
+    if fraction_bounds is not None:
+        # Kaufman's variable projection approximation: J^T.J of the water
+        # column derivatives, less their projection onto the rrs basis of
+        # the fractions that are free to absorb a change. Every term is a
+        # block of J^T.J. The gradient needs no projection, as the residual
+        # is orthogonal to the free part of the basis.
+        free = (solved > fraction_bounds[0]) & (solved < fraction_bounds[1])
+        cross = hessian[:, :, _FRACTIONS] * free[:, np.newaxis, :]
+        gram = cross[:, _FRACTIONS, :] * free[:, :, np.newaxis]
+        hessian -= np.matmul(
+            cross,
+            np.matmul(np.linalg.pinv(gram), cross.transpose(0, 2, 1)))
+        hessian[:, _FRACTIONS, :] = 0.0
+        hessian[:, :, _FRACTIONS] = 0.0
+        gradient[:, _FRACTIONS] = 0.0
+
+    cost = 0.5 * np.einsum('nb,nb->n', residual, residual)
+    cost[invalid] = np.inf
+    if not return_model:
+        return cost, gradient, hessian, parameters
+    model = _LinearModel(
+        parameters=parameters,
+        residual=residual,
+        jacobian=jacobian,
+        results=ForwardModelResults._make(
+            getattr(results, name) if name in _LINEARISATION_FIELDS else None
+            for name in ForwardModelResults._fields))
+    return cost, gradient, hessian, parameters, model
+
+
+def _predict(context, model, trial, tolerance, sqrt_weights):
+    """ Predicts the weighted residuals of trial parameters from a
+    _LinearModel.
+
+    Returns:
+        tuple: The predicted residuals (n, bands), and a boolean array (n,)
+            that is True where the estimated error of the prediction, with
+            the safety factor of evaluate_linearised, is within the
+            tolerance in every band.
+    """
+    delta = trial - model.parameters
+    # The model Jacobian is weighted, so the error estimate is too
+    # pylint: disable=protected-access
+    error = context._linearisation_scale(
+        model.results, model.parameters[:, 3], np.abs(delta)) * \
+        np.matmul(np.abs(delta)[:, np.newaxis, :],
+                  np.abs(model.jacobian))[:, 0, :]
+    if sqrt_weights is not None:
+        tolerance = tolerance * sqrt_weights
+    residual = model.residual + \
+        np.matmul(delta[:, np.newaxis, :], model.jacobian)[:, 0, :]
+    return residual, np.all(_LINEARISATION_SAFETY * error <= tolerance, axis=1)
+
+
+# pylint: disable=too-many-arguments
+# pylint: disable=too-many-locals
+# pylint: disable=too-many-statements
+def invert_batch(
+        context,
+        observed_rrs,
+        initial_parameters,
+        lower_bounds=None,
+        upper_bounds=None,
+        weights=None,
+        max_iterations=100,
+        ftol=1e-10,
+        xtol=1e-10,
+        initial_damping=1e-3,
+        max_damping=1e10,
+        project_fractions=False,
+        linear_tolerance=None):
+    """ Fits the free parameters of the forward model to observed spectra.
+
+    Minimises 0.5 * sum(w * (modelled_rrs - observed_rrs)**2) for each pixel
+    with a projected Levenberg-Marquardt method. Steps are clipped to the
+    bounds, and parameters at a bound whose gradient points out of the
+    feasible region are held fixed for that step. A parameter can be fixed
+    entirely by setting its lower and upper bounds to the same value.
+
+    A pixel has converged when an accepted step reduces its cost by no more
+    than ftol * cost, or when an accepted step changes no parameter by more
+    than xtol * (|parameter| + xtol). A pixel with no step at all, such as
+    one held at its bounds, has also converged. A pixel whose steps are
+    rejected until the damping exceeds max_damping has stalled. It stops
+    iterating, but is not reported as converged. Neither is a pixel whose
+    cost is not finite, such as one with a NaN observed band.
+
+    rrs is linear in the substrate fractions. With project_fractions, the
+    fractions are solved in closed form (by bounded linear least squares,
+    see solve_fractions) at every evaluated water column state, so that the
+    nonlinear search only covers chl, cdom, nap and depth. This variable
+    projection typically needs fewer iterations, and the initial fractions
+    are ignored.
+
+    Steps close to convergence are small. With linear_tolerance, the rrs of
+    each trial step is first predicted from the Jacobian of the last
+    evaluated parameters (see ForwardModelContext.evaluate_linearised). If
+    the estimated error of the prediction, with a safety factor, is within
+    linear_tolerance in every band, the step is taken without evaluating the
+    model, reusing that Jacobian, and the model is only evaluated once the
+    parameters have moved further. A pixel that finishes on predicted steps
+    is evaluated at its final parameters, so the reported costs are never
+    predictions. It has only converged if that cost is no more than the
+    cost of its last evaluation; otherwise it continues from the evaluated
+    state. Predicted steps cannot re-solve projected fractions, so
+    linear_tolerance requires project_fractions to be False.
+
+    Args:
+        context (ForwardModelContext): The forward model context.
+        observed_rrs (array-like): Observed rrs, shape (N, num_bands).
+        initial_parameters (array-like): Starting points, with shape (N, 7)
+            or (7,), and columns ordered as FREE_PARAMETERS.
+        lower_bounds (array-like, optional): Lower bounds of the 7 free
+            parameters, shared by all pixels with shape (7,), or per pixel
+            with shape (N, 7). Defaults to DEFAULT_LOWER_BOUNDS.
+        upper_bounds (array-like, optional): Upper bounds of the 7 free
+            parameters, with shape (7,) or (N, 7). Defaults to
+            DEFAULT_UPPER_BOUNDS.
+        weights (array-like, optional): Non-negative weights of the squared
+            residuals, with shape (num_bands,) or (N, num_bands).
+        max_iterations (int): The maximum number of iterations per pixel.
+        ftol (float): Relative cost reduction convergence tolerance.
+        xtol (float): Relative step size convergence tolerance.
+        initial_damping (float or array-like): The starting LM damping
+            factor, shared by all pixels or per pixel with shape (N,).
+        max_damping (float): The damping factor at which a pixel is
+            considered to have stalled.
+        project_fractions (bool): If True, the substrate fractions are
+            solved in closed form rather than by the LM iterations.
+        linear_tolerance (float, optional): The largest estimated rrs error
+            of a step predicted from the Jacobian rather than evaluated.
+
+    Returns:
+        InversionResults: The fitted parameters and convergence details.
+    """
+    observed = np.atleast_2d(np.asarray(observed_rrs, dtype=np.float64))
+    num_pixels, num_bands = observed.shape
+    if num_bands != context.num_bands:
+        raise ValueError(
+            'Observed spectra have {0} bands, but the model has {1}'.format(
+                num_bands, context.num_bands))
+
+    num_parameters = len(FREE_PARAMETERS)
+    lower = _as_bounds(lower_bounds, DEFAULT_LOWER_BOUNDS, num_pixels)
+    upper = _as_bounds(upper_bounds, DEFAULT_UPPER_BOUNDS, num_pixels)
+    if np.any(lower > upper):
+        raise ValueError('Inversion lower bounds exceed the upper bounds')
+    if project_fractions and linear_tolerance is not None:
+        raise ValueError(
+            'linear_tolerance cannot be combined with project_fractions')
+
+    parameters = np.clip(
+        np.broadcast_to(
+            np.asarray(initial_parameters, dtype=np.float64),
+            (num_pixels, num_parameters)),
+        lower,
+        upper)
+
+    sqrt_weights = None
+    if weights is not None:
+        sqrt_weights = np.sqrt(np.broadcast_to(
+            np.asarray(weights, dtype=np.float64), observed.shape))
+
+    def fraction_bounds(pixels):
+        if not project_fractions:
+            return None
+        return (lower[pixels, _FRACTIONS], upper[pixels, _FRACTIONS])
+
+    def reevaluate(rows):
+        """ Evaluates rows of the active pixels at their parameters. """
+        pixels = active[rows]
+        evaluations[pixels] += 1
+        return _normal_equations(
+            context, x[rows], observed[pixels],
+            None if sqrt_weights is None else sqrt_weights[pixels],
+            return_model=True)
+
+    linearise = linear_tolerance is not None
+    evaluated = _normal_equations(
+        context, parameters, observed, sqrt_weights,
+        fraction_bounds(slice(None)), return_model=linearise)
+    cost, gradient, hessian, parameters = evaluated[:4]
+    # The last evaluated state of each active pixel, for predicted steps
+    model = evaluated[4] if linearise else None
+    iterations = np.zeros(num_pixels, dtype=np.intp)
+    evaluations = np.ones(num_pixels, dtype=np.intp)
+    converged = np.zeros(num_pixels, dtype=bool)
+    damping = np.array(np.broadcast_to(
+        np.asarray(initial_damping, dtype=np.float64), (num_pixels,)))
+    final_cost = np.empty(num_pixels)
+    final_damping = np.empty(num_pixels)
+
+    # State of the active pixels, which shrinks as pixels converge
+    active = np.arange(num_pixels)
+    x = parameters
+    identity = np.eye(num_parameters, dtype=bool)
+    # Parameters that are not part of the LM step
+    projected = np.zeros(num_parameters, dtype=bool)
+    if project_fractions:
+        projected[_FRACTIONS] = True
+
+    for _ in range(max_iterations):
+        if not len(active):
+            break
+
+        # Parameters held at a bound for this step
+        active_lower = lower[active]
+        active_upper = upper[active]
+        fixed = (active_lower >= active_upper) | projected | \
+            ((x <= active_lower) & (gradient > 0)) | \
+            ((x >= active_upper) & (gradient < 0))
+
+        # Marquardt scaling by the diagonal of J^T.J, with a floor for
+        # parameters that the spectra are insensitive to.
+        diagonal = np.diagonal(hessian, axis1=1, axis2=2)
+        scale = np.maximum(
+            diagonal,
+            1e-12 * diagonal.max(axis=1, keepdims=True) + np.finfo(float).tiny)
+        system = hessian + identity * \
+            (damping[:, np.newaxis] * scale)[:, np.newaxis, :]
+        system[fixed[:, :, np.newaxis] | fixed[:, np.newaxis, :]] = 0.0
+        system[fixed[:, :, np.newaxis] & identity] = 1.0
+        rhs = np.where(fixed, 0.0, -gradient)
+
+        step = np.linalg.solve(system, rhs[..., np.newaxis])[..., 0]
+        trial = np.clip(x + step, active_lower, active_upper)
+        active_weights = None if sqrt_weights is None else \
+            sqrt_weights[active]
+        if linearise:
+            residual, predicted = _predict(
+                context, model, trial, linear_tolerance, active_weights)
+            # Pixels whose last evaluation failed have no Jacobian
+            predicted &= np.isfinite(cost)
+        else:
+            predicted = np.zeros(len(active), dtype=bool)
+
+        rows = np.flatnonzero(~predicted)
+        if len(rows):
+            evaluated = _normal_equations(
+                context,
+                trial[rows],
+                observed[active[rows]],
+                None if active_weights is None else active_weights[rows],
+                fraction_bounds(active[rows]),
+                return_model=linearise)
+        if len(rows) == len(active):
+            trial_cost, trial_gradient, trial_hessian, trial = evaluated[:4]
+        else:
+            # Predicted steps keep the Jacobian, and so J^T.J, of the model
+            trial_cost = 0.5 * np.einsum('nb,nb->n', residual, residual)
+            trial_gradient = np.matmul(
+                model.jacobian, residual[..., np.newaxis])[..., 0]
+            trial_hessian = hessian.copy()
+            if len(rows):
+                trial_cost[rows], trial_gradient[rows], \
+                    trial_hessian[rows], trial[rows] = evaluated[:4]
+        iterations[active] += 1
+        evaluations[active[rows]] += 1
+
+        accept = trial_cost < cost
+        if linearise and len(rows):
+            # Accepted evaluations replace the model of their pixels
+            renewed = accept[rows]
+            model = _replace_rows(
+                model, rows[renewed], _take(evaluated[4], renewed))
+        # Invalid pixels have infinite costs, whose difference is NaN
+        with np.errstate(invalid='ignore'):
+            small_reduction = accept & (cost - trial_cost <= ftol * cost)
+        # Rejected steps shrink as the damping grows, so only accepted steps,
+        # or no step at all (a stationary point), show convergence.
+        stationary = np.all(trial == x, axis=1)
+        small_step = (accept | stationary) & np.all(
+            np.abs(trial - x) <= xtol * (np.abs(x) + xtol), axis=1)
+
+        x = np.where(accept[:, np.newaxis], trial, x)
+        cost = np.where(accept, trial_cost, cost)
+        gradient = np.where(accept[:, np.newaxis], trial_gradient, gradient)
+        hessian = np.where(
+            accept[:, np.newaxis, np.newaxis], trial_hessian, hessian)
+        damping = np.where(
+            accept, damping * 0.1, damping * 10.0)
+
+        # Pixels whose model cannot be evaluated have an infinite cost
+        success = (small_reduction | small_step) & np.isfinite(cost)
+        done = success | (damping > max_damping)
+        if linearise:
+            # Pixels that moved on predicted steps since their last
+            # evaluation are evaluated before they finish. They have only
+            # converged if the steps did not increase the evaluated cost.
+            stale = np.flatnonzero(
+                done & np.any(x != model.parameters, axis=1))
+            if len(stale):
+                last_cost = 0.5 * np.einsum(
+                    'nb,nb->n', model.residual[stale], model.residual[stale])
+                evaluated = reevaluate(stale)
+                cost[stale], gradient[stale], hessian[stale] = evaluated[:3]
+                model = _replace_rows(model, stale, evaluated[4])
+                success[stale] &= cost[stale] <= last_cost
+                done[stale] = success[stale] | \
+                    (damping[stale] > max_damping)
+        if done.any():
+            finished = active[done]
+            parameters[finished] = x[done]
+            final_cost[finished] = cost[done]
+            final_damping[finished] = damping[done]
+            converged[finished] = success[done]
+            keep = ~done
+            active = active[keep]
+            x = x[keep]
+            cost = cost[keep]
+            gradient = gradient[keep]
+            hessian = hessian[keep]
+            damping = damping[keep]
+            if linearise:
+                model = _take(model, keep)
+
+    if linearise and len(active):
+        stale = np.flatnonzero(np.any(x != model.parameters, axis=1))
+        if len(stale):
+            cost[stale] = reevaluate(stale)[0]
+    parameters[active] = x
+    final_cost[active] = cost
+    final_damping[active] = damping
+    return InversionResults(
+        parameters=parameters,
+        cost=final_cost,
+        iterations=iterations,
+        evaluations=evaluations,
+        converged=converged,
+        damping=final_damping)
+# pylint: enable=too-many-arguments
+# pylint: enable=too-many-locals
+# pylint: enable=too-many-statements
@@ -0,0 +1,282 @@
+# -*- coding: utf-8 -*-
+""" Precomputed lookup tables of modelled remotely-sensed reflectance.
+
+A lookup table (LUT) holds forward model rrs values over a regular grid of the
+free parameters. Tables are stored on disk as a memory-mapped numpy .npy file,
+with the grid axes and other metadata in a JSON file of the same base name.
+"""
+
+from __future__ import (
+    absolute_import,
+    division,
+    print_function,
+    unicode_literals)
+from builtins import *
+
+import io
+import json
+
+import numpy as np
+
+from .forward_model import FREE_PARAMETERS
+from .utility import strictly_increasing
+
+LUT_PARAMETERS = FREE_PARAMETERS
+""" The order of the lookup table axes, and of the columns of the parameter
+arrays passed to the query methods.
+"""
+
+_FORMAT_VERSION = 1
+
+
+def _lut_filenames(filename):
+    """ Returns the (data, metadata) filenames for a LUT base filename. """
+    return '{0}.npy'.format(filename), '{0}.json'.format(filename)
+
+
+# pylint: disable=too-many-arguments
+# pylint: disable=too-many-locals
+def build_rrs_lookup_table(
+        context,
+        filename,
+        chl,
+        cdom,
+        nap,
+        depth,
+        sub1_frac,
+        sub2_frac,
+        sub3_frac,
+        chunk_size=65536):
+    """ Builds an rrs lookup table over a regular parameter grid.
+
+    The forward model is evaluated in batches of chunk_size grid points, which
+    are written directly into a memory-mapped file. Peak memory use is
+    therefore bounded by the chunk size rather than the size of the table.
+
+    Args:
+        context (ForwardModelContext): The forward model context.
+        filename (str): Base filename for the table, without extension.
+            The rrs values are written to filename.npy, and the metadata to
+            filename.json.
+        chl (array-like): Strictly increasing chlorophyll grid values.
+        cdom (array-like): Strictly increasing CDOM grid values.
+        nap (array-like): Strictly increasing NAP grid values.
+        depth (array-like): Strictly increasing depth grid values.
+        sub1_frac (array-like): Strictly increasing substrate1 proportions.
+        sub2_frac (array-like): Strictly increasing substrate2 proportions.
+        sub3_frac (array-like): Strictly increasing substrate3 proportions.
+            An axis may contain a single value, in which case that parameter
+            is fixed.
+        chunk_size (int): The number of grid points evaluated per batch.
+
+    Returns:
+        RrsLookupTable: The table, backed by the memory-mapped file.
+    """
+
+    axes = []
+    for name, values in zip(
+            LUT_PARAMETERS,
+            (chl, cdom, nap, depth, sub1_frac, sub2_frac, sub3_frac)):
+        axis = np.atleast_1d(np.asarray(values, dtype=np.float64))
+        if axis.ndim != 1 or not len(axis) or not strictly_increasing(axis):
+            raise ValueError(
+                'LUT axis {0} must be a non-empty, strictly increasing '
+                'vector'.format(name))
+        axes.append(axis)
+
+    grid_shape = tuple(len(axis) for axis in axes)
+    grid_size = int(np.prod(grid_shape))
+    data_filename, metadata_filename = _lut_filenames(filename)
+
+    rrs = np.lib.format.open_memmap(
+        data_filename,
+        mode='w+',
+        dtype=context.dtype,
+        shape=grid_shape + (context.num_bands,))
+    flat_rrs = rrs.reshape(grid_size, context.num_bands)
+
+    for start in range(0, grid_size, chunk_size):
+        stop = min(start + chunk_size, grid_size)
+        indices = np.unravel_index(np.arange(start, stop), grid_shape)
+        parameters = [axis[index] for axis, index in zip(axes, indices)]
+        flat_rrs[start:stop] = context.evaluate_batch(
+            *parameters, compute_jacobian=False).rrs
+    rrs.flush()
+
+    metadata = {
+        'format_version': _FORMAT_VERSION,
+        'parameters': list(LUT_PARAMETERS),
+        'axes': [axis.tolist() for axis in axes],
+        'wavelengths': np.asarray(context.wavelengths).tolist(),
+        'dtype': np.dtype(context.dtype).name,
+    }
+    with io.open(metadata_filename, 'w', encoding='utf-8') as metadata_file:
+        metadata_file.write(str(json.dumps(metadata, indent=2)))
+
+    return RrsLookupTable(axes, rrs, wavelengths=context.wavelengths)
+# pylint: enable=too-many-arguments
+# pylint: enable=too-many-locals
+
+
+class RrsLookupTable(object):
+    """ A regular-grid lookup table of modelled rrs.
+
+    Queries take parameter arrays of shape (N, 7), with columns ordered as
+    LUT_PARAMETERS. Parameter values outside the grid are clamped to the
+    grid bounds.
+
+    Args:
+        axes (list): The seven grid axes, as strictly increasing vectors.
+        rrs (numpy.ndarray): The rrs values, with shape
+            (len(axes[0]), ..., len(axes[6]), num_bands). This is typically a
+            numpy.memmap.
+        wavelengths (array-like, optional): The band-centre wavelengths.
+
+    Attributes:
+        axes (list): The grid axes.
+        rrs (numpy.ndarray): The rrs values.
+        wavelengths (numpy.ndarray): The band-centre wavelengths, or None.
+        grid_shape (tuple): The number of grid values along each axis.
+        num_bands (int): The number of spectral bands.
+    """
+
+    def __init__(self, axes, rrs, wavelengths=None):
+        self.axes = [np.asarray(axis, dtype=np.float64) for axis in axes]
+        self.rrs = rrs
+        self.wavelengths = None if wavelengths is None \
+            else np.asarray(wavelengths)
+        self.grid_shape = tuple(len(axis) for axis in self.axes)
+        self.num_bands = rrs.shape[-1]
+        if len(self.axes) != len(LUT_PARAMETERS) or \
+           rrs.shape[:-1] != self.grid_shape:
+            raise ValueError('LUT axes do not match the rrs array shape')
+        self._flat_rrs = rrs.reshape(-1, self.num_bands)
+
+    @classmethod
+    def load(cls, filename, mmap_mode='r'):
+        """ Loads a lookup table saved by build_rrs_lookup_table.
+
+        Args:
+            filename (str): Base filename for the table, without extension.
+            mmap_mode (str): The numpy memory-map mode for the rrs values.
+                Pass None to read the whole table into memory.
+
+        Returns:
+            RrsLookupTable: The loaded table.
+        """
+        data_filename, metadata_filename = _lut_filenames(filename)
+        with io.open(metadata_filename, 'r', encoding='utf-8') as metadata_file:
+            metadata = json.load(metadata_file)
+
+        if metadata.get('format_version') != _FORMAT_VERSION or \
+           tuple(metadata.get('parameters', ())) != LUT_PARAMETERS:
+            raise ValueError(
+                'Unsupported lookup table metadata in {0}'.format(
+                    metadata_filename))
+
+        return cls(
+            metadata['axes'],
+            np.load(data_filename, mmap_mode=mmap_mode),
+            wavelengths=metadata.get('wavelengths'))
+
+    def _as_parameters(self, parameters):
+        """ Validates and converts a query parameter array. """
+        parameters = np.atleast_2d(np.asarray(parameters, dtype=np.float64))
+        if parameters.ndim != 2 or parameters.shape[1] != len(self.axes):
+            raise ValueError(
+                'Query parameters must have shape (N, {0})'.format(
+                    len(self.axes)))
+        return parameters
+
+    def nearest(self, parameters, chunk_size=65536):
+        """ Nearest-neighbour lookup of rrs.
+
+        Args:
+            parameters (array-like): Query parameters, shape (N, 7).
+            chunk_size (int): The number of queries processed per batch.
+
+        Returns:
+            numpy.ndarray: The rrs of the nearest grid point, with shape
+                (N, num_bands).
+        """
+        parameters = self._as_parameters(parameters)
+        results = np.empty(
+            (len(parameters), self.num_bands), dtype=self.rrs.dtype)
+
+        for start in range(0, len(parameters), chunk_size):
+            chunk = parameters[start:start + chunk_size]
+            indices = []
+            for axis, values in zip(self.axes, chunk.T):
+                upper = np.clip(
+                    np.searchsorted(axis, values), 0, len(axis) - 1)
+                lower = np.clip(upper - 1, 0, len(axis) - 1)
+                use_lower = np.abs(values - axis[lower]) <= \
+                    np.abs(values - axis[upper])
+                indices.append(np.where(use_lower, lower, upper))
+            flat_indices = np.ravel_multi_index(indices, self.grid_shape)
+            results[start:start + len(chunk)] = self._flat_rrs[flat_indices]
+
+        return results
+
+    def interpolate(self, parameters, chunk_size=16384):
+        """ Multilinear interpolation of rrs.
+
+        Axes with a single value are treated as fixed, so a table with d
+        multi-valued axes reads 2**d grid points per query.
+
+        Args:
+            parameters (array-like): Query parameters, shape (N, 7).
+            chunk_size (int): The number of queries processed per batch.
+
+        Returns:
+            numpy.ndarray: The interpolated rrs, with shape (N, num_bands).
+        """
+        parameters = self._as_parameters(parameters)
+        results = np.empty(
+            (len(parameters), self.num_bands), dtype=self.rrs.dtype)
+        active = [i for i, axis in enumerate(self.axes) if len(axis) > 1]
+
+        # Gather and accumulation buffers, reused for every corner and chunk
+        corner_rrs = np.empty(
+            (min(chunk_size, len(parameters)), self.num_bands),
+            dtype=self.rrs.dtype)
+
+        for start in range(0, len(parameters), chunk_size):
+            chunk = parameters[start:start + chunk_size]
+            count = len(chunk)
+            accumulator = results[start:start + count]
+            accumulator[...] = 0.0
+            gathered = corner_rrs[:count]
+
+            # Lower cell index and fractional position along each axis
+            lower = [np.zeros(count, dtype=np.intp) for _ in self.axes]
+            fraction = {}
+            for i in active:
+                axis = self.axes[i]
+                values = np.clip(chunk[:, i], axis[0], axis[-1])
+                index = np.clip(
+                    np.searchsorted(axis, values, side='right') - 1,
+                    0,
+                    len(axis) - 2)
+                lower[i] = index
+                fraction[i] = (values - axis[index]) / \
+                    (axis[index + 1] - axis[index])
+
+            for corner in range(2 ** len(active)):
+                weight = np.ones(count, dtype=np.float64)
+                indices = list(lower)
+                for bit, i in enumerate(active):
+                    if corner & (1 << bit):
+                        indices[i] = lower[i] + 1
+                        weight *= fraction[i]
+                    else:
+                        weight *= 1.0 - fraction[i]
+                # queries on a cell face do not use the opposite corners
+                if not weight.any():
+                    continue
+                flat_indices = np.ravel_multi_index(indices, self.grid_shape)
+                np.take(self._flat_rrs, flat_indices, axis=0, out=gathered)
+                gathered *= weight[:, np.newaxis].astype(gathered.dtype)
+                accumulator += gathered
+
+        return results
@@ -0,0 +1,254 @@
+# -*- coding: utf-8 -*-
+""" Parallel evaluation of the forward model over image scenes.
+
+A scene is a (rows, cols) grid of pixels. The grid is split into tiles of
+contiguous pixels that are evaluated by a pool of worker processes. The
+forward model context, the parameter grid and the outputs are all placed in
+shared memory once, so each task only sends the bounds of its tile.
+"""
+
+from __future__ import (
+    absolute_import,
+    division,
+    print_function,
+    unicode_literals)
+from builtins import *
+
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from .forward_model import FREE_PARAMETERS, ForwardModelContext, JACOBIAN_FIELDS
+
+try:
+    from multiprocessing import shared_memory
+except ImportError:  # pragma: no cover
+    # Python < 3.8
+    shared_memory = None
+
+SceneResults = namedtuple('SceneResults', ['rrs', 'jacobian'])
+""" namedtuple containing the outputs of a scene run.
+
+Attributes:
+    rrs (numpy.ndarray): Modelled remotely-sensed reflectance, with shape
+        (rows, cols, num_bands).
+    jacobian (numpy.ndarray): Derivatives of rrs with respect to the free
+        parameters, with shape (rows, cols, 7, num_bands) and the parameter
+        axis ordered as FREE_PARAMETERS. None if the Jacobian was not
+        requested.
+"""
+
+# State of the current worker process, set by _initialise_worker
+_WORKER_STATE = {}
+
+# Peak working memory of evaluate_batch, in values of the context dtype per
+# pixel per band, without and with the Jacobian (measured with tracemalloc
+# in single and double precision).
+_EVALUATION_VALUES_PER_BAND = 26
+_JACOBIAN_EVALUATION_VALUES_PER_BAND = 44
+
+# The default working memory of each run_scene worker, in bytes
+_TILE_MEMORY_BUDGET = 256 * 1024 * 1024
+
+
+def _tile_size(context, compute_jacobian, memory_budget):
+    """ The number of pixels per tile whose evaluation fits memory_budget.
+    """
+    values = _JACOBIAN_EVALUATION_VALUES_PER_BAND if compute_jacobian \
+        else _EVALUATION_VALUES_PER_BAND
+    pixel_bytes = values * context.num_bands * np.dtype(context.dtype).itemsize
+    return max(1, memory_budget // pixel_bytes)
+
+
+class _SharedArrays(object):
+    """ A set of numpy arrays stored in shared memory blocks.
+
+    The owning process creates the blocks with create, and sends the
+    (picklable) descriptors to the workers, which attach to the same memory
+    with attach.
+    """
+
+    def __init__(self, blocks, arrays, descriptors):
+        self._blocks = blocks
+        self.arrays = arrays
+        self.descriptors = descriptors
+
+    @classmethod
+    def create(cls, specifications):
+        """ Creates shared arrays.
+
+        Args:
+            specifications (dict): Maps names to (shape, dtype, values),
+                where values is copied into the new array unless it is None.
+        """
+        shared = cls([], {}, {})
+        try:
+            for name, (shape, dtype, values) in specifications.items():
+                size = max(
+                    int(np.prod(shape)) * np.dtype(dtype).itemsize, 1)
+                block = shared_memory.SharedMemory(create=True, size=size)
+                shared._blocks.append(block)
+                array = np.ndarray(shape, dtype=dtype, buffer=block.buf)
+                if values is not None:
+                    array[...] = values
+                shared.arrays[name] = array
+                shared.descriptors[name] = (
+                    block.name, shape, np.dtype(dtype).str)
+        except Exception:
+            shared.release(unlink=True)
+            raise
+        return shared
+
+    @classmethod
+    def attach(cls, descriptors):
+        """ Attaches to shared arrays created in another process. """
+        shared = cls([], {}, descriptors)
+        for name, (block_name, shape, dtype) in descriptors.items():
+            block = shared_memory.SharedMemory(name=block_name)
+            shared._blocks.append(block)
+            shared.arrays[name] = np.ndarray(
+                shape, dtype=dtype, buffer=block.buf)
+        return shared
+
+    def release(self, unlink=False):
+        """ Closes (and optionally destroys) the shared memory blocks. """
+        self.arrays = {}
+        for block in self._blocks:
+            block.close()
+            if unlink:
+                block.unlink()
+        self._blocks = []
+
+
+def _context_state(context):
+    """ Splits a context into its array and non-array attributes. """
+    arrays = {}
+    scalars = {}
+    for name, value in vars(context).items():
+        if isinstance(value, np.ndarray):
+            arrays[name] = value
+        else:
+            scalars[name] = value
+    return arrays, scalars
+
+
+def _initialise_worker(descriptors, context_scalars):
+    """ Process pool initialiser, which attaches to the shared scene data. """
+    shared = _SharedArrays.attach(descriptors)
+    context = ForwardModelContext.__new__(ForwardModelContext)
+    vars(context).update(context_scalars)
+    for name, array in shared.arrays.items():
+        if name.startswith('context.'):
+            setattr(context, name[len('context.'):], array)
+    _WORKER_STATE['shared'] = shared
+    _WORKER_STATE['context'] = context
+
+
+def _evaluate_tile(start, stop, compute_jacobian):
+    """ Evaluates the pixels [start, stop) of the flattened scene. """
+    arrays = _WORKER_STATE['shared'].arrays
+    context = _WORKER_STATE['context']
+    parameters = arrays['parameters'][start:stop]
+    results = context.evaluate_batch(
+        *parameters.T, compute_jacobian=compute_jacobian)
+    arrays['rrs'][start:stop] = results.rrs
+    if compute_jacobian:
+        jacobian = arrays['jacobian'][start:stop]
+        for i, name in enumerate(JACOBIAN_FIELDS):
+            jacobian[:, i, :] = getattr(results, name)
+    return stop - start
+
+
+# pylint: disable=too-many-locals
+def run_scene(
+        context,
+        parameters,
+        max_workers=None,
+        tile_size=None,
+        compute_jacobian=False,
+        memory_budget=_TILE_MEMORY_BUDGET):
+    """ Evaluates the forward model over a scene in a process pool.
+
+    The (rows, cols) grid is processed in row-major order, in tiles of
+    tile_size pixels. Each worker attaches to the shared context, parameters
+    and outputs once when it starts, so tasks only carry their tile bounds.
+
+    Each worker evaluates one tile at a time, with a peak working memory of
+    about 26 values of the context dtype per pixel per band, or 44 with the
+    Jacobian. By default, tiles are sized so that this fits memory_budget;
+    the total is memory_budget times the number of workers. The shared
+    parameters and outputs are not counted in the budget.
+
+    Args:
+        context (ForwardModelContext): The forward model context.
+        parameters (array-like): The free parameters of each pixel, with
+            shape (rows, cols, 7) and the last axis ordered as
+            FREE_PARAMETERS.
+        max_workers (int, optional): The number of worker processes. Defaults
+            to the number of processors on the machine.
+        tile_size (int, optional): The number of pixels evaluated per task.
+            Defaults to the largest tile that fits memory_budget.
+        compute_jacobian (bool): If True, the Jacobian of rrs with respect to
+            the free parameters is also returned.
+        memory_budget (int): The approximate maximum working memory of each
+            worker in bytes, used when tile_size is None.
+
+    Returns:
+        SceneResults: The modelled rrs (and Jacobian) of each pixel.
+    """
+    if shared_memory is None:  # pragma: no cover
+        raise RuntimeError('run_scene requires multiprocessing.shared_memory')
+
+    parameters = np.asarray(parameters, dtype=context.dtype)
+    if parameters.ndim != 3 or parameters.shape[2] != len(FREE_PARAMETERS):
+        raise ValueError(
+            'Scene parameters must have shape (rows, cols, {0})'.format(
+                len(FREE_PARAMETERS)))
+    rows, cols = parameters.shape[:2]
+    num_pixels = rows * cols
+    num_bands = context.num_bands
+    if tile_size is None:
+        tile_size = _tile_size(context, compute_jacobian, memory_budget)
+
+    context_arrays, context_scalars = _context_state(context)
+    specifications = dict(
+        ('context.{0}'.format(name), (array.shape, array.dtype, array))
+        for name, array in context_arrays.items())
+    specifications['parameters'] = (
+        (num_pixels, len(FREE_PARAMETERS)),
+        context.dtype,
+        parameters.reshape(num_pixels, len(FREE_PARAMETERS)))
+    specifications['rrs'] = ((num_pixels, num_bands), context.dtype, None)
+    if compute_jacobian:
+        specifications['jacobian'] = (
+            (num_pixels, len(JACOBIAN_FIELDS), num_bands),
+            context.dtype,
+            None)
+
+    shared = _SharedArrays.create(specifications)
+    try:
+        with ProcessPoolExecutor(
+                max_workers=max_workers,
+                initializer=_initialise_worker,
+                initargs=(shared.descriptors, context_scalars)) as executor:
+            futures = [
+                executor.submit(
+                    _evaluate_tile,
+                    start,
+                    min(start + tile_size, num_pixels),
+                    compute_jacobian)
+                for start in range(0, num_pixels, tile_size)]
+            for future in futures:
+                future.result()
+
+        rrs = shared.arrays['rrs'].reshape(rows, cols, num_bands).copy()
+        jacobian = None
+        if compute_jacobian:
+            jacobian = shared.arrays['jacobian'].reshape(
+                rows, cols, len(JACOBIAN_FIELDS), num_bands).copy()
+    finally:
+        shared.release(unlink=True)
+
+    return SceneResults(rrs=rrs, jacobian=jacobian)
+# pylint: enable=too-many-locals
@@ -0,0 +1,443 @@
+# -*- coding: utf-8 -*-
+""" Inversion of whole image scenes.
+
+Neighbouring pixels usually have similar water column properties, so a
+solved pixel is a good starting point for the inversion of its neighbours.
+"""
+
+from __future__ import (
+    absolute_import,
+    division,
+    print_function,
+    unicode_literals)
+from builtins import *
+
+from collections import namedtuple
+
+import numpy as np
+
+from .forward_model import FREE_PARAMETERS
+from .inversion import (
+    DEFAULT_LOWER_BOUNDS,
+    DEFAULT_UPPER_BOUNDS,
+    invert_batch,
+    InversionResults,
+)
+
+# Estimated peak working memory of invert_batch, in bytes per pixel per band
+# (about 380 bytes were measured, with or without project_fractions).
+_INVERSION_BYTES_PER_BAND = 512
+
+# The default fallback cost is never below the cost of a residual of this
+# root mean square (weighted) rrs, which is a good fit for any sensor.
+_FALLBACK_RESIDUAL = 1e-5
+
+SceneInversionResults = namedtuple('SceneInversionResults',
+                                   [
+                                       'parameters',
+                                       'cost',
+                                       'evaluations',
+                                       'converged',
+                                       'fallback',
+                                   ])
+""" namedtuple containing the results of a scene inversion.
+
+Attributes:
+    parameters (numpy.ndarray): The fitted free parameters, with shape
+        (rows, cols, 7) and the last axis ordered as FREE_PARAMETERS.
+    cost (numpy.ndarray): The final cost of each pixel, shape (rows, cols).
+    evaluations (numpy.ndarray): The number of forward model evaluations
+        used for each pixel, including any fallback inversion.
+    converged (numpy.ndarray): The convergence flag of each pixel.
+    fallback (numpy.ndarray): True for warm-started pixels whose residual was
+        poor enough to be inverted again from the global initial parameters.
+"""
+
+PyramidInversionResults = namedtuple(
+    'PyramidInversionResults',
+    SceneInversionResults._fields + ('level_evaluations',))
+""" namedtuple containing the results of a pyramid inversion.
+
+The first five fields are as for SceneInversionResults, for the pixels of the
+full resolution scene.
+
+Attributes:
+    level_evaluations (list): The total number of forward model evaluations
+        made at each pyramid level, starting with the full resolution level.
+"""
+
+
+def _as_scene(values, rows, cols, name):
+    """ Broadcasts per-band values to a (rows, cols, bands) array. """
+    if values is None:
+        return None
+    values = np.asarray(values, dtype=np.float64)
+    if values.ndim == 1:
+        return np.broadcast_to(values, (rows, cols, len(values)))
+    if values.ndim != 3 or values.shape[:2] != (rows, cols):
+        raise ValueError(
+            '{0} must have shape (bands,) or (rows, cols, bands)'.format(name))
+    return values
+
+
+def _default_fallback_cost(cost, weights, num_bands):
+    """ 10 times the median cost, floored at the cost of an RMS residual of
+    _FALLBACK_RESIDUAL.
+
+    The floor keeps well-fitted pixels, such as those of noise-free data
+    whose median cost is close to 0, from all being inverted again.
+
+    Args:
+        cost (numpy.ndarray): The costs of the pixels.
+        weights (numpy.ndarray): The residual weights, with shape
+            (..., num_bands), or None.
+        num_bands (int): The number of bands.
+
+    Returns:
+        numpy.ndarray: The fallback cost, which has the shape of the weight
+            sums.
+    """
+    weight_sum = num_bands if weights is None else \
+        np.sum(weights, axis=-1)
+    return np.maximum(
+        10.0 * np.median(cost), 0.5 * _FALLBACK_RESIDUAL ** 2 * weight_sum)
+
+
+# pylint: disable=too-many-arguments
+# pylint: disable=too-many-locals
+def invert_scene(
+        context,
+        observed_rrs,
+        initial_parameters,
+        lower_bounds=None,
+        upper_bounds=None,
+        weights=None,
+        warm_start=True,
+        fallback_cost=None,
+        **kwargs):
+    """ Inverts a scene, seeding each pixel from solved neighbours.
+
+    The scene is processed as a wavefront of rows. Every pixel of a row is
+    inverted together with invert_batch. The first row starts from the
+    global initial parameters, and each later pixel starts from the solution
+    of the pixel above it. Warm-started pixels whose final cost exceeds
+    fallback_cost are inverted again from the global initial parameters, and
+    the better of the two solutions is kept.
+
+    Args:
+        context (ForwardModelContext): The forward model context.
+        observed_rrs (array-like): Observed rrs, with shape
+            (rows, cols, num_bands).
+        initial_parameters (array-like): The global initial parameters, with
+            shape (7,) and ordered as FREE_PARAMETERS.
+        lower_bounds (array-like, optional): Lower bounds of the 7 free
+            parameters, with shape (7,). Defaults to DEFAULT_LOWER_BOUNDS.
+        upper_bounds (array-like, optional): Upper bounds of the 7 free
+            parameters, with shape (7,). Defaults to DEFAULT_UPPER_BOUNDS.
+        weights (array-like, optional): Residual weights, with shape
+            (num_bands,) or (rows, cols, num_bands).
+        warm_start (bool): If False, every pixel starts from the global
+            initial parameters. This is useful as a baseline.
+        fallback_cost (float, optional): The cost above which a warm-started
+            pixel is inverted again from the global initial parameters.
+            Defaults to 10 times the median cost of the first row, but no
+            less than the cost of a root mean square residual of 1e-5 in
+            every band (with the weights applied), so that a well-fitted
+            first row does not send every later pixel to the fallback.
+        **kwargs: Other keyword arguments are passed to invert_batch.
+
+    Returns:
+        SceneInversionResults: The fitted parameters and inversion details.
+    """
+    observed = np.asarray(observed_rrs, dtype=np.float64)
+    if observed.ndim != 3:
+        raise ValueError('Observed spectra must have shape (rows, cols, bands)')
+    rows, cols, num_bands = observed.shape
+    weights = _as_scene(weights, rows, cols, 'weights')
+    initial = np.asarray(initial_parameters, dtype=np.float64)
+    if initial.shape != (len(FREE_PARAMETERS),):
+        raise ValueError(
+            'Initial parameters must have shape ({0},)'.format(
+                len(FREE_PARAMETERS)))
+
+    parameters = np.empty((rows, cols, len(FREE_PARAMETERS)))
+    cost = np.empty((rows, cols))
+    evaluations = np.zeros((rows, cols), dtype=np.intp)
+    converged = np.zeros((rows, cols), dtype=bool)
+    fallback = np.zeros((rows, cols), dtype=bool)
+
+    def invert_pixels(index, start):
+        return invert_batch(
+            context,
+            observed[index],
+            start,
+            lower_bounds,
+            upper_bounds,
+            weights=None if weights is None else weights[index],
+            **kwargs)
+
+    first_cost = None
+    for row in range(rows):
+        seeded = warm_start and row > 0
+        results = invert_pixels(
+            row, parameters[row - 1] if seeded else initial)
+        parameters[row] = results.parameters
+        cost[row] = results.cost
+        evaluations[row] = results.evaluations
+        converged[row] = results.converged
+
+        if row == 0:
+            first_cost = results.cost
+        if not seeded:
+            continue
+
+        threshold = fallback_cost
+        if threshold is None:
+            threshold = _default_fallback_cost(
+                first_cost, None if weights is None else weights[row],
+                num_bands)
+        poor = results.cost > threshold
+        if poor.any():
+            retry = invert_pixels((row, poor), initial)
+            fallback[row, poor] = True
+            evaluations[row, poor] += retry.evaluations
+            better = retry.cost < results.cost[poor]
+            indices = np.flatnonzero(poor)[better]
+            parameters[row, indices] = retry.parameters[better]
+            cost[row, indices] = retry.cost[better]
+            converged[row, indices] = retry.converged[better]
+
+    return SceneInversionResults(
+        parameters=parameters,
+        cost=cost,
+        evaluations=evaluations,
+        converged=converged,
+        fallback=fallback)
+# pylint: enable=too-many-arguments
+# pylint: enable=too-many-locals
+
+
+def _invert_in_batches(
+        context, observed, initial, lower, upper, batch_size, **kwargs):
+    """ Calls invert_batch on successive batches of pixels.
+
+    Smaller batches keep the model's (batch, bands) working arrays in cache,
+    which is faster than inverting a large tile at once. The initial
+    parameters and bounds can be shared, shape (7,), or per pixel.
+    """
+    def pixels(values, start, stop):
+        values = np.asarray(values)
+        return values if values.ndim == 1 else values[start:stop]
+
+    batches = [
+        invert_batch(
+            context,
+            observed[start:start + batch_size],
+            pixels(initial, start, start + batch_size),
+            pixels(lower, start, start + batch_size),
+            pixels(upper, start, start + batch_size),
+            **kwargs)
+        for start in range(0, len(observed), batch_size)]
+    return InversionResults._make(
+        np.concatenate(field) for field in zip(*batches))
+
+
+def block_average(cube, factor):
+    """ Averages non-overlapping factor x factor blocks of an image.
+
+    Blocks on the bottom and right edges of an image whose size is not a
+    multiple of factor average the pixels that they contain.
+
+    Args:
+        cube (array-like): The image, with shape (rows, cols, ...).
+        factor (int): The block size.
+
+    Returns:
+        numpy.ndarray: The block averages, with shape
+            (ceil(rows / factor), ceil(cols / factor), ...).
+    """
+    cube = np.asarray(cube)
+    rows, cols = cube.shape[:2]
+    row_starts = np.arange(0, rows, factor)
+    col_starts = np.arange(0, cols, factor)
+    sums = np.add.reduceat(
+        np.add.reduceat(cube, row_starts, axis=0, dtype=np.float64),
+        col_starts,
+        axis=1)
+    counts = np.outer(
+        np.minimum(factor, rows - row_starts),
+        np.minimum(factor, cols - col_starts))
+    return sums / counts.reshape(counts.shape + (1,) * (cube.ndim - 2))
+
+
+# pylint: disable=too-many-arguments
+# pylint: disable=too-many-locals
+# pylint: disable=too-many-statements
+def invert_pyramid(
+        context,
+        observed_rrs,
+        initial_parameters,
+        lower_bounds=None,
+        upper_bounds=None,
+        weights=None,
+        levels=3,
+        factor=2,
+        window=None,
+        fallback_cost=None,
+        memory_budget=256 * 1024 * 1024,
+        batch_size=64,
+        **kwargs):
+    """ Coarse-to-fine inversion of a large scene.
+
+    The observed scene is block-averaged into a pyramid of levels, each
+    factor times coarser than the last. The coarsest level is inverted from
+    the global initial parameters. Every pixel of a finer level starts from
+    the solution of the coarser pixel that covers it, optionally with its
+    bounds narrowed to a window around that prior. Pixels whose final cost
+    exceeds fallback_cost are inverted again from the global initial
+    parameters and bounds, and the better solution is kept.
+
+    Each level is processed in tiles of whole rows, sized so that the
+    observed spectra read for a tile and the working memory of the
+    inversion fit in memory_budget. Tiles are read from observed_rrs as
+    required, so it can be a memory-mapped array that is larger than
+    memory. The (rows, cols) outputs are not counted in the budget, and a
+    tile always holds at least one row.
+
+    Args:
+        context (ForwardModelContext): The forward model context.
+        observed_rrs (array-like): Observed rrs, with shape
+            (rows, cols, num_bands), such as a numpy.memmap.
+        initial_parameters (array-like): The global initial parameters, with
+            shape (7,) and ordered as FREE_PARAMETERS.
+        lower_bounds (array-like, optional): Global lower bounds of the 7
+            free parameters. Defaults to DEFAULT_LOWER_BOUNDS.
+        upper_bounds (array-like, optional): Global upper bounds of the 7
+            free parameters. Defaults to DEFAULT_UPPER_BOUNDS.
+        weights (array-like, optional): Residual weights, with shape
+            (num_bands,).
+        levels (int): The number of pyramid levels, including the full
+            resolution level.
+        factor (int): The block size between successive levels.
+        window (array-like, optional): Half-widths of the bounds around the
+            prior at the finer levels, with shape (7,). The bounds are the
+            intersection of the window and the global bounds. If None, the
+            global bounds are used at every level.
+        fallback_cost (float, optional): The cost above which a pixel of a
+            finer level is inverted again from the global start. Defaults to
+            10 times the median cost of each tile, with the same floor as
+            for invert_scene.
+        memory_budget (int): The approximate maximum working memory in
+            bytes.
+        batch_size (int): The number of pixels passed to each invert_batch
+            call within a tile.
+        **kwargs: Other keyword arguments are passed to invert_batch.
+
+    Returns:
+        PyramidInversionResults: The fitted parameters and inversion details
+            for the full resolution scene.
+    """
+    observed = observed_rrs
+    if not isinstance(observed, np.ndarray):
+        observed = np.asarray(observed, dtype=np.float64)
+    if observed.ndim != 3:
+        raise ValueError('Observed spectra must have shape (rows, cols, bands)')
+    rows, cols, num_bands = observed.shape
+    initial = np.asarray(initial_parameters, dtype=np.float64)
+    lower = np.asarray(
+        DEFAULT_LOWER_BOUNDS if lower_bounds is None else lower_bounds,
+        dtype=np.float64)
+    upper = np.asarray(
+        DEFAULT_UPPER_BOUNDS if upper_bounds is None else upper_bounds,
+        dtype=np.float64)
+    if window is not None:
+        window = np.asarray(window, dtype=np.float64)
+
+    previous = None
+    level_evaluations = []
+    for level in reversed(range(levels)):
+        block = factor ** level
+        level_rows = -(-rows // block)
+        level_cols = -(-cols // block)
+        parameters = np.empty((level_rows, level_cols, len(FREE_PARAMETERS)))
+        cost = np.empty((level_rows, level_cols))
+        evaluations = np.zeros((level_rows, level_cols), dtype=np.intp)
+        converged = np.zeros((level_rows, level_cols), dtype=bool)
+        fallback = np.zeros((level_rows, level_cols), dtype=bool)
+
+        # Bytes per row of the level: the full resolution spectra that are
+        # read and averaged, and the inversion working memory.
+        row_bytes = block * cols * num_bands * \
+            (observed.dtype.itemsize + 8) + \
+            level_cols * num_bands * _INVERSION_BYTES_PER_BAND
+        tile_rows = max(1, memory_budget // row_bytes)
+
+        for start in range(0, level_rows, tile_rows):
+            stop = min(start + tile_rows, level_rows)
+            spectra = np.asarray(
+                observed[start * block:stop * block], dtype=np.float64)
+            if block > 1:
+                spectra = block_average(spectra, block)
+            spectra = spectra.reshape(-1, num_bands)
+
+            tile_lower = lower
+            tile_upper = upper
+            if previous is None:
+                seed = initial
+            else:
+                seed = previous[np.ix_(
+                    np.arange(start, stop) // factor,
+                    np.arange(level_cols) // factor)].reshape(
+                        -1, len(FREE_PARAMETERS))
+                if window is not None:
+                    tile_lower = np.maximum(lower, seed - window)
+                    tile_upper = np.minimum(upper, seed + window)
+
+            results = _invert_in_batches(
+                context, spectra, seed, tile_lower, tile_upper, batch_size,
+                weights=weights, **kwargs)
+            tile_parameters = results.parameters
+            tile_cost = results.cost
+            tile_evaluations = results.evaluations
+            tile_converged = results.converged
+            tile_fallback = np.zeros(len(spectra), dtype=bool)
+
+            if previous is not None:
+                threshold = fallback_cost
+                if threshold is None:
+                    threshold = _default_fallback_cost(
+                        tile_cost, weights, num_bands)
+                poor = tile_cost > threshold
+                if poor.any():
+                    retry = _invert_in_batches(
+                        context, spectra[poor], initial, lower, upper,
+                        batch_size, weights=weights, **kwargs)
+                    tile_fallback[poor] = True
+                    tile_evaluations[poor] += retry.evaluations
+                    better = retry.cost < tile_cost[poor]
+                    indices = np.flatnonzero(poor)[better]
+                    tile_parameters[indices] = retry.parameters[better]
+                    tile_cost[indices] = retry.cost[better]
+                    tile_converged[indices] = retry.converged[better]
+
+            shape = (stop - start, level_cols)
+            parameters[start:stop] = tile_parameters.reshape(
+                shape + (len(FREE_PARAMETERS),))
+            cost[start:stop] = tile_cost.reshape(shape)
+            evaluations[start:stop] = tile_evaluations.reshape(shape)
+            converged[start:stop] = tile_converged.reshape(shape)
+            fallback[start:stop] = tile_fallback.reshape(shape)
+
+        level_evaluations.insert(0, int(evaluations.sum()))
+        previous = parameters
+
+    return PyramidInversionResults(
+        parameters=parameters,
+        cost=cost,
+        evaluations=evaluations,
+        converged=converged,
+        fallback=fallback,
+        level_evaluations=level_evaluations)
+# pylint: enable=too-many-arguments
+# pylint: enable=too-many-locals
+# pylint: enable=too-many-statements
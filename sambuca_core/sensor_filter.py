@@ -7,6 +7,8 @@ from __future__ import (
     print_function,
     unicode_literals)
 from builtins import *
+from collections import namedtuple, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 
 import os
 
@@ -19,8 +21,346 @@ import xlrd
 from .exceptions import UnsupportedDataFormatError, DataValidationError
 from .utility import list_files, strictly_increasing, merge_dictionary
 
+# The planning costs of a block of the banded operator, relative to one
+# multiply-add per spectrum: reading each input band of the block from the
+# spectra costs about as much as _READ_COST output bands, and each matrix
+# product call adds _CALL_COST.
+_READ_COST = 32
+_CALL_COST = 1024
 
-def apply_sensor_filter(spectra, normalised_response_function):
+# Spectra are filtered in chunks of rows of about this size, so that the
+# blocks of the banded operator re-read them from the cache.
+_CHUNK_BYTES = 1 << 19
+
+# The default working memory of filter_cube, in bytes
+_CUBE_MEMORY_BUDGET = 64 * 1024 * 1024
+
+
+class SensorFilter(namedtuple('SensorFilter', ['wavelengths', 'response'])):
+    """ A sensor filter, as returned by the sensor filter loaders.
+
+    A SensorFilter unpacks as a (wavelengths, response) tuple. The arrays
+    derived from the response, such as the pre-normalised operator, are
+    calculated on first use and cached, so that repeated filtering only pays
+    for the matrix product.
+
+    Real response functions are mostly zeros, as each output band only
+    covers a window of the input bands. apply stores the operator in banded
+    form: consecutive output bands are grouped into blocks, each multiplied
+    with only the union of their input windows. The grouping minimises an
+    estimate of the cost of the products, so a dense filter is a single
+    block.
+
+    Attributes:
+        wavelengths (numpy.ndarray): The wavelengths of the input bands.
+        response (numpy.ndarray): The spectral response function, with
+            shape (output bands, input bands).
+    """
+
+    # No __slots__, so that instances can cache the derived arrays
+
+    def _cached(self, name, function):
+        """ Returns a derived array, calculating it on first use. """
+        cache = self.__dict__.setdefault('_cache', {})
+        if name not in cache:
+            value = function()
+            if isinstance(value, np.ndarray):
+                value.flags.writeable = False
+            cache[name] = value
+        return cache[name]
+
+    @property
+    def num_bands(self):
+        """ The number of output bands. """
+        return self.response.shape[0]
+
+    @property
+    def num_input_bands(self):
+        """ The number of input bands. """
+        return self.response.shape[1]
+
+    @property
+    def wavelength_range(self):
+        """ The (first, last) wavelengths of the input bands. """
+        return (self.wavelengths[0], self.wavelengths[-1])
+
+    @property
+    def band_centres(self):
+        """ The response-weighted mean wavelength of each output band. """
+        return self._cached('band_centres', lambda: np.dot(
+            self.response, self.wavelengths) / self.response.sum(1))
+
+    @property
+    def operator(self):
+        """ The (input bands, output bands) operator, as returned by
+        sensor_filter_operator. """
+        return self.operator_as(None)
+
+    def operator_as(self, dtype):
+        """ The operator, converted to a floating-point type.
+
+        Args:
+            dtype (numpy.dtype): The type, or None for numpy.float64.
+
+        Returns:
+            numpy.ndarray: The read-only operator.
+        """
+        key = 'operator' if dtype is None else \
+            'operator_{0}'.format(np.dtype(dtype).str)
+        return self._cached(key, lambda: sensor_filter_operator(
+            self.response, dtype=dtype))
+
+    @property
+    def support(self):
+        """ The indices of the input bands with a non-zero response in any
+        output band. The other input bands do not contribute to the filtered
+        spectra, and need not be modelled. """
+        return self._cached('support', lambda: np.flatnonzero(
+            np.any(self.response != 0, axis=0)))
+
+    @property
+    def band_windows(self):
+        """ The (start, stop) input band indices of the non-zero response
+        of each output band, as two (output bands,) arrays. """
+        def windows():
+            nonzero = self.response != 0
+            starts = np.argmax(nonzero, axis=1)
+            stops = nonzero.shape[1] - np.argmax(nonzero[:, ::-1], axis=1)
+            # Output bands with no response at all get an empty window
+            empty = ~nonzero.any(axis=1)
+            starts[empty] = 0
+            stops[empty] = 0
+            return np.stack([starts, stops])
+        return tuple(self._cached('band_windows', windows))
+
+    def blocks(self, dtype=None):
+        """ The banded form of the operator.
+
+        Args:
+            dtype (numpy.dtype, optional): The floating-point type of the
+                operator blocks.
+
+        Returns:
+            tuple: (outputs, inputs, operator) triples, where outputs and
+                inputs are slices of the output and input bands, and
+                operator is the C-contiguous block of the operator.
+        """
+        key = 'blocks' if dtype is None else \
+            'blocks_{0}'.format(np.dtype(dtype).str)
+
+        def blocks():
+            operator = self.operator_as(dtype)
+            triples = []
+            for first, last, start, stop in _plan_blocks(*self.band_windows):
+                block = np.ascontiguousarray(operator[start:stop, first:last])
+                block.flags.writeable = False
+                triples.append(
+                    (slice(first, last), slice(start, stop), block))
+            return tuple(triples)
+        return self._cached(key, blocks)
+
+    def apply(self, spectra, dtype=None):
+        """ Filters spectra to the output bands.
+
+        Unlike apply_sensor_filter, the bands are the last axis of the
+        spectra, which may be a single spectrum (input bands,), a batch
+        (N, input bands) or an image cube (rows, cols, input bands).
+
+        Args:
+            spectra (array-like): The input spectra.
+            dtype (numpy.dtype, optional): If supplied, the spectra and the
+                operator are converted to this floating-point type before
+                filtering.
+
+        Returns:
+            numpy.ndarray: The filtered spectra, with the last axis replaced
+                by the output bands.
+        """
+        spectra = np.asarray(spectra, dtype=dtype)
+        if spectra.shape[-1] != self.num_input_bands:
+            raise ValueError(
+                'Spectra have {0} bands, but the sensor filter has {1} input '
+                'bands'.format(spectra.shape[-1], self.num_input_bands))
+        if spectra.ndim == 1:
+            return np.dot(spectra, self.operator_as(dtype))
+
+        # Image cubes are filtered as one (pixels, bands) batch
+        batch = spectra.reshape(-1, self.num_input_bands)
+        # Output bands with no response are not in any block, and stay zero
+        filtered = np.zeros(
+            (len(batch), self.num_bands),
+            dtype=np.result_type(batch, self.operator_as(dtype)))
+        rows = max(1, _CHUNK_BYTES // max(batch[:1].nbytes, 1))
+        for start in range(0, len(batch), rows):
+            chunk = batch[start:start + rows]
+            output = filtered[start:start + rows]
+            for outputs, inputs, operator in self.blocks(dtype):
+                output[:, outputs] = np.dot(chunk[:, inputs], operator)
+        return filtered.reshape(spectra.shape[:-1] + (self.num_bands,))
+
+
+class MultiSensorFilter(object):
+    """ Several sensor filters, stacked into one block operator.
+
+    Filtering the same spectra to several sensors one sensor at a time reads
+    the spectra once per sensor. The stacked filter concatenates the output
+    bands of every sensor into a single SensorFilter, so the spectra are
+    filtered to all of the sensors in one pass, and the result is split into
+    a view of the bands of each sensor.
+
+    The input bands of the sensors may cover different ranges, as long as
+    they lie on a common wavelength grid. The stacked filter covers the
+    union of the input bands, and each response is padded with zeros, which
+    the banded operator of the stacked filter does not store.
+
+    Args:
+        sensor_filters (dict or sequence): The sensor filters, either a
+            mapping of names to filters, as returned by load_sensor_filters,
+            or a sequence of (name, filter) pairs. The filters may be
+            SensorFilters or (wavelengths, response) tuples.
+
+    Attributes:
+        names (tuple): The sensor names, in stacking order.
+        sensor_filters (OrderedDict): The SensorFilter of each sensor.
+        stacked (SensorFilter): The stacked filter, whose input bands are the
+            union of the input bands of the sensors.
+        band_slices (OrderedDict): The slice of the output bands of the
+            stacked filter that belongs to each sensor.
+    """
+
+    def __init__(self, sensor_filters):
+        if hasattr(sensor_filters, 'items'):
+            sensor_filters = sensor_filters.items()
+        self.sensor_filters = OrderedDict(
+            (name, SensorFilter(*sensor_filter))
+            for name, sensor_filter in sensor_filters)
+        if not self.sensor_filters:
+            raise ValueError('At least one sensor filter is required')
+        self.names = tuple(self.sensor_filters)
+
+        wavelengths = np.unique(np.concatenate(
+            [sensor_filter.wavelengths
+             for sensor_filter in self.sensor_filters.values()]))
+        responses = []
+        self.band_slices = OrderedDict()
+        for name, sensor_filter in self.sensor_filters.items():
+            start = np.searchsorted(wavelengths, sensor_filter.wavelengths[0])
+            stop = start + sensor_filter.num_input_bands
+            if not np.array_equal(
+                    wavelengths[start:stop], sensor_filter.wavelengths):
+                raise DataValidationError(
+                    'The input bands of sensor filter {0} are not on the '
+                    'wavelength grid of the other filters'.format(name))
+            response = np.zeros(
+                (sensor_filter.num_bands, len(wavelengths)),
+                dtype=sensor_filter.response.dtype)
+            response[:, start:stop] = sensor_filter.response
+            first = sum(len(previous) for previous in responses)
+            self.band_slices[name] = slice(
+                first, first + sensor_filter.num_bands)
+            responses.append(response)
+        self.stacked = SensorFilter(wavelengths, np.vstack(responses))
+
+    def __len__(self):
+        return len(self.names)
+
+    def __getitem__(self, name):
+        return self.sensor_filters[name]
+
+    @property
+    def wavelengths(self):
+        """ The band-centre wavelengths of the input bands. """
+        return self.stacked.wavelengths
+
+    @property
+    def num_bands(self):
+        """ The total number of output bands of all of the sensors. """
+        return self.stacked.num_bands
+
+    @property
+    def num_input_bands(self):
+        """ The number of input bands. """
+        return self.stacked.num_input_bands
+
+    def split(self, filtered):
+        """ Splits spectra filtered by the stacked filter into the bands of
+        each sensor.
+
+        Args:
+            filtered (numpy.ndarray): Filtered spectra, with the output bands
+                of the stacked filter as the last axis.
+
+        Returns:
+            OrderedDict: A view of the bands of each sensor, by name.
+        """
+        return OrderedDict(
+            (name, filtered[..., bands])
+            for name, bands in self.band_slices.items())
+
+    def apply(self, spectra, dtype=None):
+        """ Filters spectra to the output bands of every sensor, in a single
+        pass.
+
+        Args:
+            spectra (array-like): The input spectra on the input bands of the
+                stacked filter, with the bands as the last axis, as for
+                SensorFilter.apply.
+            dtype (numpy.dtype, optional): If supplied, the spectra and the
+                operator are converted to this floating-point type before
+                filtering.
+
+        Returns:
+            OrderedDict: The filtered spectra of each sensor, by name. These
+                are views of a single array of all of the output bands.
+        """
+        return self.split(self.stacked.apply(spectra, dtype))
+
+
+def _plan_blocks(starts, stops):
+    """ Groups consecutive output bands into blocks of the banded operator.
+
+    Finds the partition of the output bands into runs that minimises the sum
+    of the estimated block costs, (stop - start) * (bands + _READ_COST) +
+    _CALL_COST, by dynamic programming over the run boundaries.
+
+    Returns:
+        list: (first, last, start, stop) tuples, of the output band range
+            and the union of the input windows of each block. Blocks with no
+            input bands are omitted.
+    """
+    num_bands = len(starts)
+    cost = np.full(num_bands + 1, np.inf)
+    cost[0] = 0.0
+    previous = np.zeros(num_bands + 1, dtype=np.intp)
+    for last in range(1, num_bands + 1):
+        start = np.inf
+        stop = -np.inf
+        for first in range(last - 1, -1, -1):
+            if stops[first] > starts[first]:
+                start = min(start, starts[first])
+                stop = max(stop, stops[first])
+            width = max(stop - start, 0)
+            candidate = cost[first] + _CALL_COST + \
+                width * (last - first + _READ_COST)
+            if candidate < cost[last]:
+                cost[last] = candidate
+                previous[last] = first
+
+    blocks = []
+    last = num_bands
+    while last > 0:
+        first = previous[last]
+        windows = [(starts[i], stops[i]) for i in range(first, last)
+                   if stops[i] > starts[i]]
+        if windows:
+            blocks.append((first, last,
+                           int(min(window[0] for window in windows)),
+                           int(max(window[1] for window in windows))))
+        last = first
+    return blocks[::-1]
+
+
+def apply_sensor_filter(spectra, normalised_response_function, dtype=None):
     """Applies a sensor filter to a spectra using the given spectral
     response function.
 
@@ -32,15 +372,156 @@ def apply_sensor_filter(spectra, normalised_response_function):
             The second dimension represents the proportional contribution of
             each of the input bands to an output band. The size must match the
             number of bands in the input spectra.
+        dtype (numpy.dtype, optional): If supplied, the spectra and the
+            response function are converted to this floating-point type
+            (for example numpy.float32) before filtering. The default is to
+            use the types of the inputs.
 
     Returns:
         ndarray: The filtered spectra.
 
     """
 
-    return np.dot(
-        normalised_response_function,
-        spectra) / normalised_response_function.sum(1)
+    if dtype is not None:
+        spectra = np.asarray(spectra, dtype=dtype)
+        normalised_response_function = np.asarray(
+            normalised_response_function, dtype=dtype)
+
+    # The band sums divide the output band axis, which is the first axis of
+    # the product. They are summed at the precision of the product, so that
+    # a float32 response does not limit the precision of float64 spectra.
+    filtered = np.dot(normalised_response_function, spectra)
+    band_sums = np.asarray(normalised_response_function).sum(
+        1, dtype=filtered.dtype)
+    return filtered / band_sums.reshape(
+        band_sums.shape + (1,) * (filtered.ndim - 1))
+
+# pylint: disable=too-many-arguments
+# pylint: disable=too-many-locals
+def filter_cube(
+        sensor_filter,
+        cube,
+        output=None,
+        dtype=None,
+        memory_budget=_CUBE_MEMORY_BUDGET,
+        max_workers=None):
+    """ Filters an image cube to the output bands of a sensor, in blocks of
+    rows.
+
+    Only one block of rows of the cube is read at a time (per worker), so
+    the cube and the output can be memory-mapped arrays that are larger than
+    memory. Each block is filtered with SensorFilter.apply as a single
+    (pixels, bands) batch, and written straight to its rows of the output.
+
+    Args:
+        sensor_filter (SensorFilter): The sensor filter. A response function
+            matrix, with shape (output bands, input bands), is also
+            accepted.
+        cube (array-like): The input cube, with shape
+            (rows, cols, input bands), such as a numpy.memmap. A filename is
+            opened as a memory-mapped .npy file.
+        output (array-like, optional): The (rows, cols, output bands) array
+            to write the filtered cube to, such as a numpy.memmap. A
+            filename is created as a memory-mapped .npy file. Defaults to a
+            new in-memory array.
+        dtype (numpy.dtype, optional): The floating-point type of the
+            filtering, as for SensorFilter.apply, and of a created output.
+        memory_budget (int): The approximate maximum working memory in
+            bytes, shared between the workers. A block always holds at
+            least one row.
+        max_workers (int, optional): The number of threads that filter
+            blocks concurrently. Defaults to filtering in the calling
+            thread.
+
+    Returns:
+        numpy.ndarray: The filtered cube. This is output, if it was an
+            array.
+    """
+    if not isinstance(sensor_filter, SensorFilter):
+        response = np.asarray(sensor_filter)
+        sensor_filter = SensorFilter(
+            np.arange(response.shape[1]), response)
+    if isinstance(cube, str):
+        cube = np.load(cube, mmap_mode='r')
+    elif not isinstance(cube, np.ndarray):
+        cube = np.asarray(cube)
+    if cube.ndim != 3 or cube.shape[-1] != sensor_filter.num_input_bands:
+        raise ValueError(
+            'The cube must have shape (rows, cols, {0})'.format(
+                sensor_filter.num_input_bands))
+    rows, cols, _ = cube.shape
+    shape = (rows, cols, sensor_filter.num_bands)
+    output_dtype = np.result_type(
+        cube.dtype if dtype is None else dtype,
+        sensor_filter.operator_as(dtype))
+    if output is None:
+        output = np.empty(shape, dtype=output_dtype)
+    elif isinstance(output, str):
+        output = np.lib.format.open_memmap(
+            output, mode='w+', dtype=output_dtype, shape=shape)
+    elif output.shape != shape:
+        raise ValueError(
+            'The output must have shape {0}'.format(shape))
+
+    # A block holds its input spectra, which are copied if they are
+    # converted or not contiguous, and its filtered spectra.
+    workers = max_workers or 1
+    row_bytes = cols * (
+        sensor_filter.num_input_bands * np.dtype(output_dtype).itemsize +
+        sensor_filter.num_bands * np.dtype(output_dtype).itemsize)
+    block_rows = max(1, memory_budget // (workers * max(row_bytes, 1)))
+    starts = range(0, rows, block_rows)
+
+    def filter_block(start):
+        """ Filters and writes the rows of one block. """
+        stop = min(start + block_rows, rows)
+        output[start:stop] = sensor_filter.apply(cube[start:stop], dtype)
+
+    if workers == 1:
+        for start in starts:
+            filter_block(start)
+    else:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            # Consume the results, to raise any exception of a block
+            for _ in executor.map(filter_block, starts):
+                pass
+    if isinstance(output, np.memmap):
+        output.flush()
+    return output
+# pylint: enable=too-many-arguments
+# pylint: enable=too-many-locals
+
+
+def sensor_filter_operator(normalised_response_function, dtype=None):
+    """Builds the pre-normalised operator form of a sensor filter.
+
+    apply_sensor_filter divides by the response function band sums on every
+    call. The operator has that division applied once, and is transposed so
+    that spectra stored with the bands along the last axis can be filtered
+    with a single matrix product: ``filtered = spectra.dot(operator)``.
+
+    Args:
+        normalised_response_function (matrix-like): The spectral sensitivity
+            matrix, as accepted by apply_sensor_filter, with shape
+            (output bands, input bands).
+        dtype (numpy.dtype, optional): The floating-point type of the operator.
+            The default is numpy.float64.
+
+    Returns:
+        ndarray: The C-contiguous (input bands, output bands) operator.
+    """
+
+    if isinstance(normalised_response_function, SensorFilter):
+        normalised_response_function = normalised_response_function.response
+    # Normalised in double precision, so that the operator of a float32
+    # response (as loaded from ENVI libraries) matches apply_sensor_filter
+    # for float64 spectra.
+    response_function = np.asarray(
+        normalised_response_function, dtype=np.float64)
+    operator = response_function / \
+        response_function.sum(1)[:, np.newaxis]
+    return np.ascontiguousarray(
+        operator.T, dtype=np.float64 if dtype is None else dtype)
 
 def _validate_filter_dataframe(filter_dataframe):
     """ Internal function to validate a sensor filter data frame.
@@ -103,8 +584,8 @@ def load_sensor_filter_spectral_library(
         normalise (bool): If true, the filter will be normalised.
 
     Returns:
-        numpy.array: The band-centre wavelengths.
-        numpy.array: The sensor filter.
+        SensorFilter: The band-centre wavelengths of the input bands, and
+            the sensor filter.
     """
 
     base_filename = os.path.join(directory, base_filename)
@@ -133,7 +614,8 @@ def load_sensor_filter_spectral_library(
     if normalise:
         dataframe = _normalise_dataframe(dataframe)
 
-    return np.array(dataframe.index), dataframe.values.transpose()
+    return SensorFilter(
+        np.array(dataframe.index), dataframe.values.transpose())
 
 # TODO: option to clip the filters to a specific range of 1nm bands?
 def load_sensor_filters_excel(filename, normalise=False, sheet_names=None):
@@ -148,7 +630,7 @@ def load_sensor_filters_excel(filename, normalise=False, sheet_names=None):
             The default is to attempt to load all worksheets.
 
     Returns:
-        dict: A dictionary of 2-tuples of numpy.ndarrays.
+        dict: A dictionary of SensorFilter 2-tuples of numpy.ndarrays.
             The first element contains the band centre wavelengths of the input
             bands, while the second element contains the filter.
             Dictionary is keyed by filter name inferred from the sheet name.
@@ -170,7 +652,7 @@ def load_sensor_filters_excel(filename, normalise=False, sheet_names=None):
                 if normalise:
                     dataframe = _normalise_dataframe(dataframe)
 
-                sensor_filters[sheet] = (
+                sensor_filters[sheet] = SensorFilter(
                     np.array(dataframe.index),
                     dataframe.values.transpose())
 
@@ -198,7 +680,7 @@ def load_sensor_filters(
             in the dictionary of results.
 
     Returns:
-        dict: A dictionary of 2-tuples of numpy.ndarrays.
+        dict: A dictionary of SensorFilter 2-tuples of numpy.ndarrays.
             The first element contains the band centre wavelengths of the input
             bands, while the second element contains the filter.
             Dictionary is keyed by filter name inferred from the sheet name.
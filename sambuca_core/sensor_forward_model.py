@@ -0,0 +1,142 @@
+# -*- coding: utf-8 -*-
+""" Forward model evaluation in sensor band space. """
+
+from __future__ import (
+    absolute_import,
+    division,
+    print_function,
+    unicode_literals)
+from builtins import *
+from collections import namedtuple
+
+import numpy as np
+
+from .forward_model import JACOBIAN_FIELDS
+from .sensor_filter import SensorFilter
+
+SensorModelResults = namedtuple('SensorModelResults', ['rrs', 'jacobian'])
+""" A namedtuple containing sensor band forward model results.
+
+Attributes:
+    rrs (numpy.ndarray): Modelled rrs in sensor bands, shape
+        (N, sensor bands).
+    jacobian (numpy.ndarray): Derivatives of the sensor band rrs with respect
+        to the free parameters, shape (N, 7, sensor bands), with the parameter
+        axis ordered as FREE_PARAMETERS. None if the Jacobian was not
+        requested.
+"""
+
+
+def _runs(support):
+    """ Splits increasing band indices into runs of consecutive bands.
+
+    Returns:
+        list: (first, last) ranges of positions in support.
+    """
+    breaks = (np.flatnonzero(np.diff(support) != 1) + 1).tolist()
+    bounds = [0] + breaks + [len(support)]
+    return list(zip(bounds[:-1], bounds[1:]))
+
+
+# pylint: disable=too-many-arguments
+def sensor_forward_model_batch(
+        context,
+        operator,
+        chl,
+        cdom,
+        nap,
+        depth,
+        sub1_frac,
+        sub2_frac,
+        sub3_frac,
+        compute_jacobian=True,
+        support=None):
+    """Evaluates a batch of pixels and filters the results to sensor bands.
+
+    The modelled rrs and its seven derivative spectra are filtered together
+    with a single batched matrix product against the pre-normalised filter
+    operator, rather than with one apply_sensor_filter call per spectrum.
+
+    Multispectral sensors often have no response at most of the model
+    wavelengths. The model only needs to be evaluated on the support of the
+    filter, by passing a context restricted to it::
+
+        pruned = context.subset(sensor_filter.support)
+        results = sensor_forward_model_batch(
+            pruned, sensor_filter, ..., support=sensor_filter.support)
+
+    The supported bands are placed back into the input bands of the
+    operator, with zeros elsewhere, before the same product with the
+    operator. The results are therefore identical to filtering the full
+    model.
+
+    Args:
+        context (ForwardModelContext): The forward model context.
+        operator (numpy.ndarray or SensorFilter): The (model bands, sensor
+            bands) operator returned by sensor_filter_operator, or a
+            SensorFilter, whose cached operator is used.
+        chl (array-like): Chlorophyll concentrations, shape (N,).
+        cdom (array-like): CDOM concentrations, shape (N,).
+        nap (array-like): NAP concentrations, shape (N,).
+        depth (array-like): Water column depths, shape (N,).
+        sub1_frac (array-like): Proportions of substrate1, shape (N,).
+        sub2_frac (array-like): Proportions of substrate2, shape (N,).
+        sub3_frac (array-like): Proportions of substrate3, shape (N,).
+        compute_jacobian (bool, optional): If true (the default), the
+            sensor band Jacobian is also calculated.
+        support (array-like, optional): The indices of the operator input
+            bands that the context models, if it models only some of them,
+            such as SensorFilter.support.
+
+    Returns:
+        SensorModelResults: The sensor band rrs and Jacobian.
+    """
+    if isinstance(operator, SensorFilter):
+        operator = operator.operator
+    operator = np.asarray(operator)
+    if support is not None:
+        support = np.asarray(support)
+        if len(support) == operator.shape[0]:
+            support = None
+    num_bands = operator.shape[0] if support is None else len(support)
+    if num_bands != context.num_bands:
+        raise ValueError(
+            'The sensor filter operator has {0} {1}input bands, but the '
+            'model has {2}'.format(
+                num_bands, '' if support is None else 'supported ',
+                context.num_bands))
+
+    results = context.evaluate_batch(
+        chl, cdom, nap, depth, sub1_frac, sub2_frac, sub3_frac,
+        compute_jacobian=compute_jacobian)
+    spectra = [results.rrs]
+    if compute_jacobian:
+        spectra.extend(getattr(results, name) for name in JACOBIAN_FIELDS)
+    # (N, 8, model bands), filtered to (N, 8, sensor bands) in one product
+    if support is not None:
+        # Zero-weight bands contribute exact zeros to the product, so the
+        # filtered results do not depend on the unmodelled bands.
+        stacked = np.zeros(
+            (len(results.rrs), len(spectra), operator.shape[0]),
+            dtype=results.rrs.dtype)
+        # Copying contiguous runs of bands is faster than fancy indexing
+        runs = _runs(support)
+        for index, spectrum in enumerate(spectra):
+            for first, last in runs:
+                stacked[:, index, support[first]:support[last - 1] + 1] = \
+                    spectrum[:, first:last]
+    elif compute_jacobian:
+        stacked = np.stack(spectra, axis=1)
+    else:
+        stacked = results.rrs[:, np.newaxis, :]
+
+    if not compute_jacobian:
+        return SensorModelResults(
+            rrs=np.dot(stacked[:, 0, :], operator),
+            jacobian=None)
+
+    filtered = np.matmul(stacked, operator)
+    return SensorModelResults(
+        rrs=filtered[:, 0, :],
+        jacobian=filtered[:, 1:, :])
+# pylint: enable=too-many-arguments
@@ -0,0 +1,213 @@
+# -*- coding: utf-8 -*-
+""" Nearest-neighbour index of simulated spectra, for initial guesses.
+
+Optimisers converge faster, and to better minima, when they start close to
+the answer. A spectral index simulates the rrs of a sample of free
+parameters, and returns the parameters whose spectra are closest to each
+observed pixel.
+"""
+
+from __future__ import (
+    absolute_import,
+    division,
+    print_function,
+    unicode_literals)
+from builtins import *
+
+from collections import namedtuple
+
+import numpy as np
+from scipy.spatial import cKDTree
+
+from .forward_model import FREE_PARAMETERS
+from .sensor_filter import SensorFilter
+
+IndexQueryResults = namedtuple('IndexQueryResults',
+                               ['parameters', 'distances', 'indices'])
+""" namedtuple containing the results of a spectral index query.
+
+Attributes:
+    parameters (numpy.ndarray): The parameters of the k nearest simulated
+        spectra, with shape (N, k, 7), nearest first.
+    distances (numpy.ndarray): The distances to those spectra in the index
+        space, shape (N, k).
+    indices (numpy.ndarray): The indices of those spectra in the parameter
+        sample, shape (N, k).
+"""
+
+_FORMAT_VERSION = 1
+
+
+# pylint: disable=too-many-arguments
+def build_spectral_index(
+        context,
+        parameters,
+        operator=None,
+        num_components=None,
+        chunk_size=1024,
+        leafsize=16):
+    """ Simulates spectra for a parameter sample, and indexes them.
+
+    Args:
+        context (ForwardModelContext): The forward model context.
+        parameters (array-like): The parameter sample, with shape (M, 7) and
+            columns ordered as FREE_PARAMETERS.
+        operator (numpy.ndarray or SensorFilter, optional): A (model bands,
+            sensor bands) filter operator from sensor_filter_operator, or a
+            SensorFilter. If supplied, the spectra are indexed in sensor
+            bands, and queries take sensor band spectra.
+        num_components (int, optional): If supplied, the spectra are
+            projected onto this many principal components before indexing,
+            which makes the tree smaller and faster to query.
+        chunk_size (int): The number of spectra simulated per batch.
+        leafsize (int): The cKDTree leaf size.
+
+    Returns:
+        SpectralIndex: The index.
+    """
+    parameters = np.asarray(parameters, dtype=np.float64)
+    if parameters.ndim != 2 or parameters.shape[1] != len(FREE_PARAMETERS):
+        raise ValueError(
+            'The parameter sample must have shape (M, {0})'.format(
+                len(FREE_PARAMETERS)))
+    if isinstance(operator, SensorFilter):
+        operator = operator.operator
+    num_bands = context.num_bands if operator is None else operator.shape[1]
+
+    spectra = np.empty((len(parameters), num_bands))
+    for start in range(0, len(parameters), chunk_size):
+        chunk = parameters[start:start + chunk_size]
+        rrs = context.evaluate_batch(*chunk.T, compute_jacobian=False).rrs
+        if operator is not None:
+            rrs = np.dot(rrs, operator)
+        spectra[start:start + len(chunk)] = rrs
+
+    mean = None
+    components = None
+    if num_components is not None:
+        mean = spectra.mean(axis=0)
+        # The principal axes are the eigenvectors of the (bands, bands)
+        # covariance, which avoids an SVD of the full (M, bands) sample.
+        covariance = np.zeros((num_bands, num_bands))
+        for start in range(0, len(spectra), chunk_size):
+            centred = spectra[start:start + chunk_size] - mean
+            covariance += np.dot(centred.T, centred)
+        _, vectors = np.linalg.eigh(covariance)
+        components = vectors[:, ::-1][:, :num_components].T.copy()
+
+    return SpectralIndex(
+        parameters, spectra, mean=mean, components=components,
+        leafsize=leafsize)
+# pylint: enable=too-many-arguments
+
+
+class SpectralIndex(object):
+    """ A k-d tree over simulated spectra, returning their parameters.
+
+    Instances are normally created by build_spectral_index or load.
+
+    Args:
+        parameters (numpy.ndarray): The parameter sample, shape (M, 7).
+        spectra (numpy.ndarray): The simulated spectra, shape (M, bands).
+        mean (numpy.ndarray, optional): The mean spectrum subtracted before
+            projection onto the principal components.
+        components (numpy.ndarray, optional): The principal components,
+            shape (num_components, bands). If None, the spectra are indexed
+            directly.
+        leafsize (int): The cKDTree leaf size.
+
+    Attributes:
+        parameters (numpy.ndarray): The parameter sample.
+        spectra (numpy.ndarray): The simulated spectra.
+        mean (numpy.ndarray): The PCA mean spectrum, or None.
+        components (numpy.ndarray): The principal components, or None.
+        tree (scipy.spatial.cKDTree): The tree over the (projected) spectra.
+    """
+
+    def __init__(self, parameters, spectra, mean=None, components=None,
+                 leafsize=16):
+        self.parameters = np.asarray(parameters, dtype=np.float64)
+        self.spectra = np.asarray(spectra, dtype=np.float64)
+        self.mean = mean
+        self.components = components
+        self.leafsize = leafsize
+        self.tree = cKDTree(self._project(self.spectra), leafsize=leafsize)
+
+    @property
+    def num_bands(self):
+        """ The number of bands of the indexed spectra. """
+        return self.spectra.shape[1]
+
+    def _project(self, spectra):
+        """ Maps spectra into the space of the tree. """
+        if self.components is None:
+            return spectra
+        return np.dot(spectra - self.mean, self.components.T)
+
+    def query(self, observed_rrs, k=1):
+        """ Finds the parameters of the simulated spectra closest to
+        observed spectra.
+
+        Args:
+            observed_rrs (array-like): Observed spectra, with shape
+                (N, bands), in the same bands as the index.
+            k (int): The number of neighbours to return.
+
+        Returns:
+            IndexQueryResults: The parameters, distances and sample indices
+                of the k nearest simulated spectra.
+        """
+        observed = np.atleast_2d(np.asarray(observed_rrs, dtype=np.float64))
+        if observed.shape[1] != self.num_bands:
+            raise ValueError(
+                'Observed spectra have {0} bands, but the index has '
+                '{1}'.format(observed.shape[1], self.num_bands))
+        distances, indices = self.tree.query(self._project(observed), k=k)
+        distances = distances.reshape(len(observed), k)
+        indices = indices.reshape(len(observed), k)
+        return IndexQueryResults(
+            parameters=self.parameters[indices],
+            distances=distances,
+            indices=indices)
+
+    def save(self, filename):
+        """ Saves the index to a .npz file.
+
+        The tree itself is rebuilt when the index is loaded, which is much
+        faster than simulating the spectra again.
+
+        Args:
+            filename (str): The file name.
+        """
+        arrays = dict(
+            format_version=_FORMAT_VERSION,
+            parameters=self.parameters,
+            spectra=self.spectra,
+            leafsize=self.leafsize)
+        if self.components is not None:
+            arrays.update(mean=self.mean, components=self.components)
+        with open(filename, 'wb') as index_file:
+            np.savez(index_file, **arrays)
+
+    @classmethod
+    def load(cls, filename):
+        """ Loads an index saved with save.
+
+        Args:
+            filename (str): The file name.
+
+        Returns:
+            SpectralIndex: The loaded index.
+        """
+        with np.load(filename) as arrays:
+            if int(arrays['format_version']) != _FORMAT_VERSION:
+                raise ValueError(
+                    'Unsupported spectral index format in {0}'.format(
+                        filename))
+            return cls(
+                arrays['parameters'],
+                arrays['spectra'],
+                mean=arrays['mean'] if 'mean' in arrays else None,
+                components=arrays['components']
+                if 'components' in arrays else None,
+                leafsize=int(arrays['leafsize']))
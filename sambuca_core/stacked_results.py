@@ -0,0 +1,195 @@
+# -*- coding: utf-8 -*-
+""" Contiguous storage for batched forward model results. """
+
+from __future__ import (
+    absolute_import,
+    division,
+    print_function,
+    unicode_literals)
+from builtins import *
+
+import numpy as np
+
+from .forward_model import ForwardModelResults, JACOBIAN_FIELDS
+
+# The Jacobian fields are the trailing fields of ForwardModelResults, so
+# results without a Jacobian simply use a shorter field axis.
+_ALL_FIELDS = ForwardModelResults._fields
+_FIELDS_WITHOUT_JACOBIAN = _ALL_FIELDS[:len(_ALL_FIELDS) - len(JACOBIAN_FIELDS)]
+assert _ALL_FIELDS[len(_FIELDS_WITHOUT_JACOBIAN):] == JACOBIAN_FIELDS
+
+
+class StackedForwardModelResults(object):
+    """ Batched forward model results backed by one contiguous buffer.
+
+    Every field of a batched ForwardModelResults is stored in a single
+    C-contiguous array of shape (N, fields, num_bands), so that all results
+    for a pixel are adjacent in memory, and the whole batch can be written to
+    disk or shared with another process as one block. The namedtuple
+    interface is available through the results attribute, whose fields are
+    views into the buffer.
+
+    Instances are normally created with allocate, from_results or
+    from_buffer rather than directly.
+
+    Args:
+        buffer (numpy.ndarray): A C-contiguous array of shape
+            (N, fields, num_bands), where fields is 29 for results with a
+            Jacobian, or 22 for results without one.
+
+    Attributes:
+        buffer (numpy.ndarray): The contiguous result storage.
+        fields (tuple): The names of the stored fields, in buffer order.
+        results (ForwardModelResults): Views of each field, with shape
+            (N, num_bands). Jacobian fields are None if the buffer does not
+            store them.
+    """
+
+    def __init__(self, buffer):
+        if buffer.ndim != 3 or not buffer.flags['C_CONTIGUOUS']:
+            raise ValueError(
+                'Stacked results require a C-contiguous (N, fields, bands) '
+                'array')
+        if buffer.shape[1] == len(_ALL_FIELDS):
+            self.fields = _ALL_FIELDS
+        elif buffer.shape[1] == len(_FIELDS_WITHOUT_JACOBIAN):
+            self.fields = _FIELDS_WITHOUT_JACOBIAN
+        else:
+            raise ValueError(
+                'Stacked results must have {0} or {1} fields, not {2}'.format(
+                    len(_ALL_FIELDS),
+                    len(_FIELDS_WITHOUT_JACOBIAN),
+                    buffer.shape[1]))
+
+        self.buffer = buffer
+        views = dict((name, None) for name in JACOBIAN_FIELDS)
+        views.update(
+            (name, buffer[:, i, :]) for i, name in enumerate(self.fields))
+        self.results = ForwardModelResults(**views)
+
+    @staticmethod
+    def _num_fields(with_jacobian):
+        return len(_ALL_FIELDS if with_jacobian else _FIELDS_WITHOUT_JACOBIAN)
+
+    @classmethod
+    def nbytes(cls, batch_size, num_bands, dtype=np.float64,
+               with_jacobian=True):
+        """ The size in bytes of a stacked results buffer.
+
+        This is useful for sizing shared memory blocks before calling
+        allocate with an external buffer.
+
+        Args:
+            batch_size (int): The number of pixels, N.
+            num_bands (int): The number of spectral bands.
+            dtype (numpy.dtype): The floating-point type.
+            with_jacobian (bool): Whether the rrs_d* fields are stored.
+
+        Returns:
+            int: The buffer size in bytes.
+        """
+        return batch_size * cls._num_fields(with_jacobian) * num_bands * \
+            np.dtype(dtype).itemsize
+
+    @classmethod
+    def allocate(cls, batch_size, num_bands, dtype=np.float64,
+                 with_jacobian=True, buffer=None):
+        """ Allocates stacked results storage.
+
+        Args:
+            batch_size (int): The number of pixels, N.
+            num_bands (int): The number of spectral bands.
+            dtype (numpy.dtype): The floating-point type.
+            with_jacobian (bool): Whether the rrs_d* fields are stored.
+            buffer (object, optional): An object exposing the buffer protocol,
+                such as multiprocessing.shared_memory.SharedMemory.buf, to use
+                as the storage. It must be at least nbytes(...) long. If not
+                supplied, new memory is allocated.
+
+        Returns:
+            StackedForwardModelResults: The (uninitialised) stacked results.
+        """
+        shape = (batch_size, cls._num_fields(with_jacobian), num_bands)
+        if buffer is None:
+            return cls(np.empty(shape, dtype=dtype))
+        return cls.from_buffer(
+            buffer, num_bands, dtype=dtype, with_jacobian=with_jacobian,
+            batch_size=batch_size)
+
+    @classmethod
+    def from_buffer(cls, buffer, num_bands, dtype=np.float64,
+                    with_jacobian=True, batch_size=None):
+        """ Wraps existing memory as stacked results, without copying.
+
+        Args:
+            buffer (object): An object exposing the buffer protocol, such as
+                a memoryview, bytearray or SharedMemory.buf.
+            num_bands (int): The number of spectral bands.
+            dtype (numpy.dtype): The floating-point type.
+            with_jacobian (bool): Whether the rrs_d* fields are stored.
+            batch_size (int, optional): The number of pixels. If not
+                supplied, it is inferred from the buffer size.
+
+        Returns:
+            StackedForwardModelResults: Stacked results sharing the memory of
+                buffer.
+        """
+        num_fields = cls._num_fields(with_jacobian)
+        count = -1 if batch_size is None \
+            else batch_size * num_fields * num_bands
+        array = np.frombuffer(buffer, dtype=dtype, count=count)
+        return cls(array.reshape(-1, num_fields, num_bands))
+
+    @classmethod
+    def from_results(cls, results, out=None):
+        """ Copies batched forward model results into stacked storage.
+
+        Args:
+            results (ForwardModelResults): Batched results, as returned by
+                forward_model_batch or ForwardModelContext.evaluate_batch.
+            out (StackedForwardModelResults, optional): Existing storage of
+                the correct shape to copy into.
+
+        Returns:
+            StackedForwardModelResults: The stacked results.
+        """
+        batch_size, num_bands = results.rrs.shape
+        with_jacobian = results.rrs_dchl is not None
+        if out is None:
+            out = cls.allocate(
+                batch_size,
+                num_bands,
+                dtype=results.rrs.dtype,
+                with_jacobian=with_jacobian)
+        elif out.buffer.shape != (
+                batch_size, cls._num_fields(with_jacobian), num_bands):
+            raise ValueError('The output buffer has the wrong shape')
+
+        for i, name in enumerate(out.fields):
+            out.buffer[:, i, :] = getattr(results, name)
+        return out
+
+    def field(self, name):
+        """ Returns the (N, num_bands) view of a named field. """
+        return getattr(self.results, name)
+
+    def memoryview(self):
+        """ Returns a zero-copy memoryview of the whole buffer. """
+        return memoryview(self.buffer).cast('B')
+
+    def __len__(self):
+        return self.buffer.shape[0]
+
+    def __getitem__(self, index):
+        """ Slices the batch along the pixel axis.
+
+        Args:
+            index (slice): The pixels to select. Only unit-step slices are
+                supported, so the result shares memory with this instance.
+
+        Returns:
+            StackedForwardModelResults: The selected pixels.
+        """
+        if not isinstance(index, slice) or index.step not in (None, 1):
+            raise TypeError('Stacked results only support unit-step slices')
+        return StackedForwardModelResults(self.buffer[index])
@@ -0,0 +1,327 @@
+# -*- coding: utf-8 -*-
+""" Selection of the best substrate combination from a spectral library.
+
+The forward model mixes three substrates. When the substrates of a pixel are
+unknown, every combination of the members of a spectral library is a
+candidate. The water column terms of the model do not depend on the
+substrates, and rrs is linear in the substrate fractions, so all of the
+combinations can be screened with one model evaluation per pixel. The
+screened combinations are then inverted with a successive halving schedule,
+which prunes poor combinations after a few iterations, so that only the best
+combination is inverted to convergence.
+"""
+
+from __future__ import (
+    absolute_import,
+    division,
+    print_function,
+    unicode_literals)
+from builtins import *
+
+from collections import namedtuple
+import itertools
+import math
+
+import numpy as np
+
+from .forward_model import FREE_PARAMETERS
+from .inversion import (
+    _as_bounds,
+    DEFAULT_LOWER_BOUNDS,
+    DEFAULT_UPPER_BOUNDS,
+    invert_batch,
+    solve_fractions,
+)
+
+# Columns of the parameter arrays holding the substrate fractions
+_FRACTIONS = slice(4, 7)
+_NUM_SUBSTRATES = 3
+
+SubstrateSearchResults = namedtuple('SubstrateSearchResults',
+                                    [
+                                        'combination',
+                                        'combinations',
+                                        'parameters',
+                                        'cost',
+                                        'screening_cost',
+                                        'evaluations',
+                                        'converged',
+                                    ])
+""" namedtuple containing the results of a substrate combination search.
+
+Attributes:
+    combination (numpy.ndarray): The index into combinations of the best
+        combination of each pixel, shape (N,).
+    combinations (numpy.ndarray): The library indices of the substrates of
+        every candidate combination, shape (C, combination_size).
+    parameters (numpy.ndarray): The fitted free parameters of the best
+        combination, shape (N, 7). The substrate fractions are ordered as the
+        substrates of the combination, and fractions beyond the combination
+        size are zero.
+    cost (numpy.ndarray): The final inversion cost of each pixel, shape (N,).
+    screening_cost (numpy.ndarray): The cost of each combination at the
+        screening water column, shape (N, C).
+    evaluations (numpy.ndarray): The number of forward model evaluations
+        used for each pixel, including the screening evaluations.
+    converged (numpy.ndarray): The convergence flag of the best combination.
+"""
+
+
+def _screen(context, library, slots, observed, water, lower, upper,
+            sqrt_weights):
+    """ Solves the fractions of every combination at fixed water columns.
+
+    Returns:
+        tuple: The cost (N, C) and fractions (N, C, 3) of each combination.
+    """
+    # rrs is the water column term, plus r_substratum times the bottom
+    # attenuation.
+    terms = context.water_column(water[:, 0], water[:, 1], water[:, 2])
+    kappa_d = terms.kappa * water[:, 3:4]
+    target = observed - \
+        terms.rrsdp * (1.0 - np.exp(-terms.column_path * kappa_d))
+    attenuation = (1.0 / math.pi) * np.exp(-terms.bottom_path * kappa_d)
+    valid = np.all(np.isfinite(target), axis=1) & \
+        np.all(np.isfinite(attenuation), axis=1)
+    target[~valid] = 0.0
+    attenuation[~valid] = 0.0
+
+    cost = np.empty((len(observed), len(slots)))
+    fractions = np.empty((len(observed), len(slots), _NUM_SUBSTRATES))
+    for index, slot in enumerate(slots):
+        bottom = library[slot][np.newaxis] * attenuation[:, np.newaxis, :]
+        solved = solve_fractions(
+            bottom, target, lower[:, _FRACTIONS], upper[:, _FRACTIONS],
+            sqrt_weights)
+        residual = np.matmul(solved[:, np.newaxis, :], bottom)[:, 0, :] - \
+            target
+        if sqrt_weights is not None:
+            residual *= sqrt_weights
+        cost[:, index] = 0.5 * np.einsum('nb,nb->n', residual, residual)
+        fractions[:, index] = solved
+    cost[~valid] = np.inf
+    return cost, fractions
+
+
+def _halve(alive, cost):
+    """ Keeps the better half, rounded up, of the alive combinations of each
+    pixel.
+
+    Combinations are ranked by cost, with every pruned combination after
+    every alive one. The sort is stable, so alive combinations of equal
+    (including infinite) cost keep their order.
+
+    Returns:
+        numpy.ndarray: The new alive mask, shape (N, C).
+    """
+    order = np.lexsort((cost, ~alive), axis=1)
+    rank = np.empty_like(order)
+    rank[np.arange(len(alive))[:, np.newaxis], order] = \
+        np.arange(alive.shape[1])
+    return alive & (rank < ((alive.sum(axis=1) + 1) // 2)[:, np.newaxis])
+
+
+# pylint: disable=too-many-arguments
+# pylint: disable=too-many-locals
+# pylint: disable=too-many-statements
+def search_substrates(
+        context,
+        substrates,
+        observed_rrs,
+        initial_parameters,
+        lower_bounds=None,
+        upper_bounds=None,
+        weights=None,
+        combination_size=3,
+        candidates=None,
+        first_iterations=2,
+        **kwargs):
+    """ Finds the best combination of library substrates for each pixel.
+
+    The search has three stages:
+
+    1. Every combination of combination_size substrates from the library is
+       screened, by solving for its bounded least-squares fractions with the
+       water column held at the initial parameters. This needs one model
+       evaluation per pixel, as the water column terms are shared by all of
+       the combinations. The best screened combination is inverted, which
+       gives a water column close to the final one.
+    2. Every combination is screened again at that water column. The
+       candidates combinations with the lowest screening cost are kept.
+    3. The candidates are inverted with successive halving. Each round runs
+       first_iterations LM iterations (doubling every round) on every
+       surviving combination, and prunes the worse half of each pixel. The
+       last survivor is inverted to convergence.
+
+    Each round continues the inversion of a combination from its parameters
+    and LM damping at the end of the last round, unless it has converged or
+    stalled. invert_batch evaluates its starting point again, so each round
+    costs one extra model evaluation per continued combination, which is
+    included in evaluations.
+
+    The combination with the lowest cost of each pixel is returned.
+
+    Libraries often contain similar substrates, which a change of the water
+    column can partly compensate for, so the screening cost alone is a poor
+    guide. Reducing candidates trades the reliability of the search for
+    fewer evaluations.
+
+    Args:
+        context (ForwardModelContext): The forward model context. Its own
+            substrates are ignored.
+        substrates (array-like): The spectral library, with shape
+            (S, num_bands).
+        observed_rrs (array-like): Observed rrs, shape (N, num_bands).
+        initial_parameters (array-like): Starting points, with shape (N, 7)
+            or (7,), and columns ordered as FREE_PARAMETERS. The initial
+            substrate fractions are ignored.
+        lower_bounds (array-like, optional): Lower bounds of the 7 free
+            parameters, with shape (7,) or (N, 7). The fraction bounds apply
+            to the substrates of each combination in order. Defaults to
+            DEFAULT_LOWER_BOUNDS.
+        upper_bounds (array-like, optional): Upper bounds of the 7 free
+            parameters, with shape (7,) or (N, 7). Defaults to
+            DEFAULT_UPPER_BOUNDS.
+        weights (array-like, optional): Residual weights, with shape
+            (num_bands,) or (N, num_bands).
+        combination_size (int): The number of substrates in each
+            combination, from 1 to 3.
+        candidates (int, optional): The number of combinations of each pixel
+            that pass the screening. Defaults to all of them.
+        first_iterations (int): The number of LM iterations of the first
+            halving round.
+        **kwargs: Other keyword arguments are passed to invert_batch.
+
+    Returns:
+        SubstrateSearchResults: The best combination and its fitted
+            parameters for each pixel.
+    """
+    library = np.asarray(substrates, dtype=np.float64)
+    if library.ndim != 2 or library.shape[1] != context.num_bands:
+        raise ValueError(
+            'The substrate library must have shape (S, {0})'.format(
+                context.num_bands))
+    if not 1 <= combination_size <= min(_NUM_SUBSTRATES, len(library)):
+        raise ValueError(
+            'The combination size must be from 1 to {0}'.format(
+                min(_NUM_SUBSTRATES, len(library))))
+    observed = np.atleast_2d(np.asarray(observed_rrs, dtype=np.float64))
+    num_pixels, num_bands = observed.shape
+    if num_bands != context.num_bands:
+        raise ValueError(
+            'Observed spectra have {0} bands, but the model has {1}'.format(
+                num_bands, context.num_bands))
+
+    lower = _as_bounds(lower_bounds, DEFAULT_LOWER_BOUNDS, num_pixels).copy()
+    upper = _as_bounds(upper_bounds, DEFAULT_UPPER_BOUNDS, num_pixels).copy()
+    # The fractions of the slots beyond the combination size are fixed at 0
+    lower[:, 4 + combination_size:] = 0.0
+    upper[:, 4 + combination_size:] = 0.0
+    initial = np.clip(
+        np.broadcast_to(
+            np.asarray(initial_parameters, dtype=np.float64),
+            (num_pixels, len(FREE_PARAMETERS))),
+        lower,
+        upper)
+    sqrt_weights = None
+    if weights is not None:
+        weights = np.broadcast_to(
+            np.asarray(weights, dtype=np.float64), observed.shape)
+        sqrt_weights = np.sqrt(weights)
+    max_iterations = kwargs.pop('max_iterations', 100)
+    initial_damping = kwargs.pop('initial_damping', 1e-3)
+    max_damping = kwargs.get('max_damping', 1e10)
+
+    combinations = np.array(
+        list(itertools.combinations(range(len(library)), combination_size)),
+        dtype=np.intp)
+    num_combinations = len(combinations)
+    # Unused substrate slots refer to an appended zero spectrum
+    library = np.vstack([library, np.zeros(num_bands)])
+    slots = np.full(
+        (num_combinations, _NUM_SUBSTRATES), len(library) - 1, dtype=np.intp)
+    slots[:, :combination_size] = combinations
+
+    pixels = np.arange(num_pixels)
+    cost = np.full((num_pixels, num_combinations), np.inf)
+    parameters = np.repeat(initial[:, np.newaxis, :], num_combinations, axis=1)
+    converged = np.zeros((num_pixels, num_combinations), dtype=bool)
+    damping = np.full((num_pixels, num_combinations), initial_damping)
+    evaluations = np.zeros(num_pixels, dtype=np.intp)
+
+    def invert(alive, iterations):
+        """ Continues the inversion of the alive combinations, from their
+        last parameters and damping. """
+        for index in np.unique(np.nonzero(alive)[1]):
+            selected = pixels[alive[:, index]]
+            inversion = invert_batch(
+                context.with_substrates(*library[slots[index]]),
+                observed[selected],
+                parameters[selected, index],
+                lower[selected],
+                upper[selected],
+                None if weights is None else weights[selected],
+                max_iterations=iterations,
+                initial_damping=damping[selected, index],
+                **kwargs)
+            cost[selected, index] = inversion.cost
+            parameters[selected, index] = inversion.parameters
+            converged[selected, index] = inversion.converged
+            damping[selected, index] = inversion.damping
+            evaluations[selected] += inversion.evaluations
+
+    def finished():
+        """ The combinations that have converged or stalled. """
+        return converged | (damping > max_damping)
+
+    def screen(water):
+        """ Screens every combination, and returns the screening cost. """
+        screening_cost, fractions = _screen(
+            context, library, slots, observed, water, lower, upper,
+            sqrt_weights)
+        evaluations[:] += 1
+        parameters[:, :, :4] = water[:, np.newaxis, :4]
+        parameters[:, :, _FRACTIONS] = fractions
+        return screening_cost
+
+    # Stage 1: screen at the initial water column, and invert the best
+    # combination.
+    best = np.argmin(screen(initial), axis=1)
+    alive = np.zeros((num_pixels, num_combinations), dtype=bool)
+    alive[pixels, best] = True
+    invert(alive, max_iterations)
+    water = parameters[pixels, best]
+    first = (cost[pixels, best], parameters[pixels, best],
+             converged[pixels, best])
+
+    # Stage 2: screen again at the new water column
+    screening_cost = screen(water)
+    cost[pixels, best], parameters[pixels, best], converged[pixels, best] = \
+        first
+    alive[...] = True
+    if candidates is not None and candidates < num_combinations:
+        kept = np.argpartition(screening_cost, candidates - 1, axis=1)
+        alive[pixels[:, np.newaxis], kept[:, candidates:]] = False
+
+    # Stage 3: successive halving
+    iterations = first_iterations
+    while np.any(alive.sum(axis=1) > 1):
+        invert(alive & ~finished(), min(iterations, max_iterations))
+        alive = _halve(alive, cost)
+        iterations *= 2
+    invert(alive & ~finished(), max_iterations)
+
+    # Pruned combinations were only partly inverted, but any of them that
+    # reached a lower cost than the survivor is a better fit.
+    best = np.argmin(cost, axis=1)
+    return SubstrateSearchResults(
+        combination=best,
+        combinations=combinations,
+        parameters=parameters[pixels, best],
+        cost=cost[pixels, best],
+        screening_cost=screening_cost,
+        evaluations=evaluations,
+        converged=converged[pixels, best])
+# pylint: enable=too-many-arguments
+# pylint: enable=too-many-locals
+# pylint: enable=too-many-statements
@@ -0,0 +1,107 @@
+# -*- coding: utf-8 -*-
+""" Shared loader for the IDL forward model test data.
+
+The IDL reference data in forward_model_test_data.sav is used by several test
+modules. This helper unpacks it into the keyword arguments accepted by
+sambuca_core.forward_model so that each test module does not need to repeat
+the IDL structure unpacking.
+"""
+# Ensure compatibility of Python 2 with Python 3 constructs
+from __future__ import (
+    absolute_import,
+    division,
+    print_function,
+    unicode_literals)
+
+from pkg_resources import resource_filename
+
+import numpy as np
+from scipy.io import readsav
+
+import sambuca_core as sbc
+
+# Tolerances used by test_forward_model.py against the IDL data, which appears
+# to be effectively single precision.
+RTOL = 1e-3
+ATOL = 5e-4
+
+
+def load_forward_model_test_data():
+    """ Loads the IDL forward model test data.
+
+    Returns:
+        tuple: (free_parameters, fixed_arguments, expected) where
+            free_parameters is a dict of chl, cdom, nap, depth and the three
+            substrate fractions, fixed_arguments is a dict of all remaining
+            forward_model arguments and expected is the IDL spectra structure.
+    """
+    filename = resource_filename(
+        sbc.__name__,
+        './tests/data/forward_model_test_data.sav')
+    data = readsav(filename)
+
+    # The IDL code has the parameters packed into a structure called ZZ.
+    # Magic numbers here are drawn directly from the IDL code.
+    zz = data.zz
+    spectra = data.sambuca.input_spectra[0]
+    params = data.sambuca.input_params[0]
+    substrates = data.sambuca.inputr[0].spectra[0]
+
+    free_parameters = dict(
+        chl=float(zz[1]),
+        cdom=float(zz[2]),
+        nap=float(zz[3]),
+        depth=float(zz[13]),
+        sub1_frac=float(zz[10]),
+        sub2_frac=1.0 - float(zz[10]),
+        sub3_frac=0.0)
+
+    fixed_arguments = dict(
+        substrate1=np.asarray(substrates[:, 0], dtype=np.float64),
+        substrate2=np.asarray(substrates[:, 1], dtype=np.float64),
+        substrate3=np.asarray(substrates[:, 1], dtype=np.float64),
+        wavelengths=np.asarray(spectra.wl[0], dtype=np.float64),
+        a_water=np.asarray(spectra.awater[0], dtype=np.float64),
+        a_ph_star=np.asarray(spectra.aphy_star[0], dtype=np.float64),
+        num_bands=551,
+        x_ph_lambda0x=float(zz[4]),
+        x_nap_lambda0x=float(zz[5]),
+        a_cdom_slope=float(zz[6]),
+        a_nap_slope=float(zz[7]),
+        a_nap_lambda0nap=float(zz[8]),
+        bb_ph_slope=float(zz[9]),
+        bb_nap_slope=float(zz[9]),
+        lambda0cdom=float(params.lambda0cdom[0]),
+        lambda0nap=float(params.lambda0tr[0]),
+        lambda0x=float(params.lambda0x[0]),
+        a_cdom_lambda0cdom=1.0,
+        bb_lambda_ref=500.0,
+        water_refractive_index=1.333,  # The hard-coded IDL value
+        theta_air=float(params.theta_air[0]),
+        off_nadir=0.0,
+        q_factor=np.pi)
+
+    return free_parameters, fixed_arguments, data.spectra
+
+
+def random_free_parameters(count, seed=42):
+    """ Generates a reproducible batch of plausible free parameters.
+
+    Args:
+        count (int): The number of parameter sets.
+        seed (int): Random seed.
+
+    Returns:
+        dict: chl, cdom, nap, depth and substrate fractions as arrays of
+            shape (count,).
+    """
+    rng = np.random.RandomState(seed)
+    fractions = rng.dirichlet([1.0, 1.0, 1.0], size=count)
+    return dict(
+        chl=rng.uniform(0.01, 2.0, count),
+        cdom=rng.uniform(0.0005, 0.5, count),
+        nap=rng.uniform(0.2, 5.0, count),
+        depth=rng.uniform(0.5, 15.0, count),
+        sub1_frac=fractions[:, 0],
+        sub2_frac=fractions[:, 1],
+        sub3_frac=fractions[:, 2])
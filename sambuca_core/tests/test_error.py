@@ -0,0 +1,190 @@
+# -*- coding: utf-8 -*-
+# Ensure compatibility of Python 2 with Python 3 constructs
+from __future__ import (
+    absolute_import,
+    division,
+    print_function,
+    unicode_literals)
+from builtins import *
+
+import warnings
+
+import numpy as np
+import pytest
+from pkg_resources import resource_filename
+from scipy.io import loadmat, readsav
+
+import sambuca_core as sbc
+
+from .forward_model_inputs import (
+    load_forward_model_test_data,
+    random_free_parameters,
+)
+
+
+def _load_mat(name):
+    return loadmat(
+        resource_filename(sbc.__name__, './tests/data/{0}'.format(name)),
+        squeeze_me=True)
+
+
+def _load_sav(name):
+    return readsav(
+        resource_filename(sbc.__name__, './tests/data/{0}'.format(name)))
+
+
+class TestErrorReferenceValues(object):
+
+    """Error function values against the SAMBUCA reference data."""
+
+    @pytest.mark.parametrize('name, use_noise', [
+        ('test_error_noise.mat', True),
+        ('test_error_no_noise.mat', False),
+    ])
+    def test_mat_data(self, name, use_noise):
+        data = _load_mat(name)
+        observed = data['observed_spectra']
+        modelled = data['modelled_spectra']
+        nedr = data['noiserrs'] if use_noise else None
+        for key, function in (('distance_lsq', sbc.distance_lsq),
+                              ('distance_alpha', sbc.distance_alpha),
+                              ('distance_f', sbc.distance_f),
+                              ('distance_alpha_f', sbc.distance_alpha_f)):
+            assert np.isclose(
+                function(observed, modelled, nedr).value, data[key])
+
+    @pytest.mark.parametrize('name, use_noise', [
+        ('noise_error_data.sav', True),
+        ('no_noise_error_data.sav', False),
+    ])
+    def test_sav_data(self, name, use_noise):
+        data = _load_sav(name)
+        nedr = data.noiserrs if use_noise else None
+        for key, function in (('lsq', sbc.distance_lsq),
+                              ('error_a', sbc.distance_alpha),
+                              ('error_f', sbc.distance_f),
+                              ('error_af', sbc.distance_alpha_f)):
+            assert np.isclose(
+                function(data.realrrs, data.rrs, nedr).value,
+                data[key],
+                rtol=1e-6)
+
+    def test_batch_matches_single(self):
+        data = _load_mat('test_error_noise.mat')
+        observed = np.stack([data['observed_spectra']] * 2 +
+                            [data['modelled_spectra']])
+        modelled = np.stack([data['modelled_spectra'],
+                             data['observed_spectra'],
+                             data['modelled_spectra']])
+        for function in sbc.ERROR_FUNCTIONS.values():
+            values = function(observed, modelled, data['noiserrs']).value
+            assert values.shape == (3,)
+            assert np.isclose(
+                values[0],
+                function(data['observed_spectra'],
+                         data['modelled_spectra'],
+                         data['noiserrs']).value)
+            assert np.isclose(values[2], 0.0)
+
+    def test_shape_mismatch(self):
+        with pytest.raises(ValueError):
+            sbc.distance_lsq(np.ones(5), np.ones(4))
+
+
+class TestErrorGradients(object):
+
+    """Error function gradients against finite differences of the model."""
+
+    @classmethod
+    def setup_class(cls):
+        _, fixed, _ = load_forward_model_test_data()
+        cls.context = sbc.ForwardModelContext(**fixed)
+        batch = random_free_parameters(4, seed=3)
+        cls.parameters = np.stack(
+            [batch[name] for name in sbc.FREE_PARAMETERS], axis=-1)
+        cls.observed = cls.context.evaluate_batch(
+            *(cls.parameters * 1.1).T, compute_jacobian=False).rrs
+        cls.nedr = np.linspace(0.0004, 0.0006, cls.context.num_bands)
+
+    @pytest.mark.parametrize('name', sorted(sbc.ERROR_FUNCTIONS))
+    def test_gradient(self, name):
+        function = sbc.ERROR_FUNCTIONS[name]
+        results = self.context.evaluate_batch(*self.parameters.T)
+        gradient = function(
+            self.observed,
+            results.rrs,
+            self.nedr,
+            jacobian=sbc.stack_jacobian(results)).gradient
+        assert gradient.shape == self.parameters.shape
+
+        for i in range(len(sbc.FREE_PARAMETERS)):
+            step = 1e-6 * np.maximum(np.abs(self.parameters[:, i]), 1e-3)
+            upper = self.parameters.copy()
+            lower = self.parameters.copy()
+            upper[:, i] += step
+            lower[:, i] -= step
+            difference = (
+                function(self.observed,
+                         self.context.evaluate_batch(*upper.T).rrs,
+                         self.nedr).value -
+                function(self.observed,
+                         self.context.evaluate_batch(*lower.T).rrs,
+                         self.nedr).value) / (2 * step)
+            assert np.allclose(gradient[:, i], difference,
+                               rtol=1e-4, atol=1e-8)
+
+    def test_single_pixel_gradient(self):
+        results = self.context.evaluate(*self.parameters[0])
+        single = sbc.distance_alpha_f(
+            self.observed[0], results.rrs, self.nedr,
+            jacobian=sbc.stack_jacobian(results))
+        assert single.gradient.shape == (len(sbc.FREE_PARAMETERS),)
+        assert np.ndim(single.value) == 0
+
+    def test_no_jacobian(self):
+        results = sbc.distance_f(self.observed, self.observed)
+        assert results.gradient is None
+        assert np.allclose(results.value, 0.0)
+
+    @pytest.mark.parametrize('name', sorted(sbc.ERROR_FUNCTIONS))
+    def test_vector_jacobian_product(self, name):
+        function = sbc.ERROR_FUNCTIONS[name]
+        results = self.context.evaluate_batch(*self.parameters.T)
+        expected = function(
+            self.observed,
+            results.rrs,
+            self.nedr,
+            jacobian=sbc.stack_jacobian(results))
+
+        def cotangent(rrs):
+            return sbc.distance_rrs_gradient(
+                name, self.observed, rrs, self.nedr).gradient
+
+        product = self.context.evaluate_vjp(
+            *self.parameters.T, cotangent=cotangent)
+        assert np.allclose(product.gradient, expected.gradient,
+                           rtol=1e-10, atol=1e-14)
+        actual = sbc.distance_rrs_gradient(
+            name, self.observed, product.rrs, self.nedr)
+        assert np.array_equal(actual.value, expected.value)
+
+    def test_rrs_gradient_single_pixel(self):
+        results = sbc.distance_rrs_gradient(
+            'f', self.observed[0], self.observed[0] * 1.1)
+        assert np.ndim(results.value) == 0
+        assert results.gradient.shape == self.observed[0].shape
+
+    def test_alpha_of_zero_spectrum(self):
+        zero = np.zeros_like(self.observed[:2])
+        with warnings.catch_warnings():
+            warnings.simplefilter('error')
+            for observed, modelled in ((self.observed[:2], zero),
+                                       (zero, self.observed[:2])):
+                results = sbc.distance_rrs_gradient(
+                    'alpha', observed, modelled, self.nedr)
+                assert np.all(results.value == 0.0)
+                assert np.all(results.gradient == 0.0)
+
+    def test_rrs_gradient_unknown_function(self):
+        with pytest.raises(ValueError):
+            sbc.distance_rrs_gradient('unknown', self.observed, self.observed)
@@ -0,0 +1,69 @@
+# -*- coding: utf-8 -*-
+# Ensure compatibility of Python 2 with Python 3 constructs
+from __future__ import (
+    absolute_import,
+    division,
+    print_function,
+    unicode_literals)
+from builtins import *
+
+import numpy as np
+import pytest
+import sambuca_core as sbc
+
+from .forward_model_inputs import (
+    ATOL,
+    RTOL,
+    load_forward_model_test_data,
+    random_free_parameters,
+)
+
+
+class TestForwardModelBatch(object):
+
+    """Batched forward model tests."""
+
+    @classmethod
+    def setup_class(cls):
+        cls.free, cls.fixed, cls.expected = load_forward_model_test_data()
+        cls.batch = random_free_parameters(16)
+
+    def test_rrs_matches_idl(self):
+        batch = dict((k, [v, v]) for k, v in self.free.items())
+        results = sbc.forward_model_batch(**dict(batch, **self.fixed))
+        assert results.rrs.shape == (2, 551)
+        for row in results.rrs:
+            assert np.allclose(
+                row,
+                self.expected.rrs[0],
+                atol=ATOL,
+                rtol=RTOL)
+
+    def test_all_fields_have_batch_shape(self):
+        results = sbc.forward_model_batch(**dict(self.batch, **self.fixed))
+        for field in results:
+            assert field.shape == (16, 551)
+
+    def test_matches_scalar_path(self):
+        results = sbc.forward_model_batch(**dict(self.batch, **self.fixed))
+        for i in range(16):
+            pixel = dict((k, v[i]) for k, v in self.batch.items())
+            expected = sbc.forward_model(**dict(pixel, **self.fixed))
+            for name, actual, wanted in zip(
+                    expected._fields, results, expected):
+                assert np.allclose(
+                    actual[i],
+                    wanted,
+                    atol=ATOL,
+                    rtol=RTOL), name
+
+    def test_scalar_parameters_are_broadcast(self):
+        batch = dict(self.batch, depth=3.0)
+        results = sbc.forward_model_batch(**dict(batch, **self.fixed))
+        assert results.rrs.shape == (16, 551)
+
+    def test_rejects_multidimensional_parameters(self):
+        batch = dict(
+            (k, np.reshape(v, (4, 4))) for k, v in self.batch.items())
+        with pytest.raises(ValueError):
+            sbc.forward_model_batch(**dict(batch, **self.fixed))
@@ -0,0 +1,394 @@
+# -*- coding: utf-8 -*-
+# Ensure compatibility of Python 2 with Python 3 constructs
+from __future__ import (
+    absolute_import,
+    division,
+    print_function,
+    unicode_literals)
+from builtins import *
+
+import numpy as np
+import pytest
+import sambuca_core as sbc
+
+from .forward_model_inputs import (
+    ATOL,
+    RTOL,
+    load_forward_model_test_data,
+    random_free_parameters,
+)
+
+
+class TestForwardModelContext(object):
+
+    """ForwardModelContext tests."""
+
+    @classmethod
+    def setup_class(cls):
+        cls.free, cls.fixed, cls.expected = load_forward_model_test_data()
+        cls.context = sbc.ForwardModelContext(**cls.fixed)
+
+    def test_precomputed_siops(self):
+        results = sbc.forward_model(**dict(self.free, **self.fixed))
+        assert np.array_equal(self.context.a_cdom_star, results.a_cdom_star)
+        assert np.array_equal(self.context.a_nap_star, results.a_nap_star)
+        assert np.array_equal(self.context.bb_ph_star, results.bb_ph_star)
+        assert np.array_equal(self.context.bb_nap_star, results.bb_nap_star)
+        assert np.array_equal(self.context.bb_water, results.bb_water)
+        # off_nadir is zero in the test data
+        assert self.context.inv_cos_theta_0 == 1.0
+
+    def test_evaluate_matches_forward_model(self):
+        expected = sbc.forward_model(**dict(self.free, **self.fixed))
+        actual = self.context.evaluate(**self.free)
+        for name, a, b in zip(expected._fields, actual, expected):
+            assert np.array_equal(a, b), name
+
+    def test_evaluate_rrs_matches_idl(self):
+        results = self.context.evaluate(**self.free)
+        assert np.allclose(
+            results.rrs,
+            self.expected.rrs[0],
+            atol=ATOL,
+            rtol=RTOL)
+
+    def test_evaluate_batch_matches_evaluate(self):
+        batch = random_free_parameters(8)
+        results = self.context.evaluate_batch(**batch)
+        for i in range(8):
+            pixel = self.context.evaluate(
+                **dict((k, v[i]) for k, v in batch.items()))
+            assert np.allclose(results.rrs[i], pixel.rrs)
+            assert np.allclose(results.rrs_dchl[i], pixel.rrs_dchl)
+
+    def test_context_is_reusable(self):
+        first = self.context.evaluate(**self.free)
+        self.context.evaluate(**dict(self.free, chl=1.5, depth=10.0))
+        second = self.context.evaluate(**self.free)
+        assert np.array_equal(first.rrs, second.rrs)
+
+    def test_without_jacobian(self):
+        full = self.context.evaluate(**self.free)
+        fast = self.context.evaluate(compute_jacobian=False, **self.free)
+        assert np.array_equal(full.rrs, fast.rrs)
+        assert np.array_equal(full.rrsdp, fast.rrsdp)
+        for name in ('rrs_dchl', 'rrs_dcdom', 'rrs_dnap', 'rrs_ddepth',
+                     'rrs_dfrac1', 'rrs_dfrac2', 'rrs_dfrac3'):
+            assert getattr(fast, name) is None
+
+    def test_batch_without_jacobian(self):
+        batch = random_free_parameters(4)
+        results = self.context.evaluate_batch(
+            compute_jacobian=False, **batch)
+        assert results.rrs.shape == (4, 551)
+        assert results.rrs_dchl is None
+
+    def test_subset(self):
+        batch = random_free_parameters(10)
+        full = self.context.evaluate_batch(**batch)
+        mask = (self.context.wavelengths > 500) & \
+            (self.context.wavelengths < 600)
+        for bands in (np.flatnonzero(mask)[::3], mask):
+            subset = self.context.subset(bands)
+            results = subset.evaluate_batch(**batch)
+            assert subset.num_bands == len(subset.wavelengths)
+            for name in ('rrs',) + sbc.JACOBIAN_FIELDS:
+                assert np.array_equal(
+                    getattr(results, name), getattr(full, name)[:, bands]), \
+                    name
+        assert self.context.num_bands == 551
+        with pytest.raises(ValueError):
+            self.context.subset(np.zeros((2, 2), dtype=np.intp))
+
+    def test_jacobian_matches_finite_differences(self):
+        base = self.context.evaluate(**self.free)
+        derivatives = {
+            'chl': base.rrs_dchl,
+            'cdom': base.rrs_dcdom,
+            'nap': base.rrs_dnap,
+            'depth': base.rrs_ddepth,
+            'sub1_frac': base.rrs_dfrac1,
+            'sub2_frac': base.rrs_dfrac2,
+            'sub3_frac': base.rrs_dfrac3,
+        }
+        for name, derivative in derivatives.items():
+            step = 1e-6 * max(1.0, abs(self.free[name]))
+            upper = self.context.evaluate(
+                compute_jacobian=False,
+                **dict(self.free, **{name: self.free[name] + step}))
+            lower = self.context.evaluate(
+                compute_jacobian=False,
+                **dict(self.free, **{name: self.free[name] - step}))
+            numerical = (upper.rrs - lower.rrs) / (2.0 * step)
+            assert np.allclose(derivative, numerical, rtol=1e-4, atol=1e-9), \
+                name
+
+
+class TestBottomLogDerivatives(object):
+
+    """The water column derivatives of the substrate term."""
+
+    def test_fraction_change(self):
+        _, fixed, _ = load_forward_model_test_data()
+        context = sbc.ForwardModelContext(**fixed)
+        batch = random_free_parameters(5)
+        first = context.evaluate_batch(**batch)
+        batch['sub1_frac'] = batch['sub1_frac'] * 0.5
+        second = context.evaluate_batch(**batch)
+
+        derivatives = context._bottom_log_derivatives(first, batch['depth'])
+        change = second.rrs - first.rrs
+        for i, name in enumerate(sbc.JACOBIAN_FIELDS[:4]):
+            assert np.allclose(
+                getattr(second, name) - getattr(first, name),
+                derivatives[..., i] * change,
+                rtol=1e-9,
+                atol=1e-14)
+
+
+class TestWaterColumn(object):
+
+    """Evaluation from cached water column terms."""
+
+    @classmethod
+    def setup_class(cls):
+        _, fixed, _ = load_forward_model_test_data()
+        cls.context = sbc.ForwardModelContext(**fixed)
+        cls.batch = random_free_parameters(20)
+        cls.terms = cls.context.water_column(
+            cls.batch['chl'], cls.batch['cdom'], cls.batch['nap'])
+
+    def test_terms_match_evaluate_batch(self):
+        expected = self.context.evaluate_batch(
+            compute_jacobian=False, **self.batch)
+        for name in ('a', 'bb', 'rrsdp', 'kd', 'kuc', 'kub'):
+            assert np.array_equal(getattr(self.terms, name),
+                                  getattr(expected, name)), name
+
+    def test_rrs_matches_evaluate_batch(self):
+        expected = self.context.evaluate_batch(**self.batch)
+        actual = self.context.evaluate_water_column(
+            self.terms,
+            self.batch['depth'],
+            self.batch['sub1_frac'],
+            self.batch['sub2_frac'],
+            self.batch['sub3_frac'],
+            compute_ddepth=True)
+        assert np.array_equal(actual.rrs, expected.rrs)
+        assert np.allclose(actual.rrs_ddepth, expected.rrs_ddepth,
+                           rtol=1e-12, atol=0.0)
+
+    def test_depth_sweep(self):
+        depths = np.linspace(0.5, 10.0, 7)[:, np.newaxis]
+        actual = self.context.evaluate_water_column(
+            self.terms, depths, 0.2, 0.3, 0.5)
+        assert actual.rrs.shape == (7, 20, self.context.num_bands)
+        assert actual.rrs_ddepth is None
+        for i, depth in enumerate(depths[:, 0]):
+            expected = self.context.evaluate_batch(
+                self.batch['chl'], self.batch['cdom'], self.batch['nap'],
+                depth, 0.2, 0.3, 0.5, compute_jacobian=False)
+            assert np.array_equal(actual.rrs[i], expected.rrs)
+
+    def test_single_water_column(self):
+        terms = self.context.water_column(0.3, 0.02, 1.0)
+        assert terms.kappa.shape == (self.context.num_bands,)
+        sweep = self.context.evaluate_water_column(
+            terms, [1.0, 2.0, 3.0], 1.0, 0.0, 0.0)
+        assert sweep.rrs.shape == (3, self.context.num_bands)
+        expected = self.context.evaluate(0.3, 0.02, 1.0, 2.0, 1.0, 0.0, 0.0)
+        assert np.array_equal(sweep.rrs[1], expected.rrs)
+
+    def test_precision(self):
+        _, fixed, _ = load_forward_model_test_data()
+        context = sbc.ForwardModelContext(dtype=np.float32, **fixed)
+        terms = context.water_column(0.3, 0.02, 1.0)
+        results = context.evaluate_water_column(terms, 2.0, 0.5, 0.5, 0.0)
+        assert terms.rrsdp.dtype == np.float32
+        assert results.rrs.dtype == np.float32
+
+
+class TestOpticallyDeep(object):
+
+    """Optically-deep detection and evaluation."""
+
+    @classmethod
+    def setup_class(cls):
+        _, fixed, _ = load_forward_model_test_data()
+        cls.context = sbc.ForwardModelContext(**fixed)
+        cls.batch = random_free_parameters(200)
+        # Mostly deep, with some shallow pixels
+        cls.batch['depth'] = np.random.RandomState(3).uniform(5.0, 150.0, 200)
+        cls.tolerance = 1e-6
+        cls.expected = cls.context.evaluate_batch(**cls.batch)
+
+    def test_detection_bound(self):
+        deep = self.context.optically_deep(
+            tolerance=self.tolerance, **self.batch)
+        assert deep.shape == self.expected.rrs.shape
+        assert deep.any() and not deep.all()
+        change = np.abs(self.expected.rrs - self.expected.rrsdp)
+        assert np.all(change[deep] <= self.tolerance)
+
+    def test_zero_tolerance(self):
+        deep = self.context.optically_deep(tolerance=0.0, **self.batch)
+        assert not deep.any()
+        actual = self.context.evaluate_batch(deep_tolerance=0.0, **self.batch)
+        for name in actual._fields:
+            assert np.array_equal(getattr(actual, name),
+                                  getattr(self.expected, name)), name
+
+    def test_mixed_batch(self):
+        deep = np.all(self.context.optically_deep(
+            tolerance=self.tolerance, **self.batch), axis=1)
+        assert 0.5 < deep.mean() < 1.0
+        actual = self.context.evaluate_batch(
+            deep_tolerance=self.tolerance, **self.batch)
+        for name in actual._fields:
+            assert getattr(actual, name).shape == self.expected.rrs.shape
+        assert np.allclose(actual.rrs, self.expected.rrs,
+                           rtol=0.0, atol=self.tolerance)
+        # Shallow pixels are evaluated by the full model
+        for name in actual._fields:
+            assert np.array_equal(getattr(actual, name)[~deep],
+                                  getattr(self.expected, name)[~deep]), name
+        assert np.array_equal(actual.rrs[deep], actual.rrsdp[deep])
+        assert np.all(actual.rrs_ddepth[deep] == 0.0)
+        assert np.all(actual.rrs_dfrac1[deep] == 0.0)
+        for name in ('rrsdp', 'kd', 'kuc', 'kub', 'a', 'bb', 'r_substratum'):
+            assert np.array_equal(getattr(actual, name),
+                                  getattr(self.expected, name)), name
+        for name in ('rrs_dchl', 'rrs_dcdom', 'rrs_dnap'):
+            assert np.allclose(getattr(actual, name)[deep],
+                               getattr(self.expected, name)[deep],
+                               rtol=1e-3, atol=1e-5), name
+
+    def test_deep_mode(self):
+        actual = self.context.evaluate_batch(
+            deep_tolerance=np.inf, compute_jacobian=False, **self.batch)
+        assert np.array_equal(actual.rrs, self.expected.rrsdp)
+        assert np.array_equal(actual.r_0_minus,
+                              self.expected.rdp_0_minus)
+        assert actual.rrs_ddepth is None
+
+
+class TestLinearised(object):
+
+    """Linearised re-evaluation from the Jacobian."""
+
+    @classmethod
+    def setup_class(cls):
+        _, fixed, _ = load_forward_model_test_data()
+        cls.context = sbc.ForwardModelContext(**fixed)
+        batch = random_free_parameters(200)
+        cls.parameters = np.stack(
+            [batch[name] for name in sbc.FREE_PARAMETERS], axis=-1)
+        cls.results = cls.context.evaluate_batch(*cls.parameters.T)
+        cls.delta = np.random.RandomState(5).normal(
+            size=cls.parameters.shape) * \
+            np.maximum(np.abs(cls.parameters), 0.05)
+
+    def evaluate(self, delta):
+        return self.context.evaluate_batch(
+            *(self.parameters + delta).T, compute_jacobian=False).rrs
+
+    def test_error_estimate(self):
+        for scale in (1e-4, 1e-3):
+            delta = scale * self.delta
+            error = self.context.linearisation_error(
+                self.results, self.parameters[:, 3], delta)
+            predicted = self.context.evaluate_linearised(
+                self.results, self.parameters, delta, np.inf)
+            assert not predicted.evaluated.any()
+            assert np.array_equal(predicted.error, error)
+            actual = np.abs(predicted.rrs - self.evaluate(delta))
+            assert np.all(actual <= error + 1e-15)
+
+    def test_error_estimate_single_parameter_steps(self):
+        # Steps along one parameter can cancel in J . delta in some bands,
+        # so the estimate only holds as a magnitude over each pixel.
+        for scale in (1e-4, 1e-2):
+            for i in range(4):
+                delta = np.zeros_like(self.delta)
+                delta[:, i] = scale * np.maximum(
+                    np.abs(self.parameters[:, i]), 0.05)
+                predicted = self.context.evaluate_linearised(
+                    self.results, self.parameters, delta, np.inf)
+                actual = np.abs(predicted.rrs - self.evaluate(delta))
+                assert np.all(
+                    actual.max(axis=1) <=
+                    1.5 * predicted.error.max(axis=1) + 1e-15), \
+                    sbc.FREE_PARAMETERS[i]
+
+    def test_fractions_are_exact(self):
+        delta = 1e-2 * self.delta
+        delta[:, :4] = 0.0
+        predicted = self.context.evaluate_linearised(
+            self.results, self.parameters, delta, 0.0)
+        assert not predicted.evaluated.any()
+        assert np.all(predicted.error == 0.0)
+        assert np.allclose(predicted.rrs, self.evaluate(delta),
+                           rtol=0.0, atol=1e-15)
+
+    def test_fallback(self):
+        delta = 1e-3 * self.delta
+        tolerance = 1e-7
+        predicted = self.context.evaluate_linearised(
+            self.results, self.parameters, delta, tolerance)
+        evaluated = predicted.evaluated
+        assert evaluated.any() and not evaluated.all()
+        expected = self.evaluate(delta)
+        assert np.array_equal(predicted.rrs[evaluated], expected[evaluated])
+        assert np.all(predicted.error[evaluated] == 0.0)
+        # Predictions keep a safety factor of 2 below the tolerance
+        assert np.all(2.0 * predicted.error[~evaluated] <= tolerance)
+        assert np.allclose(predicted.rrs, expected, rtol=0.0, atol=tolerance)
+
+
+class TestVectorJacobianProduct(object):
+
+    """Vector-Jacobian products of the model."""
+
+    @classmethod
+    def setup_class(cls):
+        _, cls.fixed, _ = load_forward_model_test_data()
+        cls.context = sbc.ForwardModelContext(**cls.fixed)
+        cls.batch = random_free_parameters(100)
+        cls.expected = cls.context.evaluate_batch(**cls.batch)
+        cls.cotangent = np.random.RandomState(11).normal(
+            size=cls.expected.rrs.shape)
+
+    def test_matches_jacobian(self):
+        product = self.context.evaluate_vjp(
+            cotangent=self.cotangent, **self.batch)
+        assert np.array_equal(product.rrs, self.expected.rrs)
+        expected = np.einsum(
+            'nib,nb->ni', sbc.stack_jacobian(self.expected), self.cotangent)
+        assert product.gradient.shape == (100, len(sbc.FREE_PARAMETERS))
+        assert np.allclose(product.gradient, expected, rtol=1e-10,
+                           atol=1e-12 * np.abs(expected).max())
+
+    def test_callable_cotangent(self):
+        observed = self.expected.rrs[::-1]
+        product = self.context.evaluate_vjp(
+            cotangent=lambda rrs: rrs - observed, **self.batch)
+        expected = self.context.evaluate_vjp(
+            cotangent=self.expected.rrs - observed, **self.batch)
+        assert np.array_equal(product.gradient, expected.gradient)
+
+    def test_broadcasting(self):
+        parameters = [self.batch[name][0] for name in sbc.FREE_PARAMETERS]
+        product = self.context.evaluate_vjp(
+            *parameters, cotangent=self.cotangent[0])
+        assert product.gradient.shape == (1, len(sbc.FREE_PARAMETERS))
+        single = self.context.evaluate(*parameters)
+        assert np.allclose(
+            product.gradient[0],
+            np.dot(sbc.stack_jacobian(single), self.cotangent[0]))
+
+    def test_precision(self):
+        context = sbc.ForwardModelContext(dtype=np.float32, **self.fixed)
+        product = context.evaluate_vjp(
+            cotangent=self.cotangent, **self.batch)
+        assert product.rrs.dtype == np.float32
+        assert product.gradient.dtype == np.float32
@@ -0,0 +1,114 @@
+# -*- coding: utf-8 -*-
+""" Accuracy harness for the single precision forward model.
+
+The IDL reference data is effectively single precision, which is why the
+forward model tests use rtol=1e-3. These tests confirm that the float32 mode
+stays within those tolerances, both against the IDL data and against the
+float64 model.
+"""
+# Ensure compatibility of Python 2 with Python 3 constructs
+from __future__ import (
+    absolute_import,
+    division,
+    print_function,
+    unicode_literals)
+from builtins import *
+
+import numpy as np
+import pytest
+from pkg_resources import resource_filename
+from scipy.io import readsav
+
+import sambuca_core as sbc
+
+from .forward_model_inputs import (
+    ATOL,
+    RTOL,
+    load_forward_model_test_data,
+    random_free_parameters,
+)
+
+
+class TestForwardModelPrecision(object):
+
+    """float32 forward model accuracy tests."""
+
+    @classmethod
+    def setup_class(cls):
+        cls.free, cls.fixed, cls.expected = load_forward_model_test_data()
+        cls.batch = random_free_parameters(64)
+
+    def run(self, dtype, **kwargs):
+        return sbc.forward_model(
+            dtype=dtype, **dict(self.free, **dict(self.fixed, **kwargs)))
+
+    def run_batch(self, dtype):
+        return sbc.forward_model_batch(
+            dtype=dtype, **dict(self.batch, **self.fixed))
+
+    def test_float32_results_are_float32(self):
+        results = self.run(np.float32)
+        for name, field in zip(results._fields, results):
+            assert field.dtype == np.float32, name
+
+    def test_float32_batch_results_are_float32(self):
+        results = self.run_batch(np.float32)
+        for name, field in zip(results._fields, results):
+            assert field.dtype == np.float32, name
+
+    @pytest.mark.parametrize('name, idl_name', [
+        ('rrs', 'rrs'),
+        ('a', 'a'),
+        ('r_substratum', 'substrater'),
+    ])
+    def test_float32_matches_idl(self, name, idl_name):
+        results = self.run(np.float32)
+        assert np.allclose(
+            getattr(results, name),
+            getattr(self.expected, idl_name)[0],
+            atol=ATOL,
+            rtol=RTOL)
+
+    def test_float32_matches_float64(self):
+        single = self.run(np.float32)
+        double = self.run(np.float64)
+        for name, a, b in zip(double._fields, single, double):
+            assert np.allclose(a, b, atol=ATOL, rtol=RTOL), name
+
+    def test_float32_batch_matches_float64(self):
+        single = self.run_batch(np.float32)
+        double = self.run_batch(np.float64)
+        for name, a, b in zip(double._fields, single, double):
+            assert np.allclose(a, b, atol=ATOL, rtol=RTOL), name
+
+    def test_float32_workspace_matches_float64(self):
+        context = sbc.ForwardModelContext(dtype=np.float32, **self.fixed)
+        workspace = sbc.ForwardModelWorkspace(context, batch_size=64)
+        single = workspace.evaluate(**self.batch)
+        double = self.run_batch(np.float64)
+        assert single.rrs.dtype == np.float32
+        for name, a, b in zip(double._fields, single, double):
+            assert np.allclose(a, b, atol=ATOL, rtol=RTOL), name
+
+    def test_float32_sensor_filter(self):
+        data = readsav(resource_filename(
+            sbc.__name__,
+            './tests/data/sensor_filter_test_data.sav'))
+        double = sbc.apply_sensor_filter(data.input_spectra, data.filter)
+        single = sbc.apply_sensor_filter(
+            data.input_spectra, data.filter, dtype=np.float32)
+        assert single.dtype == np.float32
+        assert np.allclose(single, double, atol=ATOL, rtol=RTOL)
+
+    def test_float32_filtered_batch_matches_float64(self):
+        data = readsav(resource_filename(
+            sbc.__name__,
+            './tests/data/sensor_filter_test_data.sav'))
+        single = self.run_batch(np.float32).rrs
+        double = self.run_batch(np.float64).rrs
+        for a, b in zip(single, double):
+            assert np.allclose(
+                sbc.apply_sensor_filter(a, data.filter, dtype=np.float32),
+                sbc.apply_sensor_filter(b, data.filter),
+                atol=ATOL,
+                rtol=RTOL)
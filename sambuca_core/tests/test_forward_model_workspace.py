@@ -0,0 +1,95 @@
+# -*- coding: utf-8 -*-
+# Ensure compatibility of Python 2 with Python 3 constructs
+from __future__ import (
+    absolute_import,
+    division,
+    print_function,
+    unicode_literals)
+from builtins import *
+
+import tracemalloc
+
+import numpy as np
+import sambuca_core as sbc
+
+from .forward_model_inputs import (
+    load_forward_model_test_data,
+    random_free_parameters,
+)
+
+
+class TestForwardModelWorkspace(object):
+
+    """ForwardModelWorkspace tests."""
+
+    @classmethod
+    def setup_class(cls):
+        cls.free, cls.fixed, cls.expected = load_forward_model_test_data()
+        cls.context = sbc.ForwardModelContext(**cls.fixed)
+
+    def assert_results_close(self, actual, expected):
+        for name, a, b in zip(expected._fields, actual, expected):
+            if b is None:
+                assert a is None, name
+            else:
+                assert a.shape == b.shape, name
+                assert np.allclose(a, b, rtol=1e-12, atol=1e-15), name
+
+    def test_scalar_matches_context(self):
+        workspace = sbc.ForwardModelWorkspace(self.context)
+        self.assert_results_close(
+            workspace.evaluate(**self.free),
+            self.context.evaluate(**self.free))
+
+    def test_batch_matches_context(self):
+        batch = random_free_parameters(32)
+        workspace = sbc.ForwardModelWorkspace(self.context, batch_size=32)
+        self.assert_results_close(
+            workspace.evaluate(**batch),
+            self.context.evaluate_batch(**batch))
+
+    def test_without_jacobian(self):
+        batch = random_free_parameters(8)
+        workspace = sbc.ForwardModelWorkspace(
+            self.context, batch_size=8, compute_jacobian=False)
+        self.assert_results_close(
+            workspace.evaluate(**batch),
+            self.context.evaluate_batch(compute_jacobian=False, **batch))
+
+    def test_buffers_are_reused(self):
+        workspace = sbc.ForwardModelWorkspace(self.context, batch_size=4)
+        first = workspace.evaluate(**random_free_parameters(4, seed=1))
+        rrs = first.rrs
+        second = workspace.evaluate(**random_free_parameters(4, seed=2))
+        assert second.rrs is rrs
+
+    def test_steady_state_batch_evaluation_does_not_allocate(self):
+        self.assert_no_allocations(
+            sbc.ForwardModelWorkspace(self.context, batch_size=64),
+            random_free_parameters(64))
+
+    def test_steady_state_scalar_evaluation_does_not_allocate(self):
+        self.assert_no_allocations(
+            sbc.ForwardModelWorkspace(self.context),
+            self.free)
+
+    def assert_no_allocations(self, workspace, batch):
+        # warm up, so that any lazy one-off allocations are excluded
+        workspace.evaluate(**batch)
+
+        # A single spectrum buffer is the smallest array the kernel could
+        # allocate as a temporary.
+        spectrum_bytes = self.context.num_bands * 8
+
+        tracemalloc.start()
+        try:
+            before, _ = tracemalloc.get_traced_memory()
+            tracemalloc.reset_peak()
+            for _ in range(10):
+                workspace.evaluate(**batch)
+            after, peak = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+
+        assert after - before <= 0
+        assert peak - before < spectrum_bytes
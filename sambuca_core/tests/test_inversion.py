@@ -0,0 +1,217 @@
+# -*- coding: utf-8 -*-
+# Ensure compatibility of Python 2 with Python 3 constructs
+from __future__ import (
+    absolute_import,
+    division,
+    print_function,
+    unicode_literals)
+from builtins import *
+
+import numpy as np
+import pytest
+
+import sambuca_core as sbc
+
+from .forward_model_inputs import (
+    load_forward_model_test_data,
+    random_free_parameters,
+)
+
+
+class TestInvertBatch(object):
+
+    """Batched Levenberg-Marquardt inversion tests."""
+
+    @classmethod
+    def setup_class(cls):
+        _, fixed, _ = load_forward_model_test_data()
+        cls.context = sbc.ForwardModelContext(**fixed)
+        batch = random_free_parameters(40, seed=7)
+        # Shallow water, so that every parameter affects the spectra, and
+        # substrate3 (a copy of substrate2 in the test data) excluded.
+        batch['depth'] = np.random.RandomState(7).uniform(0.5, 5.0, 40)
+        batch['sub3_frac'][:] = 0.0
+        cls.truth = np.stack(
+            [batch[name] for name in sbc.FREE_PARAMETERS], axis=-1)
+        cls.observed = cls.context.evaluate_batch(
+            *cls.truth.T, compute_jacobian=False).rrs
+        cls.initial = np.array([0.5, 0.1, 1.0, 3.0, 0.33, 0.33, 0.0])
+        cls.lower = np.array([0.01, 0.0005, 0.2, 0.1, 0.0, 0.0, 0.0])
+        cls.upper = np.array([2.0, 0.5, 5.0, 15.0, 1.0, 1.0, 0.0])
+
+    def test_recovers_parameters(self):
+        results = sbc.invert_batch(
+            self.context, self.observed, self.initial, self.lower, self.upper)
+        assert results.converged.all()
+        assert np.allclose(results.parameters, self.truth, atol=1e-6)
+        assert np.all(results.cost < 1e-20)
+        assert np.all(results.evaluations == results.iterations + 1)
+
+    def test_converged_pixels_drop_out(self):
+        initial = np.tile(self.initial, (len(self.truth), 1))
+        # Starting at the solution converges almost immediately
+        initial[:5] = self.truth[:5]
+        results = sbc.invert_batch(
+            self.context, self.observed, initial, self.lower, self.upper)
+        assert results.iterations[:5].max() < results.iterations[5:].max()
+
+    def test_respects_bounds(self):
+        upper = self.upper.copy()
+        upper[0] = 0.2
+        results = sbc.invert_batch(
+            self.context, self.observed, self.initial, self.lower, upper)
+        assert np.all(results.parameters >= self.lower)
+        assert np.all(results.parameters <= upper)
+        assert np.allclose(
+            results.parameters[self.truth[:, 0] > 0.2, 0], 0.2)
+
+    def test_weights(self):
+        weights = np.ones(self.context.num_bands)
+        weights[::2] = 0.0
+        results = sbc.invert_batch(
+            self.context, self.observed[:5], self.initial, self.lower,
+            self.upper, weights=weights)
+        assert np.allclose(results.parameters, self.truth[:5], atol=1e-6)
+
+    def test_resume_with_damping(self):
+        full = sbc.invert_batch(
+            self.context, self.observed, self.initial, self.lower, self.upper)
+        first = sbc.invert_batch(
+            self.context, self.observed, self.initial, self.lower, self.upper,
+            max_iterations=3)
+        assert first.damping.shape == (len(self.observed),)
+        resumed = sbc.invert_batch(
+            self.context, self.observed, first.parameters, self.lower,
+            self.upper, initial_damping=first.damping)
+        # Resuming only repeats the evaluation of the starting point
+        assert np.array_equal(resumed.parameters, full.parameters)
+        assert np.array_equal(
+            first.iterations + resumed.iterations, full.iterations)
+
+    def test_stalled_pixels_are_not_converged(self):
+        # No parameters reach a flat rrs of 0.5, and a tiny max_damping
+        # stalls the inversion at the first rejected step.
+        observed = np.full((3, self.context.num_bands), 0.5)
+        results = sbc.invert_batch(
+            self.context, observed, self.initial, self.lower, self.upper,
+            initial_damping=1e-3, max_damping=1e-2)
+        assert np.all(results.iterations < 100)
+        assert not results.converged.any()
+
+    def test_invalid_and_stalled_pixels_are_not_converged(self):
+        # A missing band makes the second pixel invalid, and the third
+        # starts at a negative depth from which no step is accepted.
+        observed = self.observed[[0, 0, 23]].copy()
+        observed[1, 5] = np.nan
+        initial = np.array([
+            self.initial,
+            self.initial,
+            [2.0, 0.4, 0.8, -0.7, 0.2, 0.7, 0.0]])
+        lower = self.lower.copy()
+        lower[:4] = -5.0
+        with np.errstate(invalid='ignore'):
+            results = sbc.invert_batch(
+                self.context, observed, initial, lower, self.upper)
+        assert results.converged.tolist() == [True, False, False]
+        assert np.isinf(results.cost[1])
+        assert np.isfinite(results.cost[2])
+        assert np.all(results.damping[1:] > 1e10)
+
+    def test_band_mismatch(self):
+        with pytest.raises(ValueError):
+            sbc.invert_batch(
+                self.context, self.observed[:, :10], self.initial)
+
+    def test_invalid_bounds(self):
+        with pytest.raises(ValueError):
+            sbc.invert_batch(
+                self.context, self.observed, self.initial,
+                lower_bounds=self.upper + 1.0)
+
+    def test_project_fractions(self):
+        initial = self.initial.copy()
+        initial[4:6] = [1.0, 0.0]
+        full = sbc.invert_batch(
+            self.context, self.observed, initial, self.lower, self.upper)
+        projected = sbc.invert_batch(
+            self.context, self.observed, initial, self.lower, self.upper,
+            project_fractions=True)
+        assert projected.converged.all()
+        assert np.allclose(projected.parameters, self.truth, atol=1e-6)
+        # Noise free spectra fit to round-off, where the last steps of some
+        # pixels are rejected many times over.
+        assert np.median(projected.evaluations) < \
+            np.median(full.evaluations)
+
+    def test_linear_tolerance(self):
+        full = sbc.invert_batch(
+            self.context, self.observed, self.initial, self.lower, self.upper)
+        linearised = sbc.invert_batch(
+            self.context, self.observed, self.initial, self.lower, self.upper,
+            linear_tolerance=1e-8)
+        assert linearised.converged.all()
+        assert np.allclose(linearised.parameters, self.truth, atol=1e-6)
+        assert np.all(linearised.cost < 1e-16)
+        assert np.all(linearised.evaluations <= linearised.iterations)
+        assert linearised.evaluations.sum() < full.evaluations.sum()
+        # The final costs are evaluated, not predicted
+        rrs = self.context.evaluate_batch(
+            *linearised.parameters.T, compute_jacobian=False).rrs
+        cost = 0.5 * np.sum((rrs - self.observed) ** 2, axis=1)
+        assert np.allclose(linearised.cost, cost, rtol=1e-12, atol=0.0)
+
+    def test_linear_tolerance_with_projection(self):
+        with pytest.raises(ValueError):
+            sbc.invert_batch(
+                self.context, self.observed, self.initial,
+                project_fractions=True, linear_tolerance=1e-8)
+
+
+class TestSolveFractions(object):
+
+    """Closed-form bounded substrate fraction solve tests."""
+
+    def test_matches_lsq_linear(self):
+        optimize = pytest.importorskip('scipy.optimize')
+        rng = np.random.RandomState(5)
+        bottom = rng.uniform(0.0, 1.0, (30, 3, 12))
+        target = rng.uniform(-0.5, 2.0, (30, 12))
+        weights = rng.uniform(0.5, 2.0, (30, 12))
+        lower = np.array([0.0, 0.0, 0.1])
+        upper = np.array([1.0, 0.5, 0.1])
+
+        fractions = sbc.solve_fractions(
+            bottom, target, lower, upper, np.sqrt(weights))
+        for i in range(len(target)):
+            sqrt_w = np.sqrt(weights[i])
+            expected = optimize.lsq_linear(
+                bottom[i].T * sqrt_w[:, np.newaxis],
+                target[i] * sqrt_w,
+                bounds=(lower - [0, 0, 1e-15], upper)).x
+            assert np.allclose(fractions[i], expected, atol=1e-6)
+
+    def test_linearly_dependent_substrates(self):
+        bottom = np.ones((1, 3, 5))
+        fractions = sbc.solve_fractions(
+            bottom, np.full((1, 5), 0.6), np.zeros(3), np.ones(3))
+        assert np.isclose(fractions.sum(), 0.6)
+
+
+class TestPerPixelBounds(object):
+
+    """Per-pixel bounds in invert_batch."""
+
+    def test_per_pixel_bounds(self):
+        _, fixed, _ = load_forward_model_test_data()
+        context = sbc.ForwardModelContext(**fixed)
+        truth = np.array([[0.8, 0.1, 1.5, 2.0, 0.6, 0.3, 0.0]] * 2)
+        observed = context.evaluate_batch(*truth.T).rrs
+        lower = np.zeros((2, 7))
+        upper = np.tile([2.0, 0.5, 5.0, 15.0, 1.0, 1.0, 0.0], (2, 1))
+        upper[1, 0] = 0.5
+        for project_fractions in (False, True):
+            results = sbc.invert_batch(
+                context, observed, [0.3, 0.2, 1.0, 3.0, 0.5, 0.5, 0.0],
+                lower, upper, project_fractions=project_fractions)
+            assert np.allclose(results.parameters[0], truth[0], atol=1e-6)
+            assert np.isclose(results.parameters[1, 0], 0.5)
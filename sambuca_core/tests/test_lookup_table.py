@@ -0,0 +1,126 @@
+# -*- coding: utf-8 -*-
+# Ensure compatibility of Python 2 with Python 3 constructs
+from __future__ import (
+    absolute_import,
+    division,
+    print_function,
+    unicode_literals)
+from builtins import *
+
+import os
+
+import numpy as np
+import pytest
+import sambuca_core as sbc
+
+from .forward_model_inputs import load_forward_model_test_data
+
+
+class TestRrsLookupTable(object):
+
+    """rrs lookup table tests."""
+
+    @classmethod
+    def setup_class(cls):
+        _, fixed, _ = load_forward_model_test_data()
+        cls.context = sbc.ForwardModelContext(**fixed)
+        cls.axes = dict(
+            chl=[0.1, 0.5, 1.0],
+            cdom=[0.01, 0.1],
+            nap=[0.5, 1.0, 2.0],
+            depth=[1.0, 2.0, 5.0, 10.0],
+            sub1_frac=[0.0, 1.0],
+            sub2_frac=[0.0, 1.0],
+            sub3_frac=[0.0])
+
+    def build(self, tmpdir, chunk_size=10):
+        return sbc.build_rrs_lookup_table(
+            self.context,
+            os.path.join(str(tmpdir), 'lut'),
+            chunk_size=chunk_size,
+            **self.axes)
+
+    def grid_parameters(self, *indices):
+        return np.array([
+            self.axes[name][i]
+            for name, i in zip(sbc.LUT_PARAMETERS, indices)])
+
+    def test_grid_values_match_forward_model(self, tmpdir):
+        lut = self.build(tmpdir)
+        assert lut.rrs.shape == (3, 2, 3, 4, 2, 2, 1, 551)
+        p = self.grid_parameters(2, 1, 0, 3, 1, 0, 0)
+        expected = self.context.evaluate(*p).rrs
+        assert np.allclose(lut.rrs[2, 1, 0, 3, 1, 0, 0], expected)
+
+    def test_chunk_size_does_not_change_table(self, tmpdir):
+        small = self.build(tmpdir.mkdir('small'), chunk_size=7)
+        large = self.build(tmpdir.mkdir('large'), chunk_size=100000)
+        assert np.array_equal(np.asarray(small.rrs), np.asarray(large.rrs))
+
+    def test_load(self, tmpdir):
+        built = self.build(tmpdir)
+        loaded = sbc.RrsLookupTable.load(os.path.join(str(tmpdir), 'lut'))
+        assert isinstance(loaded.rrs, np.memmap)
+        assert np.array_equal(np.asarray(loaded.rrs), np.asarray(built.rrs))
+        for a, b in zip(loaded.axes, built.axes):
+            assert np.array_equal(a, b)
+        assert np.allclose(loaded.wavelengths, self.context.wavelengths)
+
+    def test_nearest(self, tmpdir):
+        lut = self.build(tmpdir)
+        near = self.grid_parameters(1, 0, 2, 1, 1, 1, 0) + \
+            np.array([0.01, 0.001, -0.01, 0.1, -0.1, -0.2, 0.0])
+        results = lut.nearest(np.vstack([near, near]))
+        assert results.shape == (2, 551)
+        assert np.array_equal(results[0], lut.rrs[1, 0, 2, 1, 1, 1, 0])
+
+    def test_interpolate_at_grid_points(self, tmpdir):
+        lut = self.build(tmpdir)
+        p = self.grid_parameters(1, 1, 2, 2, 0, 1, 0)
+        assert np.allclose(
+            lut.interpolate(p)[0],
+            lut.rrs[1, 1, 2, 2, 0, 1, 0])
+
+    def test_interpolate_linear_substrate_fractions_is_exact(self, tmpdir):
+        # rrs is linear in the substrate fractions, so interpolating along
+        # those axes only must reproduce the forward model.
+        lut = self.build(tmpdir)
+        p = self.grid_parameters(0, 1, 1, 2, 0, 0, 0)
+        p[4] = 0.3
+        p[5] = 0.6
+        expected = self.context.evaluate(*p).rrs
+        assert np.allclose(lut.interpolate(p)[0], expected)
+
+    def test_interpolate_between_grid_points(self, tmpdir):
+        lut = self.build(tmpdir)
+        p = self.grid_parameters(1, 0, 1, 2, 1, 0, 0)
+        p[3] = 3.0
+        # depth 3.0 is a third of the way from the depth 2.0 to 5.0 nodes
+        expected = (2.0 / 3.0) * lut.rrs[1, 0, 1, 1, 1, 0, 0] + \
+            (1.0 / 3.0) * lut.rrs[1, 0, 1, 2, 1, 0, 0]
+        assert np.allclose(lut.interpolate(p)[0], expected)
+
+    def test_query_chunks(self, tmpdir):
+        lut = self.build(tmpdir)
+        rng = np.random.RandomState(0)
+        lower = np.array([axis[0] for axis in lut.axes])
+        upper = np.array([axis[-1] for axis in lut.axes])
+        p = lower + rng.uniform(size=(50, 7)) * (upper - lower)
+        assert np.allclose(
+            lut.interpolate(p, chunk_size=7),
+            lut.interpolate(p, chunk_size=1000))
+        assert np.array_equal(
+            lut.nearest(p, chunk_size=7),
+            lut.nearest(p, chunk_size=1000))
+
+    def test_invalid_axis(self, tmpdir):
+        with pytest.raises(ValueError):
+            sbc.build_rrs_lookup_table(
+                self.context,
+                os.path.join(str(tmpdir), 'lut'),
+                **dict(self.axes, chl=[1.0, 0.5]))
+
+    def test_invalid_query_shape(self, tmpdir):
+        lut = self.build(tmpdir)
+        with pytest.raises(ValueError):
+            lut.nearest(np.zeros((3, 4)))
@@ -0,0 +1,78 @@
+# -*- coding: utf-8 -*-
+# Ensure compatibility of Python 2 with Python 3 constructs
+from __future__ import (
+    absolute_import,
+    division,
+    print_function,
+    unicode_literals)
+from builtins import *
+
+import numpy as np
+import pytest
+
+import sambuca_core as sbc
+
+from .forward_model_inputs import (
+    load_forward_model_test_data,
+    random_free_parameters,
+)
+
+
+class TestRunScene(object):
+
+    """Process-pool scene runner tests."""
+
+    @classmethod
+    def setup_class(cls):
+        _, fixed, _ = load_forward_model_test_data()
+        cls.context = sbc.ForwardModelContext(**fixed)
+        batch = random_free_parameters(15)
+        cls.parameters = np.stack(
+            [batch[name] for name in sbc.FREE_PARAMETERS],
+            axis=-1).reshape(3, 5, 7)
+
+    def test_matches_forward_model_batch(self):
+        results = sbc.run_scene(
+            self.context, self.parameters, max_workers=2, tile_size=4)
+        expected = self.context.evaluate_batch(
+            *self.parameters.reshape(-1, 7).T, compute_jacobian=False)
+        assert results.rrs.shape == (3, 5, self.context.num_bands)
+        assert results.jacobian is None
+        assert np.allclose(
+            results.rrs.reshape(-1, self.context.num_bands), expected.rrs)
+
+    def test_jacobian(self):
+        results = sbc.run_scene(
+            self.context,
+            self.parameters,
+            max_workers=1,
+            compute_jacobian=True)
+        expected = self.context.evaluate_batch(
+            *self.parameters.reshape(-1, 7).T)
+        assert results.jacobian.shape == (3, 5, 7, self.context.num_bands)
+        for i, name in enumerate(sbc.JACOBIAN_FIELDS):
+            assert np.allclose(
+                results.jacobian[..., i, :].reshape(expected.rrs.shape),
+                getattr(expected, name))
+
+    def test_memory_budget(self):
+        # A budget below the memory of one pixel gives one pixel per tile
+        results = sbc.run_scene(
+            self.context, self.parameters, max_workers=1, memory_budget=1)
+        expected = self.context.evaluate_batch(
+            *self.parameters.reshape(-1, 7).T, compute_jacobian=False)
+        assert np.allclose(
+            results.rrs.reshape(-1, self.context.num_bands), expected.rrs)
+
+        # pylint: disable=protected-access
+        budget = 64 * 1024 * 1024
+        pixel_bytes = 8 * self.context.num_bands
+        tile_size = sbc.scene._tile_size(self.context, False, budget)
+        assert tile_size * 26 * pixel_bytes <= budget
+        assert (tile_size + 1) * 26 * pixel_bytes > budget
+        # The Jacobian needs more memory per pixel
+        assert sbc.scene._tile_size(self.context, True, budget) < tile_size
+
+    def test_invalid_parameter_shape(self):
+        with pytest.raises(ValueError):
+            sbc.run_scene(self.context, self.parameters.reshape(15, 7))
@@ -0,0 +1,158 @@
+# -*- coding: utf-8 -*-
+# Ensure compatibility of Python 2 with Python 3 constructs
+from __future__ import (
+    absolute_import,
+    division,
+    print_function,
+    unicode_literals)
+from builtins import *
+
+import numpy as np
+import pytest
+
+import sambuca_core as sbc
+
+from .forward_model_inputs import load_forward_model_test_data
+
+
+def smooth_scene(context, rows, cols):
+    """ A synthetic scene whose parameters vary smoothly across the image.
+    """
+    y, x = np.mgrid[0:rows, 0:cols]
+    y = y / float(rows)
+    x = x / float(cols)
+    truth = np.stack([
+        0.2 + 0.6 * x,
+        0.02 + 0.1 * y,
+        0.5 + 2.0 * x * y,
+        1.0 + 4.0 * y,
+        0.2 + 0.6 * x,
+        0.7 - 0.6 * x,
+        np.zeros_like(x)], axis=-1)
+    observed = context.evaluate_batch(
+        *truth.reshape(-1, 7).T,
+        compute_jacobian=False).rrs.reshape(rows, cols, -1)
+    return truth, observed
+
+
+class TestInvertScene(object):
+
+    """Warm-started scene inversion tests."""
+
+    @classmethod
+    def setup_class(cls):
+        _, fixed, _ = load_forward_model_test_data()
+        cls.context = sbc.ForwardModelContext(**fixed)
+        cls.truth, cls.observed = smooth_scene(cls.context, 6, 8)
+        cls.initial = np.array([0.5, 0.1, 1.0, 3.0, 0.33, 0.33, 0.0])
+        cls.lower = np.array([0.01, 0.0005, 0.2, 0.1, 0.0, 0.0, 0.0])
+        cls.upper = np.array([2.0, 0.5, 5.0, 15.0, 1.0, 1.0, 0.0])
+
+    def test_warm_start_reduces_evaluations(self):
+        cold = sbc.invert_scene(
+            self.context, self.observed, self.initial, self.lower,
+            self.upper, warm_start=False)
+        warm = sbc.invert_scene(
+            self.context, self.observed, self.initial, self.lower,
+            self.upper)
+        assert warm.parameters.shape == self.truth.shape
+        assert np.allclose(warm.parameters, self.truth, atol=1e-6)
+        assert np.allclose(cold.parameters, self.truth, atol=1e-6)
+        assert warm.evaluations.sum() < cold.evaluations.sum()
+        assert not cold.fallback.any()
+
+    def test_fallback(self):
+        results = sbc.invert_scene(
+            self.context, self.observed, self.initial, self.lower,
+            self.upper, fallback_cost=-1.0)
+        assert not results.fallback[0].any()
+        assert results.fallback[1:].all()
+        assert np.allclose(results.parameters, self.truth, atol=1e-6)
+
+    def test_default_fallback_cost_is_floored(self):
+        # A first row observed at the initial parameters fits with a cost of
+        # exactly 0, which must not send every warm-started pixel to the
+        # fallback.
+        truth = self.truth.copy()
+        truth[0] = self.initial
+        observed = self.context.evaluate_batch(
+            *truth.reshape(-1, 7).T,
+            compute_jacobian=False).rrs.reshape(self.observed.shape)
+        results = sbc.invert_scene(
+            self.context, observed, self.initial, self.lower, self.upper)
+        assert np.all(results.cost[0] == 0.0)
+        assert not results.fallback.any()
+        assert np.allclose(results.parameters, truth, atol=1e-6)
+
+    def test_keyword_arguments_are_passed_on(self):
+        results = sbc.invert_scene(
+            self.context, self.observed[:2], self.initial, self.lower,
+            self.upper, max_iterations=1)
+        assert np.all(results.evaluations <= 2)
+
+    def test_invalid_shape(self):
+        with pytest.raises(ValueError):
+            sbc.invert_scene(
+                self.context, self.observed[0], self.initial)
+
+
+class TestBlockAverage(object):
+
+    """Pyramid block averaging tests."""
+
+    def test_exact_blocks(self):
+        cube = np.arange(16.0).reshape(4, 4, 1)
+        averaged = sbc.block_average(cube, 2)
+        assert averaged.shape == (2, 2, 1)
+        assert np.allclose(averaged[..., 0], [[2.5, 4.5], [10.5, 12.5]])
+
+    def test_partial_edge_blocks(self):
+        cube = np.arange(15.0).reshape(3, 5)
+        averaged = sbc.block_average(cube, 2)
+        assert averaged.shape == (2, 3)
+        assert np.isclose(averaged[0, 2], np.mean([4.0, 9.0]))
+        assert np.isclose(averaged[1, 2], 14.0)
+        assert np.isclose(averaged[1, 0], np.mean([10.0, 11.0]))
+
+
+class TestInvertPyramid(object):
+
+    """Coarse-to-fine pyramid inversion tests."""
+
+    @classmethod
+    def setup_class(cls):
+        _, fixed, _ = load_forward_model_test_data()
+        cls.context = sbc.ForwardModelContext(**fixed)
+        cls.truth, cls.observed = smooth_scene(cls.context, 7, 9)
+        cls.initial = np.array([0.5, 0.1, 1.0, 3.0, 0.33, 0.33, 0.0])
+        cls.lower = np.array([0.01, 0.0005, 0.2, 0.1, 0.0, 0.0, 0.0])
+        cls.upper = np.array([2.0, 0.5, 5.0, 15.0, 1.0, 1.0, 0.0])
+
+    def test_recovers_parameters(self):
+        results = sbc.invert_pyramid(
+            self.context, self.observed, self.initial, self.lower,
+            self.upper, levels=3)
+        assert results.parameters.shape == self.truth.shape
+        assert np.allclose(results.parameters, self.truth, atol=1e-6)
+        assert len(results.level_evaluations) == 3
+        assert results.level_evaluations[0] == results.evaluations.sum()
+
+    def test_tiles_match_single_tile(self):
+        window = np.array([0.5, 0.1, 1.0, 2.0, 0.5, 0.5, 0.0])
+        single = sbc.invert_pyramid(
+            self.context, self.observed, self.initial, self.lower,
+            self.upper, window=window)
+        tiled = sbc.invert_pyramid(
+            self.context, self.observed, self.initial, self.lower,
+            self.upper, window=window, memory_budget=1)
+        assert np.array_equal(single.parameters, tiled.parameters)
+        assert single.level_evaluations == tiled.level_evaluations
+
+    def test_memmap_input(self, tmpdir):
+        filename = str(tmpdir.join('observed.npy'))
+        np.save(filename, self.observed)
+        observed = np.load(filename, mmap_mode='r')
+        results = sbc.invert_pyramid(
+            self.context, observed, self.initial, self.lower, self.upper,
+            levels=2, memory_budget=1)
+        assert np.allclose(results.parameters, self.truth, atol=1e-6)
@@ -7,6 +7,7 @@ from __future__ import (
     unicode_literals)
 
 import numpy as np
+import pytest
 import spectral.io.envi as envi
 from scipy.io import loadmat, readsav
 from pkg_resources import resource_filename
@@ -164,3 +165,274 @@ class TestSensorFilter(object):
         assert expected_spectra.shape == resampled_spectra.shape
         assert np.allclose(expected_spectra, resampled_spectra)
 
+
+
+class TestSensorFilterObject(object):
+
+    """ SensorFilter tests. """
+
+    @classmethod
+    def setup_class(cls):
+        directory = resource_filename(
+            sbc.__name__, 'tests/data/sensor_filters')
+        cls.sensor_filter = sbc.load_sensor_filter_spectral_library(
+            directory, 'qbtest_filter_350_900nm')
+        cls.input_spectra = envi.open(
+            resource_filename(
+                sbc.__name__, 'tests/data/qbtest_input_spectra.hdr'),
+            resource_filename(
+                sbc.__name__, 'tests/data/qbtest_input_spectra.lib')).spectra
+
+    def test_unpacks_as_tuple(self):
+        wavelengths, response = self.sensor_filter
+        assert isinstance(self.sensor_filter, sbc.SensorFilter)
+        assert wavelengths is self.sensor_filter.wavelengths
+        assert response is self.sensor_filter.response
+        assert response.shape == (
+            self.sensor_filter.num_bands, len(wavelengths))
+        assert self.sensor_filter.wavelength_range == (350, 900)
+
+    def test_operator_is_cached(self):
+        operator = self.sensor_filter.operator
+        assert operator is self.sensor_filter.operator
+        assert not operator.flags.writeable
+        assert np.array_equal(
+            operator,
+            sbc.sensor_filter_operator(self.sensor_filter.response))
+        single = self.sensor_filter.operator_as(np.float32)
+        assert single.dtype == np.float32
+        assert single is self.sensor_filter.operator_as(np.float32)
+
+    def test_band_centres(self):
+        centres = self.sensor_filter.band_centres
+        assert centres.shape == (self.sensor_filter.num_bands,)
+        assert np.all(np.diff(centres) > 0)
+        assert np.all((centres > 350) & (centres < 900))
+
+    def test_apply_matches_apply_sensor_filter(self):
+        spectrum = self.input_spectra[0]
+        expected = sbc.apply_sensor_filter(
+            spectrum, self.sensor_filter.response)
+        assert np.allclose(self.sensor_filter.apply(spectrum), expected)
+
+        batch = self.input_spectra
+        expected = sbc.apply_sensor_filter(
+            batch.T, self.sensor_filter.response).T
+        assert np.allclose(self.sensor_filter.apply(batch), expected)
+
+        cube = np.stack([batch, batch[::-1]])
+        filtered = self.sensor_filter.apply(cube)
+        assert filtered.shape == (2, len(batch), self.sensor_filter.num_bands)
+        assert np.allclose(filtered[0], expected)
+        assert np.allclose(filtered[1], expected[::-1])
+
+    def test_apply_dtype(self):
+        filtered = self.sensor_filter.apply(
+            self.input_spectra, dtype=np.float32)
+        assert filtered.dtype == np.float32
+
+    def test_apply_wrong_bands(self):
+        with pytest.raises(ValueError):
+            self.sensor_filter.apply(self.input_spectra[:, :10])
+
+
+class TestBandedSensorFilter(object):
+
+    """ Tests of the banded form of SensorFilter operators. """
+
+    @classmethod
+    def setup_class(cls):
+        cls.casi04 = sbc.load_sensor_filter_spectral_library(
+            resource_filename(sbc.__name__, 'tests/data/sensor_filters'),
+            'CASI04_350_900_1nm')
+        # Narrow Gaussian bands, which each cover a few percent of the input
+        wavelengths = np.arange(400, 801, dtype=np.float64)
+        centres = np.linspace(410, 790, 40)
+        response = np.exp(
+            -0.5 * ((wavelengths - centres[:, np.newaxis]) / 4.0) ** 2)
+        response[response < 1e-3] = 0.0
+        cls.narrow = sbc.SensorFilter(wavelengths, response)
+
+    def test_float32_response(self):
+        # The CASI04 library is float32, but the default operator is
+        # normalised in double precision.
+        assert self.casi04.response.dtype == np.float32
+        assert self.casi04.operator.dtype == np.float64
+        assert self.casi04.operator_as(np.float32).dtype == np.float32
+        spectra = np.random.RandomState(1).uniform(size=(20, 551))
+        expected = sbc.apply_sensor_filter(
+            spectra.T, self.casi04.response).T
+        assert expected.dtype == np.float64
+        assert np.allclose(
+            self.casi04.apply(spectra), expected, rtol=1e-13, atol=0)
+        assert np.allclose(
+            self.casi04.apply(spectra[0]), expected[0], rtol=1e-13, atol=0)
+
+    def test_band_windows(self):
+        starts, stops = self.narrow.band_windows
+        nonzero = self.narrow.response != 0
+        for band, (start, stop) in enumerate(zip(starts, stops)):
+            assert nonzero[band, start] and nonzero[band, stop - 1]
+            assert not nonzero[band, :start].any()
+            assert not nonzero[band, stop:].any()
+
+    def test_blocks_cover_the_operator(self):
+        for sensor_filter in (self.casi04, self.narrow):
+            operator = np.zeros_like(sensor_filter.operator)
+            for outputs, inputs, block in sensor_filter.blocks():
+                assert block.flags.c_contiguous
+                assert not block.flags.writeable
+                operator[inputs, outputs] = block
+            assert np.array_equal(operator, sensor_filter.operator)
+
+    def test_narrow_filter_is_banded(self):
+        blocks = self.narrow.blocks()
+        assert len(blocks) > 1
+        stored = sum(block.size for _, _, block in blocks)
+        assert stored < 0.5 * self.narrow.operator.size
+
+    def test_apply_matches_dense_product(self):
+        rng = np.random.RandomState(0)
+        for sensor_filter in (self.casi04, self.narrow):
+            # Enough spectra for several row chunks
+            spectra = rng.uniform(
+                size=(3000, sensor_filter.num_input_bands))
+            expected = np.dot(spectra, sensor_filter.operator)
+            filtered = sensor_filter.apply(spectra)
+            assert np.allclose(filtered, expected, rtol=1e-12, atol=0)
+
+            cube = sensor_filter.apply(spectra.reshape(30, 100, -1))
+            assert np.array_equal(cube.reshape(filtered.shape), filtered)
+
+            single = sensor_filter.apply(spectra, dtype=np.float32)
+            assert single.dtype == np.float32
+            assert np.allclose(single, expected, rtol=1e-5)
+
+
+class TestFilterCube(object):
+
+    """ filter_cube tests. """
+
+    @classmethod
+    def setup_class(cls):
+        cls.sensor_filter = sbc.load_sensor_filter_spectral_library(
+            resource_filename(sbc.__name__, 'tests/data/sensor_filters'),
+            'CASI04_350_900_1nm')
+        cls.cube = np.random.RandomState(0).uniform(
+            size=(13, 7, cls.sensor_filter.num_input_bands))
+        cls.expected = cls.sensor_filter.apply(cls.cube)
+
+    def test_in_memory(self):
+        filtered = sbc.filter_cube(self.sensor_filter, self.cube)
+        assert np.array_equal(filtered, self.expected)
+
+    def test_response_function(self):
+        filtered = sbc.filter_cube(self.sensor_filter.response, self.cube)
+        assert np.allclose(filtered, self.expected)
+
+    @pytest.mark.parametrize('max_workers', [None, 3])
+    def test_memory_mapped(self, tmpdir, max_workers):
+        input_filename = str(tmpdir.join('cube.npy'))
+        output_filename = str(tmpdir.join('filtered.npy'))
+        np.save(input_filename, self.cube)
+        # A budget of one byte filters a single row per block
+        filtered = sbc.filter_cube(
+            self.sensor_filter, input_filename, output_filename,
+            memory_budget=1, max_workers=max_workers)
+        assert isinstance(filtered, np.memmap)
+        assert np.array_equal(filtered, self.expected)
+        assert np.array_equal(np.load(output_filename), self.expected)
+
+    def test_output_array(self):
+        output = np.zeros(self.expected.shape, dtype=np.float32)
+        filtered = sbc.filter_cube(
+            self.sensor_filter, self.cube, output, dtype=np.float32,
+            memory_budget=20000, max_workers=2)
+        assert filtered is output
+        assert np.allclose(output, self.expected, rtol=1e-5)
+
+    def test_dtype(self):
+        filtered = sbc.filter_cube(
+            self.sensor_filter, self.cube, dtype=np.float32)
+        assert filtered.dtype == np.float32
+
+    def test_wrong_shapes(self):
+        with pytest.raises(ValueError):
+            sbc.filter_cube(self.sensor_filter, self.cube[..., :10])
+        with pytest.raises(ValueError):
+            sbc.filter_cube(
+                self.sensor_filter, self.cube, np.empty((13, 7, 3)))
+
+
+class TestMultiSensorFilter(object):
+
+    """ MultiSensorFilter tests. """
+
+    @classmethod
+    def setup_class(cls):
+        directory = resource_filename(
+            sbc.__name__, 'tests/data/sensor_filters')
+        cls.casi04 = sbc.load_sensor_filter_spectral_library(
+            directory, 'CASI04_350_900_1nm')
+        cls.quickbird = sbc.load_sensor_filter_spectral_library(
+            directory, 'qbtest_filter_350_900nm')
+        # A filter covering only part of the input range
+        wavelengths = np.arange(500, 601, dtype=np.float64)
+        cls.partial = sbc.SensorFilter(
+            wavelengths, np.vstack([np.ones(101), np.arange(101.0)]))
+        cls.multi = sbc.MultiSensorFilter([
+            ('casi04', cls.casi04),
+            ('quickbird', cls.quickbird),
+            ('partial', tuple(cls.partial))])
+        cls.spectra = np.random.RandomState(0).uniform(size=(50, 551))
+
+    def test_stacking(self):
+        assert self.multi.names == ('casi04', 'quickbird', 'partial')
+        assert len(self.multi) == 3
+        assert self.multi.num_bands == 36
+        assert self.multi.num_input_bands == 551
+        assert np.array_equal(self.multi.wavelengths, np.arange(350, 901))
+        assert isinstance(self.multi['partial'], sbc.SensorFilter)
+        assert self.multi.band_slices['quickbird'] == slice(30, 34)
+
+    def test_from_dict(self):
+        multi = sbc.MultiSensorFilter({'quickbird': self.quickbird})
+        assert multi.names == ('quickbird',)
+        assert np.array_equal(multi.stacked.response, self.quickbird.response)
+
+    def test_apply_matches_each_sensor(self):
+        filtered = self.multi.apply(self.spectra)
+        assert list(filtered) == list(self.multi.names)
+        assert np.allclose(
+            filtered['casi04'], self.casi04.apply(self.spectra))
+        assert np.allclose(
+            filtered['quickbird'], self.quickbird.apply(self.spectra))
+        assert np.allclose(
+            filtered['partial'], self.partial.apply(self.spectra[:, 150:251]))
+        # The sensors share one output array
+        assert filtered['casi04'].base is filtered['partial'].base
+
+    def test_apply_cube(self):
+        cube = self.spectra.reshape(5, 10, -1)
+        filtered = self.multi.apply(cube)
+        assert filtered['quickbird'].shape == (5, 10, 4)
+        split = self.multi.split(sbc.filter_cube(self.multi.stacked, cube))
+        for name in self.multi.names:
+            assert np.array_equal(split[name], filtered[name])
+
+    def test_misaligned_wavelengths(self):
+        shifted = sbc.SensorFilter(
+            self.partial.wavelengths + 0.5, self.partial.response)
+        with pytest.raises(sbc.DataValidationError):
+            sbc.MultiSensorFilter(
+                [('quickbird', self.quickbird), ('shifted', shifted)])
+        with pytest.raises(ValueError):
+            sbc.MultiSensorFilter([])
+
+    def test_support(self):
+        response = np.zeros((2, 10))
+        response[0, 2:4] = 1.0
+        response[1, 6] = 0.5
+        sensor_filter = sbc.SensorFilter(np.arange(10.0), response)
+        assert np.array_equal(sensor_filter.support, [2, 3, 6])
+        assert not sensor_filter.support.flags.writeable
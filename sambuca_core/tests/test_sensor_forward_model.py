@@ -0,0 +1,103 @@
+# -*- coding: utf-8 -*-
+# Ensure compatibility of Python 2 with Python 3 constructs
+from __future__ import (
+    absolute_import,
+    division,
+    print_function,
+    unicode_literals)
+from builtins import *
+
+import numpy as np
+import pytest
+from pkg_resources import resource_filename
+from scipy.io import readsav
+
+import sambuca_core as sbc
+
+from .forward_model_inputs import (
+    load_forward_model_test_data,
+    random_free_parameters,
+)
+
+
+class TestSensorForwardModel(object):
+
+    """Sensor band forward model tests."""
+
+    @classmethod
+    def setup_class(cls):
+        _, fixed, _ = load_forward_model_test_data()
+        cls.context = sbc.ForwardModelContext(**fixed)
+        cls.batch = random_free_parameters(12)
+        cls.filter = readsav(resource_filename(
+            sbc.__name__,
+            './tests/data/sensor_filter_test_data.sav')).filter
+        cls.operator = sbc.sensor_filter_operator(cls.filter)
+
+    def test_operator_matches_apply_sensor_filter(self):
+        spectrum = self.context.evaluate(
+            **dict((k, v[0]) for k, v in self.batch.items())).rrs
+        assert self.operator.shape == (551, 28)
+        assert self.operator.flags['C_CONTIGUOUS']
+        assert np.allclose(
+            spectrum.dot(self.operator),
+            sbc.apply_sensor_filter(spectrum, self.filter))
+
+    def test_rrs_and_jacobian(self):
+        results = sbc.sensor_forward_model_batch(
+            self.context, self.operator, **self.batch)
+        assert results.rrs.shape == (12, 28)
+        assert results.jacobian.shape == (12, 7, 28)
+
+        full = self.context.evaluate_batch(**self.batch)
+        for i in range(12):
+            assert np.allclose(
+                results.rrs[i],
+                sbc.apply_sensor_filter(full.rrs[i], self.filter))
+            for j, name in enumerate(sbc.JACOBIAN_FIELDS):
+                assert np.allclose(
+                    results.jacobian[i, j],
+                    sbc.apply_sensor_filter(
+                        getattr(full, name)[i], self.filter)), name
+
+    def test_without_jacobian(self):
+        results = sbc.sensor_forward_model_batch(
+            self.context, self.operator, compute_jacobian=False, **self.batch)
+        with_jacobian = sbc.sensor_forward_model_batch(
+            self.context, self.operator, **self.batch)
+        assert results.jacobian is None
+        assert np.allclose(results.rrs, with_jacobian.rrs)
+
+    def test_band_count_mismatch(self):
+        with pytest.raises(ValueError):
+            sbc.sensor_forward_model_batch(
+                self.context, self.operator[:-1], **self.batch)
+
+    def test_pruned_to_filter_support(self):
+        # Four rectangular bands, covering a third of the model wavelengths
+        wavelengths = self.context.wavelengths
+        response = np.vstack([
+            (wavelengths >= low) & (wavelengths < high)
+            for low, high in ((450, 520), (520, 600), (630, 690), (760, 800))
+        ]).astype(np.float64)
+        sensor_filter = sbc.SensorFilter(wavelengths, response)
+        support = sensor_filter.support
+        assert len(support) == 250
+
+        pruned = self.context.subset(support)
+        assert pruned.num_bands == 250
+        assert np.array_equal(pruned.a_water, self.context.a_water[support])
+        for compute_jacobian in (True, False):
+            full = sbc.sensor_forward_model_batch(
+                self.context, sensor_filter,
+                compute_jacobian=compute_jacobian, **self.batch)
+            results = sbc.sensor_forward_model_batch(
+                pruned, sensor_filter, compute_jacobian=compute_jacobian,
+                support=support, **self.batch)
+            assert np.array_equal(results.rrs, full.rrs)
+            if compute_jacobian:
+                assert np.array_equal(results.jacobian, full.jacobian)
+
+        with pytest.raises(ValueError):
+            sbc.sensor_forward_model_batch(
+                self.context, sensor_filter, support=support, **self.batch)
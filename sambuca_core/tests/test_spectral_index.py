@@ -0,0 +1,83 @@
+# -*- coding: utf-8 -*-
+# Ensure compatibility of Python 2 with Python 3 constructs
+from __future__ import (
+    absolute_import,
+    division,
+    print_function,
+    unicode_literals)
+from builtins import *
+
+import numpy as np
+import pytest
+from pkg_resources import resource_filename
+from scipy.io import readsav
+
+import sambuca_core as sbc
+
+from .forward_model_inputs import (
+    load_forward_model_test_data,
+    random_free_parameters,
+)
+
+
+class TestSpectralIndex(object):
+
+    """Initial guess spectral index tests."""
+
+    @classmethod
+    def setup_class(cls):
+        _, fixed, _ = load_forward_model_test_data()
+        cls.context = sbc.ForwardModelContext(**fixed)
+        batch = random_free_parameters(300, seed=11)
+        cls.sample = np.stack(
+            [batch[name] for name in sbc.FREE_PARAMETERS], axis=-1)
+        cls.spectra = cls.context.evaluate_batch(
+            *cls.sample.T, compute_jacobian=False).rrs
+
+    def test_exact_match(self):
+        index = sbc.build_spectral_index(
+            self.context, self.sample, chunk_size=64)
+        results = index.query(self.spectra[:10], k=3)
+        assert results.parameters.shape == (10, 3, 7)
+        assert np.array_equal(results.indices[:, 0], np.arange(10))
+        assert np.allclose(results.parameters[:, 0], self.sample[:10])
+        assert np.allclose(results.distances[:, 0], 0.0)
+        assert np.all(np.diff(results.distances, axis=1) >= 0.0)
+
+    def test_pca_preserves_neighbours(self):
+        exact = sbc.build_spectral_index(self.context, self.sample)
+        reduced = sbc.build_spectral_index(
+            self.context, self.sample, num_components=20)
+        assert reduced.components.shape == (20, self.context.num_bands)
+        observed = self.spectra[:20] * 1.01
+        assert np.array_equal(
+            exact.query(observed).indices, reduced.query(observed).indices)
+
+    def test_sensor_bands(self):
+        nrf = readsav(resource_filename(
+            sbc.__name__, './tests/data/sensor_filter_test_data.sav')).filter
+        operator = sbc.sensor_filter_operator(nrf)
+        index = sbc.build_spectral_index(
+            self.context, self.sample, operator=operator)
+        assert index.num_bands == operator.shape[1]
+        results = index.query(np.dot(self.spectra[5], operator))
+        assert results.indices[0, 0] == 5
+        with pytest.raises(ValueError):
+            index.query(self.spectra[:1])
+
+    def test_save_and_load(self, tmpdir):
+        filename = str(tmpdir.join('index.npz'))
+        index = sbc.build_spectral_index(
+            self.context, self.sample, num_components=10)
+        index.save(filename)
+        loaded = sbc.SpectralIndex.load(filename)
+        assert np.array_equal(loaded.parameters, index.parameters)
+        assert np.array_equal(loaded.components, index.components)
+        observed = self.spectra[::7] * 0.98
+        assert np.array_equal(
+            loaded.query(observed, k=2).indices,
+            index.query(observed, k=2).indices)
+
+    def test_invalid_sample(self):
+        with pytest.raises(ValueError):
+            sbc.build_spectral_index(self.context, self.sample[:, :4])
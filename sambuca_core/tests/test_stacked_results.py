@@ -0,0 +1,107 @@
+# -*- coding: utf-8 -*-
+# Ensure compatibility of Python 2 with Python 3 constructs
+from __future__ import (
+    absolute_import,
+    division,
+    print_function,
+    unicode_literals)
+from builtins import *
+
+import numpy as np
+import pytest
+
+import sambuca_core as sbc
+
+from .forward_model_inputs import (
+    load_forward_model_test_data,
+    random_free_parameters,
+)
+
+
+class TestStackedForwardModelResults(object):
+
+    """Contiguous stacked result storage tests."""
+
+    @classmethod
+    def setup_class(cls):
+        _, fixed, _ = load_forward_model_test_data()
+        cls.context = sbc.ForwardModelContext(**fixed)
+        cls.batch = random_free_parameters(6)
+        cls.results = cls.context.evaluate_batch(**cls.batch)
+
+    def test_buffer_layout(self):
+        stacked = sbc.StackedForwardModelResults.from_results(self.results)
+        assert stacked.buffer.shape == (6, 29, self.context.num_bands)
+        assert stacked.buffer.flags['C_CONTIGUOUS']
+        assert len(stacked) == 6
+
+    def test_fields_match_results(self):
+        stacked = sbc.StackedForwardModelResults.from_results(self.results)
+        for name in sbc.ForwardModelResults._fields:
+            expected = np.broadcast_to(
+                getattr(self.results, name), stacked.field(name).shape)
+            assert np.array_equal(getattr(stacked.results, name), expected)
+            assert np.shares_memory(stacked.field(name), stacked.buffer)
+
+    def test_namedtuple_interface(self):
+        stacked = sbc.StackedForwardModelResults.from_results(self.results)
+        assert isinstance(stacked.results, sbc.ForwardModelResults)
+        assert np.array_equal(stacked.results[0], stacked.buffer[:, 0, :])
+        assert stacked.results._asdict()['kd'] is stacked.results.kd
+
+    def test_without_jacobian(self):
+        results = self.context.evaluate_batch(
+            compute_jacobian=False, **self.batch)
+        stacked = sbc.StackedForwardModelResults.from_results(results)
+        assert stacked.buffer.shape == (6, 22, self.context.num_bands)
+        assert stacked.results.rrs_dchl is None
+        assert np.array_equal(stacked.results.rrs, results.rrs)
+
+    def test_memoryview_round_trip_is_zero_copy(self):
+        stacked = sbc.StackedForwardModelResults.from_results(self.results)
+        view = stacked.memoryview()
+        assert view.nbytes == sbc.StackedForwardModelResults.nbytes(
+            6, self.context.num_bands)
+
+        copy = sbc.StackedForwardModelResults.from_buffer(
+            view, self.context.num_bands)
+        assert np.shares_memory(copy.buffer, stacked.buffer)
+        assert np.array_equal(copy.results.rrs, self.results.rrs)
+
+    def test_shared_memory(self):
+        shared_memory = pytest.importorskip('multiprocessing.shared_memory')
+        num_bands = self.context.num_bands
+        block = shared_memory.SharedMemory(
+            create=True,
+            size=sbc.StackedForwardModelResults.nbytes(6, num_bands))
+        try:
+            stacked = sbc.StackedForwardModelResults.allocate(
+                6, num_bands, buffer=block.buf)
+            sbc.StackedForwardModelResults.from_results(
+                self.results, out=stacked)
+
+            attached = shared_memory.SharedMemory(name=block.name)
+            try:
+                other = sbc.StackedForwardModelResults.from_buffer(
+                    attached.buf, num_bands, batch_size=6)
+                assert np.array_equal(other.results.rrs, self.results.rrs)
+                assert np.array_equal(
+                    other.results.rrs_dfrac3, self.results.rrs_dfrac3)
+                del other
+            finally:
+                attached.close()
+            del stacked
+        finally:
+            block.close()
+            block.unlink()
+
+    def test_slice_shares_memory(self):
+        stacked = sbc.StackedForwardModelResults.from_results(self.results)
+        part = stacked[2:4]
+        assert len(part) == 2
+        assert np.shares_memory(part.buffer, stacked.buffer)
+        assert np.array_equal(part.results.rrs, self.results.rrs[2:4])
+
+    def test_invalid_field_count(self):
+        with pytest.raises(ValueError):
+            sbc.StackedForwardModelResults(np.zeros((2, 5, 3)))
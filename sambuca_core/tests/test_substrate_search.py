@@ -0,0 +1,163 @@
+# -*- coding: utf-8 -*-
+# Ensure compatibility of Python 2 with Python 3 constructs
+from __future__ import (
+    absolute_import,
+    division,
+    print_function,
+    unicode_literals)
+from builtins import *
+
+import itertools
+
+import numpy as np
+import pytest
+
+import sambuca_core as sbc
+
+from .forward_model_inputs import load_forward_model_test_data
+
+
+def substrate_library(fixed):
+    """ A library of the two test substrates and three synthetic spectra. """
+    wavelengths = fixed['wavelengths']
+    scaled = (wavelengths - wavelengths[0]) / \
+        (wavelengths[-1] - wavelengths[0])
+    return np.array([
+        fixed['substrate1'],
+        fixed['substrate2'],
+        0.05 + 0.4 * scaled,
+        0.3 * np.exp(-0.5 * ((wavelengths - 560.0) / 40.0) ** 2) + 0.02,
+        np.full_like(wavelengths, 0.15),
+    ])
+
+
+class TestWithSubstrates(object):
+
+    """ForwardModelContext.with_substrates tests."""
+
+    @classmethod
+    def setup_class(cls):
+        _, cls.fixed, _ = load_forward_model_test_data()
+        cls.context = sbc.ForwardModelContext(**cls.fixed)
+        cls.library = substrate_library(cls.fixed)
+
+    def test_matches_new_context(self):
+        copy = self.context.with_substrates(*self.library[2:5])
+        arguments = dict(self.fixed)
+        arguments.update(
+            substrate1=self.library[2],
+            substrate2=self.library[3],
+            substrate3=self.library[4])
+        expected = sbc.ForwardModelContext(**arguments)
+        parameters = (0.3, 0.02, 1.0, 2.5, 0.2, 0.3, 0.5)
+        actual = copy.evaluate(*parameters)
+        reference = expected.evaluate(*parameters)
+        for name in actual._fields:
+            assert np.array_equal(getattr(actual, name),
+                                  getattr(reference, name))
+
+    def test_original_unchanged(self):
+        self.context.with_substrates(*self.library[2:5])
+        assert np.array_equal(self.context.substrate1,
+                              self.fixed['substrate1'])
+
+    def test_wrong_bands(self):
+        with pytest.raises(ValueError):
+            self.context.with_substrates(
+                self.library[0][:10], self.library[1], self.library[2])
+
+
+class TestSearchSubstrates(object):
+
+    """Substrate combination search tests."""
+
+    @classmethod
+    def setup_class(cls):
+        _, fixed, _ = load_forward_model_test_data()
+        cls.context = sbc.ForwardModelContext(**fixed)
+        cls.library = substrate_library(fixed)
+        cls.initial = np.array([0.3, 0.05, 1.0, 3.0, 0.33, 0.33, 0.33])
+        cls.lower = np.array([0.01, 0.0005, 0.2, 0.1, 0.0, 0.0, 0.0])
+        cls.upper = np.array([2.0, 0.5, 5.0, 15.0, 1.0, 1.0, 1.0])
+
+        # Each pixel mixes a different triplet of library substrates
+        cls.triplets = [(0, 2, 4), (1, 3, 4), (0, 1, 3), (2, 3, 4)]
+        cls.truth = np.array([
+            [0.2, 0.02, 0.8, 2.0, 0.5, 0.3, 0.2],
+            [0.5, 0.04, 1.2, 3.5, 0.2, 0.5, 0.3],
+            [0.3, 0.08, 0.6, 2.5, 0.4, 0.2, 0.4],
+            [0.4, 0.03, 1.5, 1.5, 0.3, 0.3, 0.4]])
+        cls.observed = np.array([
+            cls.context.with_substrates(*cls.library[list(triplet)]).evaluate(
+                *parameters, compute_jacobian=False).rrs
+            for triplet, parameters in zip(cls.triplets, cls.truth)])
+
+    def search(self, **kwargs):
+        return sbc.search_substrates(
+            self.context, self.library, self.observed, self.initial,
+            self.lower, self.upper, project_fractions=True, **kwargs)
+
+    def test_finds_combinations(self):
+        results = self.search()
+        assert results.combinations.shape == (10, 3)
+        found = [tuple(results.combinations[index])
+                 for index in results.combination]
+        assert found == self.triplets
+        assert np.allclose(results.parameters, self.truth, atol=1e-6)
+        assert np.all(results.cost < 1e-12)
+        assert results.screening_cost.shape == (4, 10)
+
+    def test_pruning_saves_evaluations(self):
+        exhaustive = np.zeros(len(self.observed), dtype=np.intp)
+        for triplet in itertools.combinations(range(len(self.library)), 3):
+            exhaustive += sbc.invert_batch(
+                self.context.with_substrates(*self.library[list(triplet)]),
+                self.observed, self.initial, self.lower, self.upper,
+                project_fractions=True).evaluations
+        results = self.search()
+        assert np.all(results.evaluations < exhaustive)
+        screened = self.search(candidates=3)
+        assert np.all(screened.evaluations < results.evaluations)
+
+    def test_halving_keeps_alive_combinations(self):
+        # pylint: disable=protected-access
+        halve = sbc.substrate_search._halve
+        alive = np.array([
+            [True, True, True, False, False],
+            [True, True, False, True, False],
+            [False, False, False, False, True]])
+        # Invalid pixels have infinite costs for every combination, and
+        # pruned combinations keep their last, possibly lower, costs.
+        cost = np.array([
+            [np.inf, np.inf, 1.0, 0.5, np.inf],
+            [np.inf, np.inf, np.inf, np.inf, np.inf],
+            [0.1, 0.2, 0.3, 0.4, np.inf]])
+        assert halve(alive, cost).tolist() == [
+            [True, False, True, False, False],
+            [True, True, False, False, False],
+            [False, False, False, False, True]]
+
+    def test_pairs(self):
+        results = self.search(combination_size=2)
+        assert results.combinations.shape == (10, 2)
+        assert np.all(results.parameters[:, 6] == 0.0)
+        # No pair explains the triplet mixtures exactly, but each result is
+        # the best of all the pairs that were inverted.
+        assert np.all(results.cost > 0.0)
+
+    def test_weights(self):
+        weights = np.ones(self.context.num_bands)
+        weighted = self.search(weights=weights)
+        unweighted = self.search()
+        assert np.array_equal(weighted.combination, unweighted.combination)
+        assert np.allclose(weighted.cost, unweighted.cost)
+
+    def test_invalid_combination_size(self):
+        with pytest.raises(ValueError):
+            self.search(combination_size=4)
+
+    def test_invalid_library(self):
+        with pytest.raises(ValueError):
+            sbc.search_substrates(
+                self.context, self.library[:, :10], self.observed,
+                self.initial)